@@ -93,6 +93,11 @@ def preprocess_entry():
     parser.add_argument('--verbose', required=False, action='store_true',
                         help='Set this to print a lot of stuff. Useful for debugging. Will disable progrewss bar! '
                              'Recommended for cluster environments')
+    parser.add_argument('--incremental', required=False, action='store_true',
+                        help='Only preprocess cases that are new or whose images/labels changed since the last '
+                             'preprocessing run (and remove cases that are no longer in the dataset). If plans, '
+                             'configuration or dataset.json changed, everything is preprocessed again. Useful when '
+                             'adding cases to a large dataset')
     args, unrecognized_args = parser.parse_known_args()
     if args.np is None:
         default_np = {
@@ -103,7 +108,8 @@ def preprocess_entry():
         np = {default_np[c] if c in default_np.keys() else 4 for c in args.c}
     else:
         np = args.np
-    preprocess(args.d, args.plans_name, configurations=args.c, num_processes=np, verbose=args.verbose)
+    preprocess(args.d, args.plans_name, configurations=args.c, num_processes=np, verbose=args.verbose,
+               incremental=args.incremental)
 
 
 def plan_and_preprocess_entry():
@@ -175,6 +181,11 @@ def plan_and_preprocess_entry():
     parser.add_argument('--verbose', required=False, action='store_true',
                         help='Set this to print a lot of stuff. Useful for debugging. Will disable progrewss bar! '
                              'Recommended for cluster environments')
+    parser.add_argument('--incremental', required=False, action='store_true',
+                        help='Only preprocess cases that are new or whose images/labels changed since the last '
+                             'preprocessing run (and remove cases that are no longer in the dataset). If plans, '
+                             'configuration or dataset.json changed, everything is preprocessed again. Useful when '
+                             'adding cases to a large dataset')
     args = parser.parse_args()
 
     # fingerprint extraction
@@ -194,7 +205,7 @@ def plan_and_preprocess_entry():
     # preprocessing
     if not args.no_pp:
         print('Preprocessing...')
-        preprocess(args.d, args.overwrite_plans_name, args.c, np, args.verbose)
+        preprocess(args.d, args.overwrite_plans_name, args.c, np, args.verbose, args.incremental)
 
 
 if __name__ == '__main__':
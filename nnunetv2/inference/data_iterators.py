@@ -1,60 +1,151 @@
 import multiprocessing
 import queue
-from torch.multiprocessing import Event, Process, Queue, Manager
+import traceback
+from torch.multiprocessing import Event, Queue
 
-from time import sleep
-from typing import Union, List
+from typing import Union, List, Callable
 
 import numpy as np
 import torch
 from batchgenerators.dataloading.data_loader import DataLoader
 
 from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor
-from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
+from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot, LabelManager
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 
 
-def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
-                                       list_of_segs_from_prev_stage_files: Union[None, List[str]],
-                                       output_filenames_truncated: Union[None, List[str]],
-                                       plans_manager: PlansManager,
-                                       dataset_json: dict,
-                                       configuration_manager: ConfigurationManager,
-                                       target_queue: Queue,
-                                       done_event: Event,
-                                       abort_event: Event,
-                                       verbose: bool = False):
+def preprocess_case_fromfiles(preprocessor: DefaultPreprocessor,
+                               label_manager: LabelManager,
+                               plans_manager: PlansManager,
+                               dataset_json: dict,
+                               configuration_manager: ConfigurationManager,
+                               image_files: List[str],
+                               seg_from_prev_stage_file: Union[str, None],
+                               output_filename_truncated: Union[str, None]) -> dict:
+    data, seg, data_properites = preprocessor.run_case(image_files, seg_from_prev_stage_file, plans_manager,
+                                                       configuration_manager, dataset_json)
+    if seg_from_prev_stage_file is not None:
+        seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
+        data = np.vstack((data, seg_onehot))
+
+    data = torch.from_numpy(data).contiguous().float()
+    return {'data': data, 'data_properites': data_properites, 'ofile': output_filename_truncated}
+
+
+def preprocessing_worker(preprocess_case_fn: Callable,
+                         plans_manager: PlansManager,
+                         dataset_json: dict,
+                         configuration_manager: ConfigurationManager,
+                         task_queue: Queue,
+                         result_queue: Queue,
+                         abort_event: Event,
+                         verbose: bool = False):
+    """
+    Takes (idx, case_args) from task_queue until it receives None, preprocesses the case with preprocess_case_fn and
+    puts (idx, item) into result_queue. Tensors in item are not pickled through the pipe, torch moves them to shared
+    memory and only sends a handle. If something goes wrong, (None, traceback) is put into result_queue
+    """
     try:
         label_manager = plans_manager.get_label_manager(dataset_json)
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        for idx in range(len(list_of_lists)):
-            data, seg, data_properites = preprocessor.run_case(list_of_lists[idx],
-                                                               list_of_segs_from_prev_stage_files[
-                                                                   idx] if list_of_segs_from_prev_stage_files is not None else None,
-                                                               plans_manager,
-                                                               configuration_manager,
-                                                               dataset_json)
-            if list_of_segs_from_prev_stage_files is not None and list_of_segs_from_prev_stage_files[idx] is not None:
-                seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
-                data = np.vstack((data, seg_onehot))
-
-            data = torch.from_numpy(data).contiguous().float()
-
-            item = {'data': data, 'data_properites': data_properites,
-                    'ofile': output_filenames_truncated[idx] if output_filenames_truncated is not None else None}
-            success = False
-            while not success:
+        while not abort_event.is_set():
+            task = task_queue.get()
+            if task is None:
+                return
+            idx, case_args = task
+            item = preprocess_case_fn(preprocessor, label_manager, plans_manager, dataset_json, configuration_manager,
+                                      *case_args)
+            result_queue.put((idx, item))
+    except Exception:
+        abort_event.set()
+        result_queue.put((None, traceback.format_exc()))
+
+
+def preprocessing_iterator(preprocess_case_fn: Callable,
+                           list_of_case_args: List[tuple],
+                           plans_manager: PlansManager,
+                           dataset_json: dict,
+                           configuration_manager: ConfigurationManager,
+                           num_processes: int,
+                           pin_memory: bool = False,
+                           verbose: bool = False,
+                           in_order: bool = True):
+    """
+    Preprocesses cases in num_processes background workers and yields them as soon as they are done.
+
+    Work is handed out dynamically: each worker gets the next case as soon as it is done with its current one, so one
+    huge case only occupies one worker and does not hold up the others. At most 2 * num_processes cases are in flight
+    (submitted but not yet yielded) so that we don't fill up the RAM if the GPU is slower than the preprocessing.
+
+    in_order=True yields the cases in the order of list_of_case_args (finished cases are held back until all cases
+    before them are done). in_order=False yields them in the order in which they finish. Use that whenever the order
+    does not matter, for example when the predictions are written to files anyway.
+    """
+    # the torch.multiprocessing import above registers the torch reductions with multiprocessing, so tensors put into
+    # these queues go through shared memory
+    context = multiprocessing.get_context('spawn')
+    num_cases = len(list_of_case_args)
+    num_processes = min(num_cases, num_processes)
+    assert num_processes >= 1
+    task_queue = context.Queue()
+    result_queue = context.Queue()
+    abort_event = context.Event()
+    processes = []
+    for i in range(num_processes):
+        pr = context.Process(target=preprocessing_worker,
+                             args=(
+                                 preprocess_case_fn,
+                                 plans_manager,
+                                 dataset_json,
+                                 configuration_manager,
+                                 task_queue,
+                                 result_queue,
+                                 abort_event,
+                                 verbose
+                             ), daemon=True)
+        pr.start()
+        processes.append(pr)
+
+    max_in_flight = 2 * num_processes
+    num_submitted = 0
+    num_yielded = 0
+    next_idx_to_yield = 0
+    held_back = {}
+    try:
+        while num_yielded < num_cases:
+            while num_submitted < num_cases and num_submitted - num_yielded < max_in_flight:
+                task_queue.put((num_submitted, list_of_case_args[num_submitted]))
+                num_submitted += 1
+
+            if in_order and next_idx_to_yield in held_back:
+                item = held_back.pop(next_idx_to_yield)
+            else:
                 try:
-                    if abort_event.is_set():
-                        return
-                    target_queue.put(item, timeout=0.01)
-                    success = True
-                except queue.Full:
-                    pass
-        done_event.set()
-    except Exception as e:
+                    idx, item = result_queue.get(timeout=1)
+                except queue.Empty:
+                    if not all([p.is_alive() for p in processes]):
+                        raise RuntimeError('Background workers died. Look for the error message further up! If '
+                                           'there is none then your RAM was full and the worker was killed by the '
+                                           'OS. Use fewer workers or get more RAM in that case!')
+                    continue
+                if idx is None:
+                    raise RuntimeError(f'Preprocessing failed in a background worker:\n{item}')
+                if in_order and idx != next_idx_to_yield:
+                    held_back[idx] = item
+                    continue
+            next_idx_to_yield += 1
+            num_yielded += 1
+            if pin_memory:
+                item['data'] = item['data'].pin_memory()
+            yield item
+        for _ in processes:
+            task_queue.put(None)
+        [p.join() for p in processes]
+    finally:
         abort_event.set()
-        raise e
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
 
 
 def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
@@ -65,56 +156,18 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
                                      configuration_manager: ConfigurationManager,
                                      num_processes: int,
                                      pin_memory: bool = False,
-                                     verbose: bool = False):
-    context = multiprocessing.get_context('spawn')
-    manager = Manager()
-    num_processes = min(len(list_of_lists), num_processes)
-    assert num_processes >= 1
-    processes = []
-    done_events = []
-    target_queues = []
-    abort_event = manager.Event()
-    for i in range(num_processes):
-        event = manager.Event()
-        queue = Manager().Queue(maxsize=1)
-        pr = context.Process(target=preprocess_fromfiles_save_to_queue,
-                     args=(
-                         list_of_lists[i::num_processes],
-                         list_of_segs_from_prev_stage_files[
-                         i::num_processes] if list_of_segs_from_prev_stage_files is not None else None,
-                         output_filenames_truncated[
-                         i::num_processes] if output_filenames_truncated is not None else None,
-                         plans_manager,
-                         dataset_json,
-                         configuration_manager,
-                         queue,
-                         event,
-                         abort_event,
-                         verbose
-                     ), daemon=True)
-        pr.start()
-        target_queues.append(queue)
-        done_events.append(event)
-        processes.append(pr)
+                                     verbose: bool = False,
+                                     in_order: bool = True):
+    if list_of_segs_from_prev_stage_files is None:
+        list_of_segs_from_prev_stage_files = [None] * len(list_of_lists)
+    if output_filenames_truncated is None:
+        output_filenames_truncated = [None] * len(list_of_lists)
+    return preprocessing_iterator(preprocess_case_fromfiles,
+                                  list(zip(list_of_lists, list_of_segs_from_prev_stage_files,
+                                           output_filenames_truncated)),
+                                  plans_manager, dataset_json, configuration_manager, num_processes, pin_memory,
+                                  verbose, in_order)
 
-    worker_ctr = 0
-    while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
-        if not target_queues[worker_ctr].empty():
-            item = target_queues[worker_ctr].get()
-            worker_ctr = (worker_ctr + 1) % num_processes
-        else:
-            all_ok = all(
-                [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
-            if not all_ok:
-                raise RuntimeError('Background workers died. Look for the error message further up! If there is '
-                                   'none then your RAM was full and the worker was killed by the OS. Use fewer '
-                                   'workers or get more RAM in that case!')
-            sleep(0.01)
-            continue
-        if pin_memory:
-            [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
-        yield item
-    [p.join() for p in processes]
 
 class PreprocessAdapter(DataLoader):
     def __init__(self, list_of_lists: List[List[str]],
@@ -210,49 +263,23 @@ class PreprocessAdapterFromNpy(DataLoader):
         return {'data': data, 'data_properites': props, 'ofile': ofname}
 
 
-def preprocess_fromnpy_save_to_queue(list_of_images: List[np.ndarray],
-                                     list_of_segs_from_prev_stage: Union[List[np.ndarray], None],
-                                     list_of_image_properties: List[dict],
-                                     truncated_ofnames: Union[List[str], None],
-                                     plans_manager: PlansManager,
-                                     dataset_json: dict,
-                                     configuration_manager: ConfigurationManager,
-                                     target_queue: Queue,
-                                     done_event: Event,
-                                     abort_event: Event,
-                                     verbose: bool = False):
-    try:
-        label_manager = plans_manager.get_label_manager(dataset_json)
-        preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        for idx in range(len(list_of_images)):
-            data, seg = preprocessor.run_case_npy(list_of_images[idx],
-                                                  list_of_segs_from_prev_stage[
-                                                      idx] if list_of_segs_from_prev_stage is not None else None,
-                                                  list_of_image_properties[idx],
-                                                  plans_manager,
-                                                  configuration_manager,
-                                                  dataset_json)
-            if list_of_segs_from_prev_stage is not None and list_of_segs_from_prev_stage[idx] is not None:
-                seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
-                data = np.vstack((data, seg_onehot))
-
-            data = torch.from_numpy(data).contiguous().float()
-
-            item = {'data': data, 'data_properites': list_of_image_properties[idx],
-                    'ofile': truncated_ofnames[idx] if truncated_ofnames is not None else None}
-            success = False
-            while not success:
-                try:
-                    if abort_event.is_set():
-                        return
-                    target_queue.put(item, timeout=0.01)
-                    success = True
-                except queue.Full:
-                    pass
-        done_event.set()
-    except Exception as e:
-        abort_event.set()
-        raise e
+def preprocess_case_fromnpy(preprocessor: DefaultPreprocessor,
+                             label_manager: LabelManager,
+                             plans_manager: PlansManager,
+                             dataset_json: dict,
+                             configuration_manager: ConfigurationManager,
+                             image: np.ndarray,
+                             seg_from_prev_stage: Union[np.ndarray, None],
+                             image_properties: dict,
+                             output_filename_truncated: Union[str, None]) -> dict:
+    data, seg = preprocessor.run_case_npy(image, seg_from_prev_stage, image_properties, plans_manager,
+                                          configuration_manager, dataset_json)
+    if seg_from_prev_stage is not None:
+        seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
+        data = np.vstack((data, seg_onehot))
+
+    data = torch.from_numpy(data).contiguous().float()
+    return {'data': data, 'data_properites': image_properties, 'ofile': output_filename_truncated}
 
 
 def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
@@ -264,53 +291,14 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
                                    configuration_manager: ConfigurationManager,
                                    num_processes: int,
                                    pin_memory: bool = False,
-                                   verbose: bool = False):
-    context = multiprocessing.get_context('spawn')
-    manager = Manager()
-    num_processes = min(len(list_of_images), num_processes)
-    assert num_processes >= 1
-    target_queues = []
-    processes = []
-    done_events = []
-    abort_event = manager.Event()
-    for i in range(num_processes):
-        event = manager.Event()
-        queue = manager.Queue(maxsize=1)
-        pr = context.Process(target=preprocess_fromnpy_save_to_queue,
-                     args=(
-                         list_of_images[i::num_processes],
-                         list_of_segs_from_prev_stage[
-                         i::num_processes] if list_of_segs_from_prev_stage is not None else None,
-                         list_of_image_properties[i::num_processes],
-                         truncated_ofnames[i::num_processes] if truncated_ofnames is not None else None,
-                         plans_manager,
-                         dataset_json,
-                         configuration_manager,
-                         queue,
-                         event,
-                         abort_event,
-                         verbose
-                     ), daemon=True)
-        pr.start()
-        done_events.append(event)
-        processes.append(pr)
-        target_queues.append(queue)
-
-    worker_ctr = 0
-    while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
-        if not target_queues[worker_ctr].empty():
-            item = target_queues[worker_ctr].get()
-            worker_ctr = (worker_ctr + 1) % num_processes
-        else:
-            all_ok = all(
-                [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
-            if not all_ok:
-                raise RuntimeError('Background workers died. Look for the error message further up! If there is '
-                                   'none then your RAM was full and the worker was killed by the OS. Use fewer '
-                                   'workers or get more RAM in that case!')
-            sleep(0.01)
-            continue
-        if pin_memory:
-            [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
-        yield item
-    [p.join() for p in processes]
+                                   verbose: bool = False,
+                                   in_order: bool = True):
+    if list_of_segs_from_prev_stage is None:
+        list_of_segs_from_prev_stage = [None] * len(list_of_images)
+    if truncated_ofnames is None:
+        truncated_ofnames = [None] * len(list_of_images)
+    return preprocessing_iterator(preprocess_case_fromnpy,
+                                  list(zip(list_of_images, list_of_segs_from_prev_stage, list_of_image_properties,
+                                           truncated_ofnames)),
+                                  plans_manager, dataset_json, configuration_manager, num_processes, pin_memory,
+                                  verbose, in_order)
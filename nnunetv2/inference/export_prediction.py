@@ -8,34 +8,98 @@ from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
 from batchgenerators.utilities.file_and_folder_operations import load_json, isfile, save_pickle
 
 from nnunetv2.configuration import default_num_processes
+from nnunetv2.utilities.helpers import softmax_helper_dim0
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 
 
-def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray],
+def resample_logits_and_convert_to_segmentation_chunked(predicted_logits: Union[torch.Tensor, np.ndarray],
+                                                        configuration_manager: ConfigurationManager,
+                                                        label_manager: LabelManager,
+                                                        properties_dict: dict,
+                                                        current_spacing: List[float],
+                                                        num_channels_per_chunk: int = 4) -> np.ndarray:
+    """
+    Resamples predicted_logits to properties_dict['shape_after_cropping_and_before_resampling'] num_channels_per_chunk
+    channels at a time and immediately reduces them to a segmentation:
+    - labels: we keep a running max and argmax of the logits (softmax is monotonic, so argmax(logits) is
+    argmax(softmax(logits)))
+    - regions: logit > 0 is the same as sigmoid(logit) > 0.5. Regions are written in regions_class_order
+    Resampling treats each channel independently, so the result is the same as resampling everything at once. But peak
+    memory no longer depends on the number of classes. Only use this with the default inference nonlinearities!
+    """
+    target_shape = properties_dict['shape_after_cropping_and_before_resampling']
+    segmentation = np.zeros(target_shape, dtype=np.uint16)
+    running_max = None
+    for c0 in range(0, predicted_logits.shape[0], num_channels_per_chunk):
+        resampled = configuration_manager.resampling_fn_probabilities(predicted_logits[c0:c0 + num_channels_per_chunk],
+                                                                      target_shape,
+                                                                      current_spacing,
+                                                                      properties_dict['spacing'])
+        if isinstance(resampled, torch.Tensor):
+            resampled = resampled.cpu().numpy()
+        if label_manager.has_regions:
+            for i in range(resampled.shape[0]):
+                segmentation[resampled[i] > 0] = label_manager.regions_class_order[c0 + i]
+        else:
+            chunk_max = resampled.max(0)
+            chunk_argmax = resampled.argmax(0) + c0
+            if running_max is None:
+                running_max = chunk_max
+                segmentation[:] = chunk_argmax
+            else:
+                # strictly greater: on ties the lower class index wins, same as argmax
+                better = chunk_max > running_max
+                running_max[better] = chunk_max[better]
+                segmentation[better] = chunk_argmax[better]
+        del resampled
+    return segmentation
+
+
+def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray, str],
                                                                 plans_manager: PlansManager,
                                                                 configuration_manager: ConfigurationManager,
                                                                 label_manager: LabelManager,
                                                                 properties_dict: dict,
                                                                 return_probabilities: bool = False,
                                                                 num_threads_torch: int = default_num_processes):
+    """
+    predicted_logits can also be the name of a .npy file (see nnUNetPredictor.accumulate_on_disk). It will be loaded
+    as a memory map and DELETED once we are done with it
+    """
     old_threads = torch.get_num_threads()
     torch.set_num_threads(num_threads_torch)
 
-    # resample to original shape
-    current_spacing = configuration_manager.spacing if \
-        len(configuration_manager.spacing) == \
-        len(properties_dict['shape_after_cropping_and_before_resampling']) else \
-        [properties_dict['spacing'][0], *configuration_manager.spacing]
-    predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
-                                            properties_dict['shape_after_cropping_and_before_resampling'],
-                                            current_spacing,
-                                            properties_dict['spacing'])
-    # return value of resampling_fn_probabilities can be ndarray or Tensor but that doesnt matter because
-    # apply_inference_nonlin will covnert to torch
-    predicted_probabilities = label_manager.apply_inference_nonlin(predicted_logits)
-    del predicted_logits
-    segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities)
+    delfile = predicted_logits if isinstance(predicted_logits, str) else None
+    try:
+        if delfile is not None:
+            predicted_logits = np.load(delfile, mmap_mode='r')
+
+        # resample to original shape
+        current_spacing = configuration_manager.spacing if \
+            len(configuration_manager.spacing) == \
+            len(properties_dict['shape_after_cropping_and_before_resampling']) else \
+            [properties_dict['spacing'][0], *configuration_manager.spacing]
+        if not return_probabilities and label_manager.inference_nonlin in (softmax_helper_dim0, torch.sigmoid):
+            # we only need the segmentation. No need to ever hold all resampled channels in memory
+            segmentation = resample_logits_and_convert_to_segmentation_chunked(predicted_logits, configuration_manager,
+                                                                               label_manager, properties_dict,
+                                                                               current_spacing)
+        else:
+            predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
+                                                    properties_dict['shape_after_cropping_and_before_resampling'],
+                                                    current_spacing,
+                                                    properties_dict['spacing'])
+            # return value of resampling_fn_probabilities can be ndarray or Tensor but that doesnt matter because
+            # apply_inference_nonlin will covnert to torch
+            predicted_probabilities = label_manager.apply_inference_nonlin(predicted_logits)
+            del predicted_logits
+            segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities)
+    finally:
+        # also if something went wrong, nobody else is going to delete the file. Drop the memory map first (Windows)
+        predicted_logits = None
+        if delfile is not None:
+            os.remove(delfile)
 
     # segmentation may be torch.Tensor but we continue with numpy
     if isinstance(segmentation, torch.Tensor):
@@ -68,18 +132,16 @@ def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits
         return segmentation_reverted_cropping
 
 
-def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, torch.Tensor], properties_dict: dict,
+def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, torch.Tensor, str], properties_dict: dict,
                                   configuration_manager: ConfigurationManager,
                                   plans_manager: PlansManager,
                                   dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
                                   save_probabilities: bool = False):
-    # if isinstance(predicted_array_or_file, str):
-    #     tmp = deepcopy(predicted_array_or_file)
-    #     if predicted_array_or_file.endswith('.npy'):
-    #         predicted_array_or_file = np.load(predicted_array_or_file)
-    #     elif predicted_array_or_file.endswith('.npz'):
-    #         predicted_array_or_file = np.load(predicted_array_or_file)['softmax']
-    #     os.remove(tmp)
+    # if predicted_array_or_file is a str it must be a .npy file. It is memory mapped and deleted in
+    # convert_predicted_logits_to_segmentation_with_correct_shape
+    # torch tensors coming from nnUNetPredictor live in shared memory, so when this runs in an export worker we got a
+    # mapping of the predictor's buffer and not a copy (see nnUNetPredictor._internal_move_to_shared_memory). The del
+    # below releases our reference as soon as possible
 
     if isinstance(dataset_json_dict_or_file, str):
         dataset_json_dict_or_file = load_json(dataset_json_dict_or_file)
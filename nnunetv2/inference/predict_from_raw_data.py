@@ -1,9 +1,14 @@
 import inspect
+import itertools
 import multiprocessing
 import os
+import queue
+import tempfile
+import threading
 import traceback
+import weakref
 from copy import deepcopy
-from time import sleep
+from time import time
 from typing import Tuple, Union, List, Optional
 
 import numpy as np
@@ -25,9 +30,10 @@ from nnunetv2.inference.export_prediction import export_prediction_from_logits,
     convert_predicted_logits_to_segmentation_with_correct_shape
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian, \
     compute_steps_for_sliding_window
-from nnunetv2.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
+from nnunetv2.utilities.export_backpressure import ExportBackpressure
+from nnunetv2.utilities.file_path_utilities import get_output_folder
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
-from nnunetv2.utilities.helpers import empty_cache, dummy_context
+from nnunetv2.utilities.helpers import empty_cache, dummy_context, get_available_memory
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
 from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
@@ -43,7 +49,66 @@ class nnUNetPredictor(object):
                  device: torch.device = torch.device('cuda'),
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
-                 allow_tqdm: bool = True):
+                 allow_tqdm: bool = True,
+                 tile_batch_size: int = None,
+                 batched_mirroring: bool = False,
+                 skip_empty_tiles: bool = False,
+                 empty_tile_threshold: float = None,
+                 coarse_to_fine: bool = False,
+                 coarse_tile_step_size: float = 1.,
+                 roi_margin: float = 0.25,
+                 pipeline_tiles: bool = False,
+                 accumulate_on_disk: bool = False,
+                 accumulate_on_disk_folder: str = None,
+                 share_tiles_across_folds: bool = False,
+                 micro_batch_cases: int = 1,
+                 micro_batch_max_latency: float = 0.5):
+        """
+        tile_batch_size: number of sliding window tiles that are stacked into one forward pass. None means this is
+        determined automatically from the memory available on the device (see _internal_get_tile_batch_size)
+
+        batched_mirroring: if True, all mirrored variants of a tile are concatenated along the batch dimension and
+        predicted in as few forward passes as the available memory allows (instead of one forward pass per mirroring
+        combination). Same result, better hardware utilization
+
+        skip_empty_tiles: if True, sliding window tiles that carry no information are not predicted. Their logits are
+        filled with background instead. By default a tile is empty if all its intensities are exactly 0, which only
+        happens for tiles that lie entirely in the zero padding of the image or outside of the nonzero mask (with
+        use_mask_for_norm the normalization sets everything there to 0). Other constant regions (for example air in
+        CT) are still predicted. If empty_tile_threshold is given, a tile is empty if all its (normalized!)
+        intensities are <= empty_tile_threshold instead.
+        This is an approximation: the network never sees these tiles. The number of skipped tiles of the last
+        prediction is stored in self.num_skipped_tiles
+
+        coarse_to_fine: if True, each image is first predicted with coarse_tile_step_size and without mirroring. The
+        bounding box of the predicted foreground is then enlarged by roi_margin (fraction of the patch size) on each
+        side and only this region of interest is predicted again with tile_step_size and use_mirroring. Everything
+        outside the ROI keeps the coarse prediction. Makes a lot of sense for datasets with small structures in large
+        images
+
+        pipeline_tiles: only relevant if we predict on a cuda device but the image or the predicted logits are in CPU
+        RAM (perform_everything_on_gpu=False or not enough GPU memory). In that case a background thread extracts and
+        pins the next tiles while the GPU computes and another thread accumulates the results (which are copied back
+        asynchronously) into the predicted logits. This hides most of the transfer time. Off by default
+
+        accumulate_on_disk: if True, predicted_logits and n_predictions are not allocated in (GPU) memory but as memory
+        mapped files in accumulate_on_disk_folder (None = system temp dir, make sure that this is a fast local disk!).
+        Use this if your images are so large that not even the CPU RAM can hold the logits. The logits are handed to
+        the export workers as a file so they are never materialized in the main process
+
+        share_tiles_across_folds: if True and we predict with more than one fold, all fold networks are held in
+        (GPU) memory at the same time and every tile is predicted by all of them before we move on. Tiles are then
+        only extracted, transferred and Gaussian weighted once per case (instead of once per fold per case) and we
+        no longer need to load_state_dict for each fold and case. Needs more GPU memory (one network per fold)
+
+        micro_batch_cases: if > 1, predict_from_data_iterator collects up to this many cases and predicts their tiles
+        together, so tiles of different cases share forward passes. Each case keeps its own predicted_logits, results
+        are scattered back to the case they came from. Only makes sense for many small cases (2D slices, small crops)
+        where a single case does not have enough tiles to fill a batch. A group is predicted as soon as it is full or
+        the first case in it waited for micro_batch_max_latency seconds, whichever comes first. Works with
+        perform_everything_on_gpu=False as well (logits of the group in CPU RAM). Not used together with
+        coarse_to_fine and accumulate_on_disk (cases are then predicted one by one, without waiting for a group)
+        """
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -54,6 +119,30 @@ class nnUNetPredictor(object):
         self.tile_step_size = tile_step_size
         self.use_gaussian = use_gaussian
         self.use_mirroring = use_mirroring
+        assert tile_batch_size is None or tile_batch_size >= 1, 'tile_batch_size must be None (auto) or >= 1'
+        self.tile_batch_size = tile_batch_size
+        self.batched_mirroring = batched_mirroring
+        self.skip_empty_tiles = skip_empty_tiles
+        self.empty_tile_threshold = empty_tile_threshold
+        self.num_skipped_tiles = 0
+        # filled by predict_from_data_iterator, see ExportBackpressure.get_metrics
+        self.export_metrics = None
+        assert 0 < coarse_tile_step_size <= 1, 'coarse_tile_step_size must be larger than 0 and smaller or equal to 1'
+        self.coarse_to_fine = coarse_to_fine
+        self.coarse_tile_step_size = coarse_tile_step_size
+        self.roi_margin = roi_margin
+        self.pipeline_tiles = pipeline_tiles
+        self.accumulate_on_disk = accumulate_on_disk
+        self.accumulate_on_disk_folder = accumulate_on_disk_folder
+        # data_ptr -> weakref.finalize of the memmap files that back predicted_logits, see
+        # _internal_create_memmap_tensor
+        self._accumulator_files = {}
+        self.share_tiles_across_folds = share_tiles_across_folds
+        assert micro_batch_cases >= 1, 'micro_batch_cases must be >= 1'
+        self.micro_batch_cases = micro_batch_cases
+        self.micro_batch_max_latency = micro_batch_max_latency
+        self._fold_networks = None
+        self._active_fold_networks = None
         if device.type == 'cuda':
             # device = torch.device(type='cuda', index=0)  # set the desired GPU with CUDA_VISIBLE_DEVICES!
             # why would I ever want to do that. Stupid dobby. This kills DDP inference...
@@ -104,6 +193,7 @@ class nnUNetPredictor(object):
         self.configuration_manager = configuration_manager
         self.list_of_parameters = parameters
         self.network = network
+        self._fold_networks = None
         self.dataset_json = dataset_json
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
@@ -124,6 +214,7 @@ class nnUNetPredictor(object):
         self.configuration_manager = configuration_manager
         self.list_of_parameters = parameters
         self.network = network
+        self._fold_networks = None
         self.dataset_json = dataset_json
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
@@ -256,7 +347,9 @@ class nnUNetPredictor(object):
         return preprocessing_iterator_fromfiles(input_list_of_lists, seg_from_prev_stage_files,
                                                 output_filenames_truncated, self.plans_manager, self.dataset_json,
                                                 self.configuration_manager, num_processes, self.device.type == 'cuda',
-                                                self.verbose_preprocessing)
+                                                self.verbose_preprocessing,
+                                                # results are returned as a list -> order matters
+                                                in_order=output_filenames_truncated is None)
         # preprocessor = self.configuration_manager.preprocessor_class(verbose=self.verbose_preprocessing)
         # # hijack batchgenerators, yo
         # # we use the multiprocessing of the batchgenerators dataloader to handle all the background worker stuff. This
@@ -305,7 +398,8 @@ class nnUNetPredictor(object):
             self.configuration_manager,
             num_processes,
             self.device.type == 'cuda',
-            self.verbose_preprocessing
+            self.verbose_preprocessing,
+            in_order=truncated_ofname is None
         )
 
         return pp
@@ -336,10 +430,13 @@ class nnUNetPredictor(object):
         each element returned by data_iterator must be a dict with 'data', 'ofile' and 'data_properites' keys!
         If 'ofile' is None, the result will be returned instead of written to a file
         """
+        # coarse_to_fine and accumulate_on_disk predict cases one by one, no point in waiting for a group
+        micro_batching = self.micro_batch_cases > 1 and not self.coarse_to_fine and not self.accumulate_on_disk
         with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
-            worker_list = [i for i in export_pool._pool]
-            r = []
-            for preprocessed in data_iterator:
+            backpressure = ExportBackpressure(export_pool)
+            case_iterator = self._internal_micro_batch_iterator(data_iterator, backpressure) if micro_batching \
+                else data_iterator
+            for preprocessed in case_iterator:
                 data = preprocessed['data']
                 if isinstance(data, str):
                     delfile = data
@@ -358,46 +455,57 @@ class nnUNetPredictor(object):
 
                 # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
                 # npy files
-                proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-                while not proceed:
-                    # print('sleeping')
-                    sleep(0.1)
-                    proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
+                backpressure.wait()
 
-                prediction = self.predict_logits_from_preprocessed_data(data).cpu()
+                if 'predicted_logits' in preprocessed:
+                    # already predicted together with other cases, see _internal_micro_batch_iterator
+                    prediction = preprocessed['predicted_logits']
+                else:
+                    prediction = self._internal_logits_to_cpu(self._internal_predict_logits_with_fallback(data), True)
+                if self.accumulate_on_disk:
+                    # don't send hundreds of GB through a pipe. The export worker will map the file
+                    prediction = self._internal_save_logits_for_export(prediction)
+                nbytes = prediction.element_size() * prediction.nelement() if isinstance(prediction, torch.Tensor) \
+                    else None
 
-                if ofile is not None:
-                    # this needs to go into background processes
-                    # export_prediction_from_logits(prediction, properties, configuration_manager, plans_manager,
-                    #                               dataset_json, ofile, save_probabilities)
-                    print('sending off prediction to background worker for resampling and export')
-                    r.append(
-                        export_pool.starmap_async(
+                try:
+                    if ofile is not None:
+                        # this needs to go into background processes
+                        # export_prediction_from_logits(prediction, properties, configuration_manager, plans_manager,
+                        #                               dataset_json, ofile, save_probabilities)
+                        print('sending off prediction to background worker for resampling and export')
+                        backpressure.submit(
                             export_prediction_from_logits,
-                            ((prediction, properties, self.configuration_manager, self.plans_manager,
-                              self.dataset_json, ofile, save_probabilities),)
+                            (prediction, properties, self.configuration_manager, self.plans_manager,
+                             self.dataset_json, ofile, save_probabilities),
+                            nbytes
                         )
-                    )
-                else:
-                    # convert_predicted_logits_to_segmentation_with_correct_shape(prediction, plans_manager,
-                    #                                                             configuration_manager, label_manager,
-                    #                                                             properties,
-                    #                                                             save_probabilities)
-                    print('sending off prediction to background worker for resampling')
-                    r.append(
-                        export_pool.starmap_async(
-                            convert_predicted_logits_to_segmentation_with_correct_shape, (
-                                (prediction, self.plans_manager,
-                                 self.configuration_manager, self.label_manager,
-                                 properties,
-                                 save_probabilities),)
+                    else:
+                        # convert_predicted_logits_to_segmentation_with_correct_shape(prediction, plans_manager,
+                        #                                                             configuration_manager,
+                        #                                                             label_manager, properties,
+                        #                                                             save_probabilities)
+                        print('sending off prediction to background worker for resampling')
+                        backpressure.submit(
+                            convert_predicted_logits_to_segmentation_with_correct_shape,
+                            (prediction, self.plans_manager,
+                             self.configuration_manager, self.label_manager,
+                             properties,
+                             save_probabilities),
+                            nbytes
                         )
-                    )
+                except BaseException:
+                    # the export worker never got the file, so it won't delete it
+                    if isinstance(prediction, str):
+                        self._internal_remove_file(prediction)
+                    raise
                 if ofile is not None:
                     print(f'done with {os.path.basename(ofile)}')
                 else:
                     print(f'\nDone with image of shape {data.shape}:')
-            ret = [i.get()[0] for i in r]
+            ret = backpressure.get_results()
+            self.export_metrics = backpressure.get_metrics()
+            print(backpressure.get_summary())
 
         if isinstance(data_iterator, MultiThreadedAugmenter):
             data_iterator._finish()
@@ -408,6 +516,175 @@ class nnUNetPredictor(object):
         empty_cache(self.device)
         return ret
 
+    def _internal_micro_batch_iterator(self, data_iterator, backpressure: ExportBackpressure = None):
+        """
+        Wraps data_iterator (see micro_batch_cases in __init__). A background thread pulls cases from data_iterator
+        while we predict. Cases are grouped until we have micro_batch_cases of them or the first one waited for
+        micro_batch_max_latency seconds. Each group is predicted with _internal_predict_logits_case_group. Yields the
+        dicts of data_iterator (in their original order) with an additional 'predicted_logits' key.
+        backpressure: if given, we wait for the exports to catch up before predicting a group. Otherwise the logits of
+        whole groups would pile up in RAM while the exports lag behind
+        """
+        case_queue = queue.Queue(maxsize=self.micro_batch_cases)
+        end_of_data = object()
+        errors = []
+
+        def pull():
+            try:
+                for preprocessed in data_iterator:
+                    case_queue.put(preprocessed)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                case_queue.put(end_of_data)
+
+        threading.Thread(target=pull, daemon=True).start()
+        finished = False
+        while not finished:
+            item = case_queue.get()
+            if item is end_of_data:
+                break
+            group = [item]
+            deadline = time() + self.micro_batch_max_latency
+            while len(group) < self.micro_batch_cases:
+                try:
+                    item = case_queue.get(timeout=max(0., deadline - time()))
+                except queue.Empty:
+                    break
+                if item is end_of_data:
+                    finished = True
+                    break
+                group.append(item)
+
+            for preprocessed in group:
+                if isinstance(preprocessed['data'], str):
+                    delfile = preprocessed['data']
+                    preprocessed['data'] = torch.from_numpy(np.load(delfile))
+                    os.remove(delfile)
+            if backpressure is not None:
+                backpressure.wait()
+            if self.verbose: print(f'micro batching: predicting {len(group)} cases together')
+            predictions = self._internal_predict_logits_case_group([p['data'] for p in group], to_shared_memory=True)
+            for preprocessed, prediction in zip(group, predictions):
+                preprocessed['predicted_logits'] = prediction
+                yield preprocessed
+        if len(errors) > 0:
+            raise errors[0]
+
+    def _internal_predict_logits_case_group(self, list_of_data: List[torch.Tensor],
+                                            to_shared_memory: bool = False) -> List[torch.Tensor]:
+        """
+        Same as calling predict_logits_from_preprocessed_data for each element of list_of_data, but the sliding window
+        tiles of all cases are pooled so that they can share forward passes. Returned logits are on the CPU (see
+        _internal_logits_to_cpu for to_shared_memory).
+        Like predict_logits_from_preprocessed_data, the logits are kept on the GPU if perform_everything_on_gpu and
+        moved to CPU RAM if that fails. coarse_to_fine and accumulate_on_disk don't support pooling, the cases are
+        then predicted one by one (predict_from_data_iterator does not group cases in that case)
+        """
+        if len(list_of_data) == 1 or self.coarse_to_fine or self.accumulate_on_disk:
+            return [self._internal_logits_to_cpu(self._internal_predict_logits_with_fallback(d), to_shared_memory)
+                    for d in list_of_data]
+        with torch.no_grad():
+            predictions = None
+            if self.perform_everything_on_gpu:
+                try:
+                    predictions = self._internal_predict_case_group_all_folds(list_of_data, self.device)
+                except RuntimeError:
+                    print('Predicting multiple cases together with perform_everything_on_gpu=True failed due to '
+                          'insufficient GPU memory. Keeping their logits in CPU RAM instead')
+                    print('Error:')
+                    traceback.print_exc()
+                    predictions = None
+                    empty_cache(self.device)
+            if predictions is None:
+                predictions = self._internal_predict_case_group_all_folds(list_of_data, torch.device('cpu'))
+            return [self._internal_logits_to_cpu(p, to_shared_memory) for p in predictions]
+
+    def _internal_predict_case_group_all_folds(self, list_of_data: List[torch.Tensor], results_device: torch.device) \
+            -> List[torch.Tensor]:
+        """
+        _internal_predict_case_group_sliding_window with all folds in self.list_of_parameters, averaged. See
+        _internal_predict_logits_all_folds
+        """
+        if self.share_tiles_across_folds and len(self.list_of_parameters) > 1:
+            self._active_fold_networks = self._internal_get_fold_networks()
+            try:
+                return self._internal_predict_case_group_sliding_window(list_of_data, results_device)
+            finally:
+                self._active_fold_networks = None
+
+        predictions = None
+        for params in self.list_of_parameters:
+            if not isinstance(self.network, OptimizedModule):
+                self.network.load_state_dict(params)
+            else:
+                self.network._orig_mod.load_state_dict(params)
+            fold_predictions = self._internal_predict_case_group_sliding_window(list_of_data, results_device)
+            if predictions is None:
+                predictions = fold_predictions
+            else:
+                for p, f in zip(predictions, fold_predictions):
+                    p += f
+        if len(self.list_of_parameters) > 1:
+            for p in predictions:
+                p /= len(self.list_of_parameters)
+        return predictions
+
+    def _internal_predict_case_group_sliding_window(self, list_of_data: List[torch.Tensor],
+                                                     results_device: torch.device) -> List[torch.Tensor]:
+        """
+        sliding window prediction of several cases with the current self.network (or all fold networks if
+        self._active_fold_networks is set). The images and predicted logits live on results_device, tiles are moved
+        to self.device for prediction. Tiles of all cases go into one list and are batched together. Each prediction
+        is accumulated into the predicted_logits of the case it came from
+        """
+        self.network = self.network.to(self.device)
+        self.network.eval()
+        empty_cache(self.device)
+
+        with torch.no_grad():
+            with torch.autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+                gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
+                                            value_scaling_factor=1000, device=results_device) \
+                    if self.use_gaussian else None
+
+                datas, slicers_revert_padding, predicted_logits, n_predictions, tiles = [], [], [], [], []
+                self.num_skipped_tiles = 0
+                for i, input_image in enumerate(list_of_data):
+                    assert len(input_image.shape) == 4, 'input_image must be a 4D np.ndarray or torch.Tensor (c, x, y, z)'
+                    data, slicer_revert_padding = pad_nd_image(input_image, self.configuration_manager.patch_size,
+                                                               'constant', {'value': 0}, True, None)
+                    data = data.to(results_device)
+                    pl, npred = self._internal_allocate_results(data.shape[1:], results_device)
+                    slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+                    if self.skip_empty_tiles:
+                        slicers, num_skipped = self._internal_skip_empty_tiles(data, slicers, pl, npred, gaussian)
+                        self.num_skipped_tiles += num_skipped
+                    datas.append(data)
+                    slicers_revert_padding.append(slicer_revert_padding)
+                    predicted_logits.append(pl)
+                    n_predictions.append(npred)
+                    tiles += [(i, sl) for sl in slicers]
+
+                max_forward_batch_size = self._internal_estimate_max_forward_batch_size()
+                tile_batch_size = self._internal_get_tile_batch_size(len(tiles), max_forward_batch_size)
+                if self.verbose: print(f'predicting {len(tiles)} tiles of {len(list_of_data)} cases with '
+                                       f'tile_batch_size {tile_batch_size}')
+                for batch_start in tqdm(range(0, len(tiles), tile_batch_size), disable=not self.allow_tqdm):
+                    batch_tiles = tiles[batch_start:batch_start + tile_batch_size]
+                    workon = torch.stack([datas[i][sl] for i, sl in batch_tiles]).to(self.device, non_blocking=False)
+                    prediction = self._internal_predict_tile_batch(workon, max_forward_batch_size).to(results_device)
+                    for p, (i, sl) in zip(prediction, batch_tiles):
+                        self._internal_accumulate_predictions(predicted_logits[i], n_predictions[i], p, sl, gaussian)
+                    del prediction, workon
+
+                results = []
+                for pl, npred, slicer_revert_padding in zip(predicted_logits, n_predictions, slicers_revert_padding):
+                    pl /= npred
+                    results.append(pl[tuple([slice(None), *slicer_revert_padding[1:]])])
+        empty_cache(self.device)
+        return results
+
     def predict_single_npy_array(self, input_image: np.ndarray, image_properties: dict,
                                  segmentation_previous_stage: np.ndarray = None,
                                  output_file_truncated: str = None,
@@ -453,7 +730,16 @@ class nnUNetPredictor(object):
         RETURNED LOGITS HAVE THE SHAPE OF THE INPUT. THEY MUST BE CONVERTED BACK TO THE ORIGINAL IMAGE SIZE.
         SEE convert_predicted_logits_to_segmentation_with_correct_shape
         """
-        # we have some code duplication here but this allows us to run with perform_everything_on_gpu=True as
+        prediction = self._internal_predict_logits_with_fallback(data)
+        print('Prediction done, transferring to CPU if needed')
+        return prediction.to('cpu')
+
+    def _internal_predict_logits_with_fallback(self, data: torch.Tensor) -> torch.Tensor:
+        """
+        predict_logits_from_preprocessed_data without the final transfer to the CPU. The logits stay where they were
+        accumulated (self.device or CPU), see _internal_logits_to_cpu
+        """
+        # the try/except allows us to run with perform_everything_on_gpu=True as
         # default and not have the entire program crash in case of GPU out of memory. Neat. That should make
         # things a lot faster for some datasets.
         original_perform_everything_on_gpu = self.perform_everything_on_gpu
@@ -461,22 +747,7 @@ class nnUNetPredictor(object):
             prediction = None
             if self.perform_everything_on_gpu:
                 try:
-                    for params in self.list_of_parameters:
-
-                        # messing with state dict names...
-                        if not isinstance(self.network, OptimizedModule):
-                            self.network.load_state_dict(params)
-                        else:
-                            self.network._orig_mod.load_state_dict(params)
-
-                        if prediction is None:
-                            prediction = self.predict_sliding_window_return_logits(data)
-                        else:
-                            prediction += self.predict_sliding_window_return_logits(data)
-
-                    if len(self.list_of_parameters) > 1:
-                        prediction /= len(self.list_of_parameters)
-
+                    prediction = self._internal_predict_logits_all_folds(data)
                 except RuntimeError:
                     print('Prediction with perform_everything_on_gpu=True failed due to insufficient GPU memory. '
                           'Falling back to perform_everything_on_gpu=False. Not a big deal, just slower...')
@@ -486,23 +757,90 @@ class nnUNetPredictor(object):
                     self.perform_everything_on_gpu = False
 
             if prediction is None:
-                for params in self.list_of_parameters:
-                    # messing with state dict names...
-                    if not isinstance(self.network, OptimizedModule):
-                        self.network.load_state_dict(params)
-                    else:
-                        self.network._orig_mod.load_state_dict(params)
+                prediction = self._internal_predict_logits_all_folds(data)
+            self.perform_everything_on_gpu = original_perform_everything_on_gpu
+        return prediction
 
-                    if prediction is None:
-                        prediction = self.predict_sliding_window_return_logits(data)
-                    else:
-                        prediction += self.predict_sliding_window_return_logits(data)
-                if len(self.list_of_parameters) > 1:
-                    prediction /= len(self.list_of_parameters)
+    def _internal_logits_to_cpu(self, logits: torch.Tensor, to_shared_memory: bool) -> torch.Tensor:
+        """
+        to_shared_memory: the logits are going to be handed to the export workers, so put them into shared memory
+        (see _internal_move_to_shared_memory). Otherwise, and always with accumulate_on_disk (the logits are a memory
+        mapped file then), plain CPU memory. /dev/shm can be small (docker!), only use it when we have to
+        """
+        if to_shared_memory and not self.accumulate_on_disk:
+            return self._internal_move_to_shared_memory(logits)
+        return logits.to('cpu')
 
-            print('Prediction done, transferring to CPU if needed')
-            prediction = prediction.to('cpu')
-            self.perform_everything_on_gpu = original_perform_everything_on_gpu
+    def _internal_predict_logits_all_folds(self, data: torch.Tensor) -> torch.Tensor:
+        """
+        Predicts data with all folds in self.list_of_parameters and averages the results.
+        If share_tiles_across_folds is set we run the sliding window only once and every tile is predicted by all
+        folds before we move on to the next one
+        """
+        if self.share_tiles_across_folds and len(self.list_of_parameters) > 1:
+            self._active_fold_networks = self._internal_get_fold_networks()
+            try:
+                return self.predict_sliding_window_return_logits(data)
+            finally:
+                self._active_fold_networks = None
+
+        prediction = None
+        for params in self.list_of_parameters:
+            # messing with state dict names...
+            if not isinstance(self.network, OptimizedModule):
+                self.network.load_state_dict(params)
+            else:
+                self.network._orig_mod.load_state_dict(params)
+
+            if prediction is None:
+                prediction = self.predict_sliding_window_return_logits(data)
+            else:
+                prediction += self.predict_sliding_window_return_logits(data)
+
+        if len(self.list_of_parameters) > 1:
+            prediction /= len(self.list_of_parameters)
+        return prediction
+
+    def _internal_get_fold_networks(self) -> List[nn.Module]:
+        """
+        one network instance per fold, all on self.device. Created once and then reused for all cases so we don't
+        have to load_state_dict over and over again
+        """
+        if self._fold_networks is None:
+            compiled = isinstance(self.network, OptimizedModule)
+            base_network = self.network._orig_mod if compiled else self.network
+            fold_networks = []
+            for params in self.list_of_parameters:
+                network = deepcopy(base_network)
+                network.load_state_dict(params)
+                network = network.to(self.device)
+                network.eval()
+                if compiled:
+                    network = torch.compile(network)
+                fold_networks.append(network)
+            self._fold_networks = fold_networks
+        return self._fold_networks
+
+    def _internal_predict_tile_batch(self, x: torch.Tensor, max_forward_batch_size: int = None) -> torch.Tensor:
+        """
+        Predicts a batch of tiles with self.network or, if we are sharing tiles across folds, with all fold networks
+        (and all mirrorings for each of them) and returns the average
+        """
+        if self._active_fold_networks is None:
+            return self._internal_maybe_mirror_and_predict(x, max_forward_batch_size)
+
+        original_network = self.network
+        prediction = None
+        try:
+            for network in self._active_fold_networks:
+                self.network = network
+                if prediction is None:
+                    prediction = self._internal_maybe_mirror_and_predict(x, max_forward_batch_size)
+                else:
+                    prediction += self._internal_maybe_mirror_and_predict(x, max_forward_batch_size)
+        finally:
+            self.network = original_network
+        prediction /= len(self._active_fold_networks)
         return prediction
 
     def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...]):
@@ -539,15 +877,91 @@ class nnUNetPredictor(object):
                                                   zip((sx, sy, sz), self.configuration_manager.patch_size)]]))
         return slicers
 
-    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor) -> torch.Tensor:
+    def _internal_tile_is_empty(self, tile: torch.Tensor) -> bool:
+        """
+        tile has shape (c, x, y(, z)). See skip_empty_tiles in __init__
+        """
+        if self.empty_tile_threshold is not None:
+            return bool(torch.all(tile <= self.empty_tile_threshold))
+        # zero padding and the region outside the nonzero mask (use_mask_for_norm) are exactly 0
+        return bool(torch.all(tile == 0))
+
+    def _internal_skip_empty_tiles(self, data: torch.Tensor, slicers: List[Tuple[slice, ...]],
+                                   predicted_logits: torch.Tensor, n_predictions: torch.Tensor,
+                                   gaussian: Union[torch.Tensor, None]) -> Tuple[List[Tuple[slice, ...]], int]:
+        """
+        fills the empty tiles (see _internal_tile_is_empty) with background logits. Returns the slicers that still
+        need to be predicted and the number of skipped tiles
+        """
+        is_empty = [self._internal_tile_is_empty(data[sl]) for sl in slicers]
+        skipped_slicers = [sl for sl, e in zip(slicers, is_empty) if e]
+        slicers = [sl for sl, e in zip(slicers, is_empty) if not e]
+        if self.verbose: print(f'skipping {len(skipped_slicers)} out of {len(skipped_slicers) + len(slicers)} tiles '
+                               f'because they are empty')
+        # these tiles are background. Period.
+        background = self.label_manager.get_background_logits(predicted_logits.dtype, predicted_logits.device)
+        background = background.view(-1, *[1] * len(self.configuration_manager.patch_size))
+        for sl in skipped_slicers:
+            self._internal_accumulate_predictions(predicted_logits, n_predictions, background, sl, gaussian)
+        return slicers, len(skipped_slicers)
+
+    def _internal_estimate_max_forward_batch_size(self) -> int:
+        """
+        Estimates how many samples (tiles or mirrored variants of tiles) fit into one forward pass given the memory
+        that is currently available on self.device. Must be called AFTER predicted_logits etc have been allocated so
+        that these are accounted for.
+
+        The estimate is deliberately conservative: we assume the activations of one sample take
+        patch_voxels * UNet_base_num_features * 4 bytes * 8 (several feature maps at full resolution are alive at the
+        same time: skip connection, current conv output, decoder input). We then only use half of what is available.
+        """
+        bytes_per_sample = np.prod(self.configuration_manager.patch_size, dtype=np.int64) * \
+                           self.configuration_manager.UNet_base_num_features * 4 * 8
+        return max(1, int(get_available_memory(self.device) * 0.5 // bytes_per_sample))
+
+    def _internal_get_tile_batch_size(self, num_tiles: int, max_forward_batch_size: int) -> int:
+        """
+        If the user did not specify tile_batch_size we use as many tiles as fit into max_forward_batch_size. With
+        batched mirroring each tile occupies one slot per mirroring combination.
+        """
+        if self.tile_batch_size is not None:
+            return max(1, min(self.tile_batch_size, num_tiles))
+        tile_batch_size = max_forward_batch_size
+        if self.batched_mirroring:
+            tile_batch_size //= len(self._internal_get_mirror_flip_axes())
+        tile_batch_size = max(1, min(tile_batch_size, num_tiles))
+        if self.verbose: print(f'automatically determined tile_batch_size: {tile_batch_size}')
+        return tile_batch_size
+
+    def _internal_get_mirror_flip_axes(self) -> List[Tuple[int, ...]]:
+        """
+        returns the tensor dimensions that need to be flipped for each mirroring combination. The first entry is
+        always () (= no mirroring). Order is the same as it always was: no mirroring, single axes, pairs, all three
+        """
         mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
-        prediction = self.network(x)
+        if mirror_axes is None:
+            return [()]
+        # x is 5d for 3d images and 4d for 2d, so mirror_axes are offset by 2 (batch and channel dimension)
+        axes = [m + 2 for m in sorted(mirror_axes)]
+        return [()] + [c for i in range(1, len(axes) + 1) for c in itertools.combinations(axes, i)]
 
+    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor, max_forward_batch_size: int = None) -> torch.Tensor:
+        """
+        max_forward_batch_size is only used for batched mirroring. It caps the number of samples that go into one
+        forward pass. None means everything is predicted in a single forward pass
+        """
+        mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
         if mirror_axes is not None:
             # check for invalid numbers in mirror_axes
             # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
             assert max(mirror_axes) <= len(x.shape) - 3, 'mirror_axes does not match the dimension of the input!'
 
+        if mirror_axes is not None and self.batched_mirroring:
+            return self._internal_predict_mirrored_batched(x, max_forward_batch_size)
+
+        prediction = self.network(x)
+
+        if mirror_axes is not None:
             num_predictons = 2 ** len(mirror_axes)
             if 0 in mirror_axes:
                 prediction += torch.flip(self.network(torch.flip(x, (2,))), (2,))
@@ -566,8 +980,285 @@ class nnUNetPredictor(object):
             prediction /= num_predictons
         return prediction
 
+    def _internal_predict_mirrored_batched(self, x: torch.Tensor, max_forward_batch_size: int = None) -> torch.Tensor:
+        """
+        Concatenates all mirrored variants of x along the batch dimension and predicts them in chunks of at most
+        max_forward_batch_size samples. Results are flipped back and averaged in the same order as the sequential
+        implementation in _internal_maybe_mirror_and_predict
+        """
+        flip_axes = self._internal_get_mirror_flip_axes()
+        b = x.shape[0]
+        variants = torch.cat([x if len(a) == 0 else torch.flip(x, a) for a in flip_axes])
+        if max_forward_batch_size is None:
+            max_forward_batch_size = variants.shape[0]
+        predictions = torch.cat([self.network(variants[i:i + max_forward_batch_size])
+                                 for i in range(0, variants.shape[0], max_forward_batch_size)])
+        del variants
+
+        prediction = predictions[:b]
+        for k, a in enumerate(flip_axes[1:], start=1):
+            prediction += torch.flip(predictions[k * b:(k + 1) * b], a)
+        prediction /= len(flip_axes)
+        return prediction
+
     def predict_sliding_window_return_logits(self, input_image: torch.Tensor) \
             -> Union[np.ndarray, torch.Tensor]:
+        if not self.coarse_to_fine:
+            return self._internal_predict_sliding_window_return_logits(input_image)
+
+        # coarse pass. Cheap settings, whole image
+        original_tile_step_size, original_use_mirroring = self.tile_step_size, self.use_mirroring
+        self.tile_step_size, self.use_mirroring = self.coarse_tile_step_size, False
+        try:
+            if self.verbose: print('coarse_to_fine: running coarse prediction')
+            predicted_logits = self._internal_predict_sliding_window_return_logits(input_image)
+        finally:
+            self.tile_step_size, self.use_mirroring = original_tile_step_size, original_use_mirroring
+
+        roi_slicer = self._internal_get_roi_from_coarse_logits(predicted_logits)
+        if roi_slicer is None:
+            if self.verbose: print('coarse_to_fine: no foreground predicted in coarse pass, skipping fine prediction')
+            return predicted_logits
+        if self.verbose: print(f'coarse_to_fine: refining region of interest {roi_slicer[1:]} of image with shape '
+                               f'{tuple(input_image.shape[1:])}')
+
+        # fine pass. Full quality, only the ROI
+        predicted_logits[roi_slicer] = self._internal_predict_sliding_window_return_logits(
+            input_image[roi_slicer]).to(predicted_logits.device)
+        return predicted_logits
+
+    def _internal_get_roi_from_coarse_logits(self, predicted_logits: torch.Tensor) -> Union[None, Tuple[slice, ...]]:
+        """
+        returns a slicer (including the channel dimension) of the bounding box of the predicted foreground enlarged by
+        roi_margin. None if there is no foreground
+        """
+        with torch.no_grad():
+            foreground = (self.label_manager.convert_logits_to_segmentation(predicted_logits) != 0).to(torch.uint8)
+        if not torch.any(foreground):
+            return None
+        image_size = foreground.shape
+        # 2d configurations: no margin along the slice axis, each slice is predicted independently
+        patch_size = [1] * (len(image_size) - len(self.configuration_manager.patch_size)) + \
+                     list(self.configuration_manager.patch_size)
+        margin = [0] * (len(image_size) - len(self.configuration_manager.patch_size)) + \
+                 [int(round(p * self.roi_margin)) for p in self.configuration_manager.patch_size]
+        slicer = [slice(None)]
+        for d in range(len(image_size)):
+            other_axes = tuple([i for i in range(len(image_size)) if i != d])
+            fg_along_d = torch.where(foreground.amax(dim=other_axes) > 0)[0]
+            lb = max(0, int(fg_along_d[0]) - margin[d])
+            ub = min(image_size[d], int(fg_along_d[-1]) + 1 + margin[d])
+            # ROI should be at least as large as the patch size (if possible), otherwise we just waste compute on
+            # padding
+            if ub - lb < patch_size[d]:
+                lb = max(0, min(lb, image_size[d] - patch_size[d]))
+                ub = min(image_size[d], lb + patch_size[d])
+            slicer.append(slice(lb, ub))
+        return tuple(slicer)
+
+    def _internal_allocate_results(self, image_size: Tuple[int, ...], results_device: torch.device) \
+            -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        returns zero initialized predicted_logits (num_segmentation_heads, *image_size) and n_predictions (image_size)
+        """
+        if self.accumulate_on_disk:
+            return self._internal_create_memmap_tensor((self.label_manager.num_segmentation_heads, *image_size),
+                                                       keep_file=True), \
+                self._internal_create_memmap_tensor(image_size)
+        # plain memory, also on the CPU. Only logits that go to the export workers need to be in shared memory
+        # (/dev/shm, which can be small, for example in docker), see _internal_logits_to_cpu
+        predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *image_size), dtype=torch.half,
+                                       device=results_device)
+        n_predictions = torch.zeros(image_size, dtype=torch.half, device=results_device)
+        return predicted_logits, n_predictions
+
+    @staticmethod
+    def _internal_move_to_shared_memory(logits: torch.Tensor) -> torch.Tensor:
+        """
+        Predicted logits are handed to the export workers through a pipe. For tensors in shared memory torch only
+        sends a handle that the worker maps (zero copy). Any other tensor is first copied into shared memory by the
+        pickler, so for a moment we hold it twice. This makes sure the logits are in shared memory to begin with: GPU
+        tensors are copied straight into a shared buffer, CPU tensors that are already shared are returned as is
+        """
+        if logits.device.type == 'cpu' and logits.is_shared():
+            return logits
+        shared = torch.empty(logits.shape, dtype=logits.dtype).share_memory_()
+        shared.copy_(logits)
+        return shared
+
+    def _internal_create_memmap_tensor(self, shape: Tuple[int, ...], keep_file: bool = False) -> torch.Tensor:
+        """
+        zero initialized float16 tensor backed by a memory mapped file in accumulate_on_disk_folder. Unless keep_file
+        is set, the file is unlinked right away. The mapping stays valid until the tensor is garbage collected, at which point the OS frees
+        the disk space. No need to clean up after ourselves (except on Windows, where the file stays around)
+
+        keep_file: the file is only removed once the tensor is garbage collected (weakref.finalize). Until then
+        _internal_save_logits_for_export can hand it to the export workers instead of copying it
+        """
+        fd, fname = tempfile.mkstemp(suffix='.npy', dir=self.accumulate_on_disk_folder)
+        os.close(fd)
+        arr = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float16, shape=tuple(shape))
+        tensor = torch.from_numpy(arr)
+        if keep_file:
+            self._accumulator_files = {k: v for k, v in self._accumulator_files.items() if v.alive}
+            self._accumulator_files[tensor.data_ptr()] = weakref.finalize(arr, self._internal_remove_file, fname)
+        else:
+            self._internal_remove_file(fname)
+        return tensor
+
+    @staticmethod
+    def _internal_remove_file(fname: str) -> None:
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+    def _internal_save_logits_for_export(self, logits: torch.Tensor) -> str:
+        """
+        Returns the name of a .npy file with the logits. The export functions (see
+        convert_predicted_logits_to_segmentation_with_correct_shape) load this file as a memory map and delete it once
+        they are done.
+        If logits are an entire accumulator of _internal_allocate_results (no padding was removed) we hand over its
+        file. Otherwise they are written to a new file, one channel at a time
+        """
+        key = logits.untyped_storage().data_ptr()
+        finalizer = self._accumulator_files.pop(key, None)
+        if finalizer is not None and finalizer.alive and logits.is_contiguous() and logits.data_ptr() == key and \
+                logits.dtype == torch.float16 and \
+                logits.nelement() * logits.element_size() == logits.untyped_storage().nbytes():
+            arr, _, (fname, ), _ = finalizer.peek()
+            arr.flush()
+            # the export worker deletes it now
+            finalizer.detach()
+            return fname
+
+        fd, fname = tempfile.mkstemp(suffix='.npy', dir=self.accumulate_on_disk_folder)
+        os.close(fd)
+        try:
+            out = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float16, shape=tuple(logits.shape))
+            for c in range(logits.shape[0]):
+                out[c] = logits[c].numpy()
+            out.flush()
+            del out
+        except BaseException:
+            self._internal_remove_file(fname)
+            raise
+        return fname
+
+    def _internal_accumulate_predictions(self, predicted_logits: torch.Tensor, n_predictions: torch.Tensor,
+                                         prediction: torch.Tensor, slicer: Tuple[slice, ...],
+                                         gaussian: Union[torch.Tensor, None]) -> None:
+        """
+        adds the (gaussian weighted) prediction of one tile to predicted_logits and keeps track of the weights in
+        n_predictions
+        """
+        predicted_logits[slicer] += (prediction * gaussian if self.use_gaussian else prediction)
+        n_predictions[slicer[1:]] += (gaussian if self.use_gaussian else 1)
+
+    def _internal_run_sliding_window_pipelined(self, data: torch.Tensor, slicers: List[Tuple[slice, ...]],
+                                               tile_batch_size: int, max_forward_batch_size: int,
+                                               predicted_logits: torch.Tensor, n_predictions: torch.Tensor,
+                                               gaussian: Union[torch.Tensor, None]) -> None:
+        """
+        Does the same as the plain loop in _internal_predict_sliding_window_return_logits but:
+        - a producer thread stacks (and pins, if data is in CPU RAM) the next tile batches while the GPU computes
+        - predictions are copied back with non_blocking=True and a consumer thread accumulates them into
+        predicted_logits once the copy is done (cuda event)
+        The main thread only talks to the GPU. Queues are short so that we don't pile up tiles in (pinned) memory.
+        Errors in the background threads are re-raised in the main thread.
+        """
+        batch_starts = list(range(0, len(slicers), tile_batch_size))
+        tile_queue = queue.Queue(maxsize=2)
+        result_queue = queue.Queue(maxsize=2)
+        abort_event = threading.Event()
+        errors = []
+
+        def put(q: queue.Queue, item) -> bool:
+            while not abort_event.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q: queue.Queue, source: Union[threading.Thread, None]):
+            while True:
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    if len(errors) > 0:
+                        raise errors[0]
+                    if abort_event.is_set():
+                        return None
+                    if source is not None and not source.is_alive():
+                        # the source may have put its last item after our timeout and then exited
+                        try:
+                            return q.get_nowait()
+                        except queue.Empty:
+                            return None
+
+        def produce():
+            try:
+                pin_memory = data.device.type == 'cpu'
+                for batch_start in batch_starts:
+                    batch_slicers = slicers[batch_start:batch_start + tile_batch_size]
+                    workon = torch.stack([data[sl] for sl in batch_slicers])
+                    if pin_memory:
+                        workon = workon.pin_memory()
+                    if not put(tile_queue, (batch_slicers, workon)):
+                        return
+            except Exception as e:
+                errors.append(e)
+                abort_event.set()
+
+        def accumulate():
+            try:
+                while True:
+                    item = get(result_queue, None)
+                    if item is None:
+                        return
+                    batch_slicers, prediction, copy_done = item
+                    if copy_done is not None:
+                        copy_done.synchronize()
+                    for p, sl in zip(prediction, batch_slicers):
+                        self._internal_accumulate_predictions(predicted_logits, n_predictions, p, sl, gaussian)
+            except Exception as e:
+                errors.append(e)
+                abort_event.set()
+
+        producer = threading.Thread(target=produce, daemon=True)
+        accumulator = threading.Thread(target=accumulate, daemon=True)
+        producer.start()
+        accumulator.start()
+        try:
+            for _ in tqdm(batch_starts, disable=not self.allow_tqdm):
+                item = get(tile_queue, producer)
+                if item is None:
+                    raise RuntimeError('Tile producer thread stopped unexpectedly')
+                batch_slicers, workon = item
+                workon = workon.to(self.device, non_blocking=True)
+                prediction = self._internal_predict_tile_batch(workon, max_forward_batch_size)
+                del workon
+                copy_done = None
+                if prediction.device != predicted_logits.device:
+                    prediction = prediction.to(predicted_logits.device, non_blocking=True)
+                    copy_done = torch.cuda.Event()
+                    copy_done.record()
+                if not put(result_queue, (batch_slicers, prediction, copy_done)):
+                    break
+            # None tells the accumulator that we are done
+            put(result_queue, None)
+            accumulator.join()
+            if len(errors) > 0:
+                raise errors[0]
+        finally:
+            abort_event.set()
+            producer.join()
+            accumulator.join()
+
+    def _internal_predict_sliding_window_return_logits(self, input_image: torch.Tensor) \
+            -> Union[np.ndarray, torch.Tensor]:
         assert isinstance(input_image, torch.Tensor)
         self.network = self.network.to(self.device)
         self.network.eval()
@@ -594,17 +1285,16 @@ class nnUNetPredictor(object):
                                                            None)
 
                 slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+                gaussian = None
 
                 # preallocate results and num_predictions
-                results_device = self.device if self.perform_everything_on_gpu else torch.device('cpu')
+                results_device = self.device if (self.perform_everything_on_gpu and not self.accumulate_on_disk) \
+                    else torch.device('cpu')
                 if self.verbose: print('preallocating arrays')
                 try:
                     data = data.to(self.device)
-                    predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
-                                                   dtype=torch.half,
-                                                   device=results_device)
-                    n_predictions = torch.zeros(data.shape[1:], dtype=torch.half,
-                                                device=results_device)
+                    predicted_logits, n_predictions = self._internal_allocate_results(data.shape[1:],
+                                                                                      results_device)
                     if self.use_gaussian:
                         gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
                                                     value_scaling_factor=1000,
@@ -613,11 +1303,8 @@ class nnUNetPredictor(object):
                     # sometimes the stuff is too large for GPUs. In that case fall back to CPU
                     results_device = torch.device('cpu')
                     data = data.to(results_device)
-                    predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
-                                                   dtype=torch.half,
-                                                   device=results_device)
-                    n_predictions = torch.zeros(data.shape[1:], dtype=torch.half,
-                                                device=results_device)
+                    predicted_logits, n_predictions = self._internal_allocate_results(data.shape[1:],
+                                                                                      results_device)
                     if self.use_gaussian:
                         gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
                                                     value_scaling_factor=1000,
@@ -625,17 +1312,42 @@ class nnUNetPredictor(object):
                 finally:
                     empty_cache(self.device)
 
-                if self.verbose: print('running prediction')
-                for sl in tqdm(slicers, disable=not self.allow_tqdm):
-                    workon = data[sl][None]
-                    workon = workon.to(self.device, non_blocking=False)
-
-                    prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
-
-                    predicted_logits[sl] += (prediction * gaussian if self.use_gaussian else prediction)
-                    n_predictions[sl[1:]] += (gaussian if self.use_gaussian else 1)
-
-                predicted_logits /= n_predictions
+                self.num_skipped_tiles = 0
+                if self.skip_empty_tiles:
+                    slicers, self.num_skipped_tiles = self._internal_skip_empty_tiles(data, slicers, predicted_logits,
+                                                                                      n_predictions, gaussian)
+
+                max_forward_batch_size = self._internal_estimate_max_forward_batch_size()
+                tile_batch_size = self._internal_get_tile_batch_size(len(slicers), max_forward_batch_size)
+
+                if self.verbose: print(f'running prediction with tile_batch_size {tile_batch_size}')
+                if self.pipeline_tiles and self.device.type == 'cuda' and \
+                        (data.device.type == 'cpu' or results_device.type == 'cpu'):
+                    if self.verbose: print('using pipelined tile transfer')
+                    self._internal_run_sliding_window_pipelined(data, slicers, tile_batch_size,
+                                                                max_forward_batch_size, predicted_logits,
+                                                                n_predictions, gaussian)
+                else:
+                    for batch_start in tqdm(range(0, len(slicers), tile_batch_size), disable=not self.allow_tqdm):
+                        batch_slicers = slicers[batch_start:batch_start + tile_batch_size]
+                        # stack the tiles along the batch dimension so that the network sees them in one forward pass
+                        workon = torch.stack([data[sl] for sl in batch_slicers])
+                        workon = workon.to(self.device, non_blocking=False)
+
+                        prediction = self._internal_predict_tile_batch(workon, max_forward_batch_size).to(
+                            results_device)
+
+                        # scatter the results back to where they came from
+                        for p, sl in zip(prediction, batch_slicers):
+                            self._internal_accumulate_predictions(predicted_logits, n_predictions, p, sl, gaussian)
+                        del prediction, workon
+
+                if self.accumulate_on_disk:
+                    # one channel at a time so that we never need a full size temporary
+                    for c in range(predicted_logits.shape[0]):
+                        predicted_logits[c] /= n_predictions
+                else:
+                    predicted_logits /= n_predictions
         empty_cache(self.device)
         return predicted_logits[tuple([slice(None), *slicer_revert_padding[1:]])]
 
@@ -685,6 +1397,43 @@ def predict_entry_point_modelfolder():
                         help="Use this to set the device the inference should run with. Available options are 'cuda' "
                              "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2). Do NOT use this to set which GPU ID! "
                              "Use CUDA_VISIBLE_DEVICES=X nnUNetv2_predict [...] instead!")
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=None,
+                        help='Number of sliding window tiles that are predicted together in one forward pass. '
+                             'Default: determined automatically from the available (GPU) memory. Reduce this if you '
+                             'run into out of memory errors.')
+    parser.add_argument('--batched_mirroring', action='store_true', required=False, default=False,
+                        help='Set this flag to predict all mirrored variants of a tile (test time augmentation) '
+                             'together in one forward pass instead of one after the other. Same result, better '
+                             'hardware utilization but needs more memory.')
+    parser.add_argument('--pipeline_tiles', action='store_true', required=False, default=False,
+                        help='Set this flag to overlap tile transfers with prediction (background threads) when we '
+                             'predict on a GPU but the image or the predicted logits are in CPU RAM.')
+    parser.add_argument('--skip_empty_tiles', action='store_true', required=False, default=False,
+                        help='Set this flag to skip sliding window tiles that carry no information (input is 0 '
+                             'everywhere within the tile: zero padding or outside of the nonzero mask). They are '
+                             'filled with background instead. Faster, but the network does not see these regions.')
+    parser.add_argument('-empty_tile_threshold', type=float, required=False, default=None,
+                        help='Only used with --skip_empty_tiles. If set, tiles are considered empty if all their '
+                             'intensities (after normalization!) are smaller or equal to this value.')
+    parser.add_argument('--coarse_to_fine', action='store_true', required=False, default=False,
+                        help='Set this flag to first run a cheap prediction (step size 1, no mirroring) and then '
+                             'predict only the region around the detected foreground with the full settings. '
+                             'Faster for small structures in large images.')
+    parser.add_argument('--accumulate_on_disk', action='store_true', required=False, default=False,
+                        help='Set this flag to keep the predicted logits in memory mapped files (system temp dir, '
+                             'set TMPDIR to change it) instead of RAM. Use this if your images are so large that you '
+                             'run out of RAM. Slower.')
+    parser.add_argument('--share_tiles_across_folds', action='store_true', required=False, default=False,
+                        help='Set this flag to keep the networks of all folds in GPU memory and predict each sliding '
+                             'window tile with all folds at once. Faster when predicting with multiple folds, but '
+                             'needs more GPU memory.')
+    parser.add_argument('-micro_batch_cases', type=int, required=False, default=1,
+                        help='Predict the sliding window tiles of up to this many cases together so that they share '
+                             'forward passes. Speeds things up if you have many small cases (2D images, small crops) '
+                             'that on their own do not fill a batch. Default: 1 (cases are predicted one by one)')
+    parser.add_argument('-micro_batch_max_latency', type=float, required=False, default=0.5,
+                        help='Only used with -micro_batch_cases > 1. Maximum time (in seconds) a case waits for other '
+                             'cases before it is predicted anyway. Default: 0.5')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -719,7 +1468,17 @@ def predict_entry_point_modelfolder():
                                 use_mirroring=not args.disable_tta,
                                 perform_everything_on_gpu=True,
                                 device=device,
-                                verbose=args.verbose)
+                                verbose=args.verbose,
+                                tile_batch_size=args.tile_batch_size,
+                                batched_mirroring=args.batched_mirroring,
+                                pipeline_tiles=args.pipeline_tiles,
+                                skip_empty_tiles=args.skip_empty_tiles,
+                                empty_tile_threshold=args.empty_tile_threshold,
+                                coarse_to_fine=args.coarse_to_fine,
+                                accumulate_on_disk=args.accumulate_on_disk,
+                                share_tiles_across_folds=args.share_tiles_across_folds,
+                                micro_batch_cases=args.micro_batch_cases,
+                                micro_batch_max_latency=args.micro_batch_max_latency)
     predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
     predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
@@ -789,6 +1548,43 @@ def predict_entry_point():
                         help="Use this to set the device the inference should run with. Available options are 'cuda' "
                              "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2). Do NOT use this to set which GPU ID! "
                              "Use CUDA_VISIBLE_DEVICES=X nnUNetv2_predict [...] instead!")
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=None,
+                        help='Number of sliding window tiles that are predicted together in one forward pass. '
+                             'Default: determined automatically from the available (GPU) memory. Reduce this if you '
+                             'run into out of memory errors.')
+    parser.add_argument('--batched_mirroring', action='store_true', required=False, default=False,
+                        help='Set this flag to predict all mirrored variants of a tile (test time augmentation) '
+                             'together in one forward pass instead of one after the other. Same result, better '
+                             'hardware utilization but needs more memory.')
+    parser.add_argument('--pipeline_tiles', action='store_true', required=False, default=False,
+                        help='Set this flag to overlap tile transfers with prediction (background threads) when we '
+                             'predict on a GPU but the image or the predicted logits are in CPU RAM.')
+    parser.add_argument('--skip_empty_tiles', action='store_true', required=False, default=False,
+                        help='Set this flag to skip sliding window tiles that carry no information (input is 0 '
+                             'everywhere within the tile: zero padding or outside of the nonzero mask). They are '
+                             'filled with background instead. Faster, but the network does not see these regions.')
+    parser.add_argument('-empty_tile_threshold', type=float, required=False, default=None,
+                        help='Only used with --skip_empty_tiles. If set, tiles are considered empty if all their '
+                             'intensities (after normalization!) are smaller or equal to this value.')
+    parser.add_argument('--coarse_to_fine', action='store_true', required=False, default=False,
+                        help='Set this flag to first run a cheap prediction (step size 1, no mirroring) and then '
+                             'predict only the region around the detected foreground with the full settings. '
+                             'Faster for small structures in large images.')
+    parser.add_argument('--accumulate_on_disk', action='store_true', required=False, default=False,
+                        help='Set this flag to keep the predicted logits in memory mapped files (system temp dir, '
+                             'set TMPDIR to change it) instead of RAM. Use this if your images are so large that you '
+                             'run out of RAM. Slower.')
+    parser.add_argument('--share_tiles_across_folds', action='store_true', required=False, default=False,
+                        help='Set this flag to keep the networks of all folds in GPU memory and predict each sliding '
+                             'window tile with all folds at once. Faster when predicting with multiple folds, but '
+                             'needs more GPU memory.')
+    parser.add_argument('-micro_batch_cases', type=int, required=False, default=1,
+                        help='Predict the sliding window tiles of up to this many cases together so that they share '
+                             'forward passes. Speeds things up if you have many small cases (2D images, small crops) '
+                             'that on their own do not fill a batch. Default: 1 (cases are predicted one by one)')
+    parser.add_argument('-micro_batch_max_latency', type=float, required=False, default=0.5,
+                        help='Only used with -micro_batch_cases > 1. Maximum time (in seconds) a case waits for other '
+                             'cases before it is predicted anyway. Default: 0.5')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -829,7 +1625,17 @@ def predict_entry_point():
                                 perform_everything_on_gpu=True,
                                 device=device,
                                 verbose=args.verbose,
-                                verbose_preprocessing=False)
+                                verbose_preprocessing=False,
+                                tile_batch_size=args.tile_batch_size,
+                                batched_mirroring=args.batched_mirroring,
+                                pipeline_tiles=args.pipeline_tiles,
+                                skip_empty_tiles=args.skip_empty_tiles,
+                                empty_tile_threshold=args.empty_tile_threshold,
+                                coarse_to_fine=args.coarse_to_fine,
+                                accumulate_on_disk=args.accumulate_on_disk,
+                                share_tiles_across_folds=args.share_tiles_across_folds,
+                                micro_batch_cases=args.micro_batch_cases,
+                                micro_batch_max_latency=args.micro_batch_max_latency)
     predictor.initialize_from_trained_model_folder(
         model_folder,
         args.f,
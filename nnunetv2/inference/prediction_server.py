@@ -0,0 +1,355 @@
+import io
+import json
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future
+from time import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Union, List, Tuple
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import torch
+
+from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
+    convert_predicted_logits_to_segmentation_with_correct_shape
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.utilities.file_path_utilities import get_output_folder
+from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+
+
+def _warm_up_worker(_) -> None:
+    # nothing to do here. Unpickling this function makes the (spawned) worker import torch and nnunetv2 which is what
+    # takes all the time
+    return None
+
+
+def _preprocess_case_from_files(image_files: List[str],
+                                seg_from_prev_stage_file: Union[str, None],
+                                plans_manager: PlansManager,
+                                dataset_json: dict,
+                                configuration_manager: ConfigurationManager,
+                                verbose: bool = False) -> Tuple[np.ndarray, dict]:
+    preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
+    data, seg, data_properites = preprocessor.run_case(image_files, seg_from_prev_stage_file, plans_manager,
+                                                       configuration_manager, dataset_json)
+    if seg_from_prev_stage_file is not None:
+        label_manager = plans_manager.get_label_manager(dataset_json)
+        seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
+        data = np.vstack((data, seg_onehot))
+    return data, data_properites
+
+
+def _preprocess_case_from_npy(image: np.ndarray,
+                              seg_from_prev_stage: Union[np.ndarray, None],
+                              image_properties: dict,
+                              plans_manager: PlansManager,
+                              dataset_json: dict,
+                              configuration_manager: ConfigurationManager,
+                              verbose: bool = False) -> Tuple[np.ndarray, dict]:
+    preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
+    data, seg = preprocessor.run_case_npy(image, seg_from_prev_stage, image_properties, plans_manager,
+                                          configuration_manager, dataset_json)
+    if seg_from_prev_stage is not None:
+        label_manager = plans_manager.get_label_manager(dataset_json)
+        seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
+        data = np.vstack((data, seg_onehot))
+    return data, image_properties
+
+
+class nnUNetPredictionServer(object):
+    def __init__(self, predictor: nnUNetPredictor,
+                 num_processes_preprocessing: int = 3,
+                 num_processes_segmentation_export: int = 3):
+        """
+        Keeps an initialized nnUNetPredictor (network + parameters of all folds) as well as the preprocessing and
+        segmentation export worker pools alive so that predicting a case does not have to pay the startup cost of
+        nnUNetv2_predict (importing torch, building the network, loading checkpoints, spawning workers) each time.
+
+        Cases are submitted with submit_files or submit_npy which return a concurrent.futures.Future. Preprocessing
+        and export happen in the worker pools, prediction happens in one dedicated thread (we only have one GPU, so
+        there is no point in predicting several cases at the same time). Preprocessing of the next cases therefore
+        overlaps with the prediction of the current one, same as in predict_from_files.
+
+        Use serve_http (or nnUNetv2_predict_server) to make this available via a localhost HTTP endpoint.
+        """
+        assert predictor.network is not None, 'predictor must be initialized (initialize_from_trained_model_folder)'
+        self.predictor = predictor
+        context = multiprocessing.get_context('spawn')
+        self.preprocessing_pool = context.Pool(num_processes_preprocessing)
+        self.export_pool = context.Pool(num_processes_segmentation_export)
+        # pay the startup cost of the workers now and not with the first request
+        self.preprocessing_pool.map(_warm_up_worker, range(num_processes_preprocessing))
+        self.export_pool.map(_warm_up_worker, range(num_processes_segmentation_export))
+
+        self._prediction_queue = queue.Queue()
+        self._prediction_thread = threading.Thread(target=self._prediction_loop, daemon=True)
+        self._prediction_thread.start()
+
+    def submit_files(self, image_files: List[str],
+                     output_file_truncated: str = None,
+                     seg_from_prev_stage_file: str = None,
+                     save_probabilities: bool = False) -> Future:
+        """
+        image_files must be given in the order of the channels in dataset.json.
+        If output_file_truncated is None the future resolves to the segmentation (and probabilities if
+        save_probabilities) instead of output_file_truncated
+        """
+        future = Future()
+        self.preprocessing_pool.apply_async(
+            _preprocess_case_from_files,
+            (image_files, seg_from_prev_stage_file, self.predictor.plans_manager, self.predictor.dataset_json,
+             self.predictor.configuration_manager, self.predictor.verbose_preprocessing),
+            callback=self._get_enqueue_callback(output_file_truncated, save_probabilities, future),
+            error_callback=future.set_exception
+        )
+        return future
+
+    def submit_npy(self, image: np.ndarray, image_properties: dict,
+                   output_file_truncated: str = None,
+                   seg_from_prev_stage: np.ndarray = None,
+                   save_probabilities: bool = False) -> Future:
+        """
+        image_properties must have a 'spacing' key (see predict_single_npy_array). Same as submit_files otherwise
+        """
+        future = Future()
+        self.preprocessing_pool.apply_async(
+            _preprocess_case_from_npy,
+            (image, seg_from_prev_stage, image_properties, self.predictor.plans_manager, self.predictor.dataset_json,
+             self.predictor.configuration_manager, self.predictor.verbose_preprocessing),
+            callback=self._get_enqueue_callback(output_file_truncated, save_probabilities, future),
+            error_callback=future.set_exception
+        )
+        return future
+
+    def _get_enqueue_callback(self, output_file_truncated: Union[str, None], save_probabilities: bool,
+                              future: Future):
+        def enqueue(preprocessed: Tuple[np.ndarray, dict]):
+            self._prediction_queue.put((preprocessed, output_file_truncated, save_probabilities, future))
+        return enqueue
+
+    def _prediction_loop(self):
+        finished = False
+        while not finished:
+            item = self._prediction_queue.get()
+            if item is None:
+                return
+            # requests that arrive while we wait are predicted together (see micro_batch_cases in nnUNetPredictor)
+            group = [item]
+            deadline = time() + self.predictor.micro_batch_max_latency
+            while len(group) < self.predictor.micro_batch_cases:
+                try:
+                    item = self._prediction_queue.get(timeout=max(0., deadline - time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    finished = True
+                    break
+                group.append(item)
+            try:
+                predictions = self.predictor._internal_predict_logits_case_group(
+                    [torch.from_numpy(data) for (data, _), _, _, _ in group], to_shared_memory=True)
+            except Exception as e:
+                for _, _, _, future in group:
+                    future.set_exception(e)
+                continue
+            for prediction, ((_, properties), ofile, save_probabilities, future) in zip(predictions, group):
+                try:
+                    self._export(prediction, properties, ofile, save_probabilities, future)
+                except Exception as e:
+                    future.set_exception(e)
+
+    def _export(self, prediction: torch.Tensor, properties: dict, ofile: Union[str, None],
+                save_probabilities: bool, future: Future):
+        if self.predictor.accumulate_on_disk:
+            prediction = self.predictor._internal_save_logits_for_export(prediction)
+        if ofile is not None:
+            self.export_pool.apply_async(
+                export_prediction_from_logits,
+                (prediction, properties, self.predictor.configuration_manager, self.predictor.plans_manager,
+                 self.predictor.dataset_json, ofile, save_probabilities),
+                callback=lambda _: future.set_result(ofile),
+                error_callback=future.set_exception
+            )
+        else:
+            self.export_pool.apply_async(
+                convert_predicted_logits_to_segmentation_with_correct_shape,
+                (prediction, self.predictor.plans_manager, self.predictor.configuration_manager,
+                 self.predictor.label_manager, properties, save_probabilities),
+                callback=future.set_result,
+                error_callback=future.set_exception
+            )
+
+    def shutdown(self):
+        self._prediction_queue.put(None)
+        self._prediction_thread.join()
+        for p in (self.preprocessing_pool, self.export_pool):
+            p.close()
+            p.join()
+
+    def serve_http(self, host: str = '127.0.0.1', port: int = 8050):
+        """
+        Blocks until interrupted (Ctrl+C). Endpoints:
+
+        GET /health -> json with the configuration and folds that are loaded
+
+        POST /predict, body is json:
+            {"input_files": [...], "output_file_truncated": str or null, "seg_from_prev_stage_file": str or null,
+            "save_probabilities": bool}
+            if output_file_truncated is given, the segmentation is written and the response is
+            {"output_file_truncated": ...}. Otherwise the response is the segmentation as .npy file (or .npz with keys
+            segmentation and probabilities if save_probabilities)
+
+        POST /predict_npy?spacing=z,y,x[&output_file_truncated=...], body is an image saved with np.save (c, x, y, z).
+            Response as for /predict
+
+        Binds to localhost by default. There is no authentication whatsoever, so think twice before exposing this!
+        """
+        httpd = ThreadingHTTPServer((host, port), _nnUNetRequestHandler)
+        httpd.prediction_server = self
+        print(f'nnU-Net prediction server listening on http://{host}:{port}')
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            self.shutdown()
+
+
+class _nnUNetRequestHandler(BaseHTTPRequestHandler):
+    def _send(self, code: int, body: bytes, content_type: str):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code: int, obj: dict):
+        self._send(code, json.dumps(obj).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            self._send_json(404, {'error': f'unknown endpoint {self.path}'})
+            return
+        predictor = self.server.prediction_server.predictor
+        self._send_json(200, {'status': 'ok',
+                              'dataset': predictor.plans_manager.dataset_name,
+                              'trainer': predictor.trainer_name,
+                              'num_folds': len(predictor.list_of_parameters)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        prediction_server = self.server.prediction_server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if url.path == '/predict':
+                request = json.loads(body)
+                ofile = request.get('output_file_truncated')
+                save_probabilities = request.get('save_probabilities', False)
+                future = prediction_server.submit_files(request['input_files'], ofile,
+                                                        request.get('seg_from_prev_stage_file'), save_probabilities)
+            elif url.path == '/predict_npy':
+                query = parse_qs(url.query)
+                spacing = [float(i) for i in query['spacing'][0].split(',')]
+                ofile = query.get('output_file_truncated', [None])[0]
+                save_probabilities = query.get('save_probabilities', ['false'])[0].lower() in ('true', '1', 't')
+                image = np.load(io.BytesIO(body), allow_pickle=False)
+                future = prediction_server.submit_npy(image, {'spacing': spacing}, ofile,
+                                                      save_probabilities=save_probabilities)
+            else:
+                self._send_json(404, {'error': f'unknown endpoint {self.path}'})
+                return
+            result = future.result()
+        except Exception as e:
+            self._send_json(500, {'error': repr(e)})
+            return
+
+        if ofile is not None:
+            self._send_json(200, {'output_file_truncated': ofile})
+            return
+        buffer = io.BytesIO()
+        if save_probabilities:
+            np.savez(buffer, segmentation=result[0], probabilities=result[1])
+        else:
+            np.save(buffer, result)
+        self._send(200, buffer.getvalue(), 'application/octet-stream')
+
+
+def predict_server_entry_point():
+    import argparse
+    parser = argparse.ArgumentParser(description='Starts a persistent nnU-Net prediction server on localhost. The '
+                                                 'network, the checkpoints of all folds and the worker pools are '
+                                                 'loaded once and then stay in memory, so each request only pays for '
+                                                 'the actual prediction. See nnUNetPredictionServer.serve_http for '
+                                                 'the endpoints.')
+    parser.add_argument('-d', type=str, required=True,
+                        help='Dataset with which you would like to predict. You can specify either dataset name or id')
+    parser.add_argument('-p', type=str, required=False, default='nnUNetPlans',
+                        help='Plans identifier. Specify the plans in which the desired configuration is located. '
+                             'Default: nnUNetPlans')
+    parser.add_argument('-tr', type=str, required=False, default='nnUNetTrainer',
+                        help='What nnU-Net trainer class was used for training? Default: nnUNetTrainer')
+    parser.add_argument('-c', type=str, required=True,
+                        help='nnU-Net configuration that should be used for prediction. Config must be located '
+                             'in the plans specified with -p')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Specify the folds of the trained model that should be used for prediction. '
+                             'Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+                        help='Step size for sliding window prediction. The larger it is the faster but less accurate '
+                             'the prediction. Default: 0.5. Cannot be larger than 1. We recommend the default.')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to disable test time data augmentation in the form of mirroring. Faster, '
+                             'but less accurate inference. Not recommended.')
+    parser.add_argument('--verbose', action='store_true', help="Set this if you like being talked to. You will have "
+                                                               "to be a good listener/reader.")
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
+    parser.add_argument('-npp', type=int, required=False, default=3,
+                        help='Number of processes used for preprocessing. Default: 3')
+    parser.add_argument('-nps', type=int, required=False, default=3,
+                        help='Number of processes used for segmentation export. Default: 3')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="Use this to set the device the inference should run with. Available options are 'cuda' "
+                             "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2). Do NOT use this to set which GPU ID! "
+                             "Use CUDA_VISIBLE_DEVICES=X nnUNetv2_predict_server [...] instead!")
+    parser.add_argument('-host', type=str, required=False, default='127.0.0.1',
+                        help='Host to bind to. Default: 127.0.0.1 (only reachable from this machine)')
+    parser.add_argument('-port', type=int, required=False, default=8050,
+                        help='Port to listen on. Default: 8050')
+    args = parser.parse_args()
+    args.f = [i if i == 'all' else int(i) for i in args.f]
+
+    assert args.device in ['cpu', 'cuda',
+                           'mps'], f'-device must be either cpu, mps or cuda. Other devices are not tested/supported. Got: {args.device}.'
+    if args.device == 'cpu':
+        # let's allow torch to use hella threads
+        torch.set_num_threads(multiprocessing.cpu_count())
+        device = torch.device('cpu')
+    elif args.device == 'cuda':
+        # multithreading in torch doesn't help nnU-Net if run on GPU
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+        device = torch.device('cuda')
+    else:
+        device = torch.device('mps')
+
+    predictor = nnUNetPredictor(tile_step_size=args.step_size,
+                                use_gaussian=True,
+                                use_mirroring=not args.disable_tta,
+                                perform_everything_on_gpu=True,
+                                device=device,
+                                verbose=args.verbose,
+                                verbose_preprocessing=False,
+                                allow_tqdm=False)
+    predictor.initialize_from_trained_model_folder(get_output_folder(args.d, args.tr, args.p, args.c), args.f,
+                                                   checkpoint_name=args.chk)
+    server = nnUNetPredictionServer(predictor, args.npp, args.nps)
+    server.serve_http(args.host, args.port)
+
+
+if __name__ == '__main__':
+    predict_server_entry_point()
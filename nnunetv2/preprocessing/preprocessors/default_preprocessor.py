@@ -11,6 +11,8 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
+import hashlib
+import json
 import multiprocessing
 import shutil
 from time import sleep
@@ -25,6 +27,8 @@ from nnunetv2.preprocessing.resampling.default_resampling import compute_new_sha
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.preprocessed_storage import save_preprocessed_case, preprocessed_case_exists, \
+    remove_preprocessed_case
 from nnunetv2.utilities.utils import get_identifiers_from_splitted_dataset_folder, \
     create_lists_from_splitted_dataset_folder, get_filenames_of_train_images_and_targets
 from tqdm import tqdm
@@ -145,7 +149,8 @@ class DefaultPreprocessor(object):
                       dataset_json: Union[dict, str]):
         data, seg, properties = self.run_case(image_files, seg_file, plans_manager, configuration_manager, dataset_json)
         # print('dtypes', data.dtype, seg.dtype)
-        np.savez_compressed(output_filename_truncated + '.npz', data=data, seg=seg)
+        save_preprocessed_case(data, seg, output_filename_truncated, configuration_manager.preprocessed_storage_format,
+                               configuration_manager.patch_size)
         write_pickle(properties, output_filename_truncated + '.pkl')
 
     @staticmethod
@@ -191,10 +196,39 @@ class DefaultPreprocessor(object):
             data[c] = normalizer.run(data[c], seg[0])
         return data
 
+    def _get_preprocessing_fingerprint(self, plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                                       dataset_json: dict) -> str:
+        """
+        hash of everything (apart from the images themselves) that determines what the preprocessed data looks like.
+        If this changes, all cases must be preprocessed again
+        """
+        relevant = {
+            'preprocessor': self.__class__.__name__,
+            'configuration': configuration_manager.configuration,
+            'plans': {k: v for k, v in plans_manager.plans.items() if k != 'configurations'},
+            'dataset_json': dataset_json
+        }
+        return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _get_case_signature(images: List[str], label: Union[str, None]) -> dict:
+        """
+        size and modification time of each input file. Much cheaper than hashing the content and good enough to
+        detect added/replaced/modified files
+        """
+        files = list(images) + ([label] if label is not None else [])
+        return {f: [os.path.getsize(f), os.stat(f).st_mtime_ns] for f in files}
+
     def run(self, dataset_name_or_id: Union[int, str], configuration_name: str, plans_identifier: str,
-            num_processes: int):
+            num_processes: int, incremental: bool = False):
         """
         data identifier = configuration name in plans. EZ.
+
+        incremental: if True, only cases that are new or whose input files changed (size or mtime) are preprocessed.
+        Cases that are no longer in the dataset are removed. What was done is tracked in a manifest
+        (preprocessing_manifest.json) in the output folder, together with a fingerprint of the plans, configuration,
+        dataset.json and preprocessor class. If the fingerprint changed (or there is no manifest) everything is
+        preprocessed from scratch. Note that changes in the code of the preprocessor are not detected!
         """
         dataset_name = maybe_convert_to_dataset_name(dataset_name_or_id)
 
@@ -216,45 +250,80 @@ class DefaultPreprocessor(object):
         dataset_json = load_json(dataset_json_file)
 
         output_directory = join(nnUNet_preprocessed, dataset_name, configuration_manager.data_identifier)
-
-        if isdir(output_directory):
-            shutil.rmtree(output_directory)
+        manifest_file = join(output_directory, 'preprocessing_manifest.json')
+        fingerprint = self._get_preprocessing_fingerprint(plans_manager, configuration_manager, dataset_json)
+
+        manifest = None
+        if incremental and isfile(manifest_file):
+            manifest = load_json(manifest_file)
+            if manifest['fingerprint'] != fingerprint:
+                print('Plans, configuration or dataset.json changed since the last preprocessing. Preprocessing all '
+                      'cases again')
+                manifest = None
+        elif incremental:
+            print(f'No preprocessing manifest found in {output_directory}. Preprocessing all cases')
+
+        if manifest is None:
+            if isdir(output_directory):
+                shutil.rmtree(output_directory)
+            manifest = {'fingerprint': fingerprint, 'cases': {}}
 
         maybe_mkdir_p(output_directory)
 
         dataset = get_filenames_of_train_images_and_targets(join(nnUNet_raw, dataset_name), dataset_json)
 
+        for k in [i for i in manifest['cases'].keys() if i not in dataset.keys()]:
+            # case was removed from the dataset
+            remove_preprocessed_case(join(output_directory, k))
+            del manifest['cases'][k]
+
+        signatures = {k: self._get_case_signature(dataset[k]['images'], dataset[k]['label']) for k in dataset.keys()}
+        todo = [k for k in dataset.keys() if manifest['cases'].get(k) != signatures[k] or
+                not preprocessed_case_exists(join(output_directory, k))]
+        if incremental:
+            print(f'{len(dataset) - len(todo)} cases are up to date, {len(todo)} cases need to be preprocessed')
+        for k in todo:
+            manifest['cases'].pop(k, None)
+            # unpack_dataset does not overwrite existing .npy files, so stale ones must go as well
+            remove_preprocessed_case(join(output_directory, k))
+
         # identifiers = [os.path.basename(i[:-len(dataset_json['file_ending'])]) for i in seg_fnames]
         # output_filenames_truncated = [join(output_directory, i) for i in identifiers]
 
         # multiprocessing magic.
         r = []
         with multiprocessing.get_context("spawn").Pool(num_processes) as p:
-            for k in dataset.keys():
+            for k in todo:
                 r.append(p.starmap_async(self.run_case_save,
                                          ((join(output_directory, k), dataset[k]['images'], dataset[k]['label'],
                                            plans_manager, configuration_manager,
                                            dataset_json),)))
-            remaining = list(range(len(dataset)))
+            remaining = list(range(len(todo)))
             # p is pretty nifti. If we kill workers they just respawn but don't do any work.
             # So we need to store the original pool of workers.
             workers = [j for j in p._pool]
-            with tqdm(desc=None, total=len(dataset), disable=self.verbose) as pbar:
-                while len(remaining) > 0:
-                    all_alive = all([j.is_alive() for j in workers])
-                    if not all_alive:
-                        raise RuntimeError('Some background worker is 6 feet under. Yuck. \n'
-                                           'OK jokes aside.\n'
-                                           'One of your background processes is missing. This could be because of '
-                                           'an error (look for an error message) or because it was killed '
-                                           'by your OS due to running out of RAM. If you don\'t see '
-                                           'an error message, out of RAM is likely the problem. In that case '
-                                           'reducing the number of workers might help')
-                    done = [i for i in remaining if r[i].ready()]
-                    for _ in done:
-                        pbar.update()
-                    remaining = [i for i in remaining if i not in done]
-                    sleep(0.1)
+            try:
+                with tqdm(desc=None, total=len(todo), disable=self.verbose) as pbar:
+                    while len(remaining) > 0:
+                        all_alive = all([j.is_alive() for j in workers])
+                        if not all_alive:
+                            raise RuntimeError('Some background worker is 6 feet under. Yuck. \n'
+                                               'OK jokes aside.\n'
+                                               'One of your background processes is missing. This could be because of '
+                                               'an error (look for an error message) or because it was killed '
+                                               'by your OS due to running out of RAM. If you don\'t see '
+                                               'an error message, out of RAM is likely the problem. In that case '
+                                               'reducing the number of workers might help')
+                        done = [i for i in remaining if r[i].ready()]
+                        for i in done:
+                            if r[i].successful():
+                                manifest['cases'][todo[i]] = signatures[todo[i]]
+                            pbar.update()
+                        remaining = [i for i in remaining if i not in done]
+                        sleep(0.1)
+            finally:
+                # whatever finished successfully does not have to be done again next time
+                save_json(manifest, manifest_file, sort_keys=False)
 
     def modify_seg_fn(self, seg: np.ndarray, plans_manager: PlansManager, dataset_json: dict,
                       configuration_manager: ConfigurationManager) -> np.ndarray:
@@ -1,10 +1,11 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Tuple, List
 
 import numpy as np
 import pandas as pd
 import torch
-from batchgenerators.augmentations.utils import resize_segmentation
+from batchgenerators.augmentations.utils import resize_segmentation, unique_labels
 from scipy.ndimage.interpolation import map_coordinates
 from skimage.transform import resize
 from nnunetv2.configuration import ANISO_THRESHOLD
@@ -29,13 +30,10 @@ def compute_new_shape(old_shape: Union[Tuple[int, ...], List[int], np.ndarray],
     return new_shape
 
 
-def resample_data_or_seg_to_spacing(data: np.ndarray,
-                                    current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
-                                    new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
-                                    is_seg: bool = False,
-                                    order: int = 3, order_z: int = 0,
-                                    force_separate_z: Union[bool, None] = False,
-                                    separate_z_anisotropy_threshold: float = ANISO_THRESHOLD):
+def determine_do_separate_z_and_axis(current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                     new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                     force_separate_z: Union[bool, None] = False,
+                                     separate_z_anisotropy_threshold: float = ANISO_THRESHOLD):
     if force_separate_z is not None:
         do_separate_z = force_separate_z
         if force_separate_z:
@@ -63,6 +61,19 @@ def resample_data_or_seg_to_spacing(data: np.ndarray,
             do_separate_z = False
         else:
             pass
+    return do_separate_z, axis
+
+
+def resample_data_or_seg_to_spacing(data: np.ndarray,
+                                    current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                    new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                    is_seg: bool = False,
+                                    order: int = 3, order_z: int = 0,
+                                    force_separate_z: Union[bool, None] = False,
+                                    separate_z_anisotropy_threshold: float = ANISO_THRESHOLD,
+                                    num_threads: int = 1):
+    do_separate_z, axis = determine_do_separate_z_and_axis(current_spacing, new_spacing, force_separate_z,
+                                                           separate_z_anisotropy_threshold)
 
     if data is not None:
         assert len(data.shape) == 4, "data must be c x y z"
@@ -70,7 +81,8 @@ def resample_data_or_seg_to_spacing(data: np.ndarray,
     shape = np.array(data[0].shape)
     new_shape = compute_new_shape(shape[1:], current_spacing, new_spacing)
 
-    data_reshaped = resample_data_or_seg(data, new_shape, is_seg, axis, order, do_separate_z, order_z=order_z)
+    data_reshaped = resample_data_or_seg(data, new_shape, is_seg, axis, order, do_separate_z, order_z=order_z,
+                                         num_threads=num_threads)
     return data_reshaped
 
 
@@ -81,50 +93,158 @@ def resample_data_or_seg_to_shape(data: Union[torch.Tensor, np.ndarray],
                                   is_seg: bool = False,
                                   order: int = 3, order_z: int = 0,
                                   force_separate_z: Union[bool, None] = False,
-                                  separate_z_anisotropy_threshold: float = ANISO_THRESHOLD):
+                                  separate_z_anisotropy_threshold: float = ANISO_THRESHOLD,
+                                  num_threads: int = 1):
     """
     needed for segmentation export. Stupid, I know. Maybe we can fix that with Leos new resampling functions
+    num_threads: see resample_data_or_seg. Can be set via the resampling_fn_*_kwargs in the plans
     """
     if isinstance(data, torch.Tensor):
         data = data.cpu().numpy()
-    if force_separate_z is not None:
-        do_separate_z = force_separate_z
-        if force_separate_z:
-            axis = get_lowres_axis(current_spacing)
-        else:
-            axis = None
-    else:
-        if get_do_separate_z(current_spacing, separate_z_anisotropy_threshold):
-            do_separate_z = True
-            axis = get_lowres_axis(current_spacing)
-        elif get_do_separate_z(new_spacing, separate_z_anisotropy_threshold):
-            do_separate_z = True
-            axis = get_lowres_axis(new_spacing)
-        else:
-            do_separate_z = False
-            axis = None
-
-    if axis is not None:
-        if len(axis) == 3:
-            # every axis has the same spacing, this should never happen, why is this code here?
-            do_separate_z = False
-        elif len(axis) == 2:
-            # this happens for spacings like (0.24, 1.25, 1.25) for example. In that case we do not want to resample
-            # separately in the out of plane axis
-            do_separate_z = False
-        else:
-            pass
+    do_separate_z, axis = determine_do_separate_z_and_axis(current_spacing, new_spacing, force_separate_z,
+                                                           separate_z_anisotropy_threshold)
 
     if data is not None:
         assert len(data.shape) == 4, "data must be c x y z"
 
-    data_reshaped = resample_data_or_seg(data, new_shape, is_seg, axis, order, do_separate_z, order_z=order_z)
+    data_reshaped = resample_data_or_seg(data, new_shape, is_seg, axis, order, do_separate_z, order_z=order_z,
+                                         num_threads=num_threads)
     return data_reshaped
 
 
+def _interpolate_mask_in_bbox(mask: np.ndarray, coords_per_axis: List[np.ndarray], order: int = 1) \
+        -> Union[None, Tuple[Tuple[slice, ...], np.ndarray]]:
+    """
+    Linear interpolation of a binary mask at the (separable) coordinates coords_per_axis (one 1d array per axis, same
+    convention as map_coordinates, mode='nearest'), restricted to the bounding box of the mask.
+    Output voxels whose coordinates are not within 1 voxel of the bounding box can only ever be 0 (all neighbors
+    they interpolate from are 0), so we don't compute them. Within the box we call map_coordinates on a crop of the
+    mask (bounding box + 1 voxel) with exactly the same coordinates (minus the integer crop offset, which is exact in
+    floating point). Every computed voxel sees the same neighbors and weights as if we had interpolated the entire
+    mask, so the result is the same.
+    Returns (slicer into the output, interpolated values) or None if the mask is empty.
+    Only valid for order 1! Higher orders prefilter the entire array (splines) and are not local.
+    """
+    assert order == 1
+    nonzero_per_axis = [np.where(np.any(mask, axis=tuple([j for j in range(mask.ndim) if j != i])))[0]
+                        for i in range(mask.ndim)]
+    if len(nonzero_per_axis[0]) == 0:
+        return None
+    crop_slicer, out_slicer, local_coords = [], [], []
+    for n, nonzero, coords in zip(mask.shape, nonzero_per_axis, coords_per_axis):
+        lb, ub = nonzero[0], nonzero[-1]
+        # output voxels that can see the bbox: lb - 1 < coordinate < ub + 1
+        k_lo = int(np.searchsorted(coords, lb - 1, side='right'))
+        k_hi = int(np.searchsorted(coords, ub + 1, side='left'))
+        if k_hi <= k_lo:
+            return None
+        crop_lo, crop_hi = max(lb - 1, 0), min(ub + 1, n - 1)
+        crop_slicer.append(slice(crop_lo, crop_hi + 1))
+        out_slicer.append(slice(k_lo, k_hi))
+        local_coords.append(coords[k_lo:k_hi] - crop_lo)
+    coord_map = np.array(np.meshgrid(*local_coords, indexing='ij'))
+    values = map_coordinates(mask[tuple(crop_slicer)].astype(float), coord_map, order=order, mode='nearest')
+    return tuple(out_slicer), values
+
+
+def resize_segmentation_bbox(segmentation: np.ndarray, new_shape: Union[Tuple[int, ...], List[int], np.ndarray],
+                             order: int = 3) -> np.ndarray:
+    """
+    Same output as batchgenerators' resize_segmentation, but much faster for segmentations with many labels.
+    resize_segmentation resizes the mask of every label (skimage resize, mode='edge') and picks the label with the
+    highest score per voxel (argmax, exact ties go to the nearest neighbor label if it is one of the tied labels,
+    otherwise to the smallest one). For order 1 a label scores 0 outside of its bounding box (+ 1 voxel), and a
+    score of 0 never changes the running argmax. So we only interpolate (see _interpolate_mask_in_bbox) and compare
+    within the bounding box of each label and the cost no longer scales with number of labels * image size.
+    Other orders are not local, so we just use resize_segmentation for them.
+    """
+    assert len(segmentation.shape) == len(new_shape), "new shape must have same dimensionality as segmentation"
+    labels = unique_labels(segmentation) if segmentation.size > 0 else None
+    if order != 1 or labels is None or len(labels) < 2:
+        return resize_segmentation(segmentation, new_shape, order)
+    new_shape = tuple([int(i) for i in new_shape])
+    # skimage resize (ndi.zoom with grid_mode=True) samples output voxel k at input coordinate (k + 0.5) * zoom - 0.5
+    # with zoom = input size / output size
+    coords_per_axis = [((np.arange(o) + 0.5) * (i / o)) - 0.5 for i, o in zip(segmentation.shape, new_shape)]
+
+    # index (into labels) of the nearest neighbor label, used for breaking ties
+    nn = resize(segmentation.astype(float), new_shape, 0, mode="edge", clip=True, anti_aliasing=False)
+    nn_idx = np.minimum(np.searchsorted(labels, nn), len(labels) - 1)
+    nn_idx[labels[nn_idx] != nn] = -1
+    del nn
+
+    # running argmax. Voxels outside all bounding boxes keep label index 0 (they can't exist, every voxel is
+    # covered by some label)
+    win = np.zeros(new_shape, dtype=np.int32)
+    best = np.zeros(new_shape, dtype=float)
+    # does the nearest neighbor label currently share the top score?
+    nn_top = np.zeros(new_shape, dtype=bool)
+    for i, c in enumerate(labels):
+        ret = _interpolate_mask_in_bbox(segmentation == c, coords_per_axis, order)
+        if ret is None:
+            continue
+        out_slicer, score = ret
+        b, is_nn, t = best[out_slicer], nn_idx[out_slicer] == i, nn_top[out_slicer]
+        if i == 0:
+            # first label: starting point of the argmax (best is still 0 everywhere)
+            t[:] = is_nn & (score > 0)
+            b[:] = score
+            continue
+        t |= (score == b) & (score > 0) & is_nn
+        better = score > b
+        t[better] = is_nn[better]
+        win[out_slicer][better] = i
+        np.maximum(b, score, out=b)
+    np.copyto(win, nn_idx, where=nn_top)
+    return labels.astype(segmentation.dtype, copy=False)[win]
+
+
+def _resample_along_lowres_axis(reshaped_data: np.ndarray, new_shape: np.ndarray, is_seg: bool, order_z: int,
+                                dtype_data) -> np.ndarray:
+    # The following few lines are blatantly copied and modified from sklearn's resize()
+    rows, cols, dim = new_shape[0], new_shape[1], new_shape[2]
+    orig_rows, orig_cols, orig_dim = reshaped_data.shape
+
+    row_scale = float(orig_rows) / rows
+    col_scale = float(orig_cols) / cols
+    dim_scale = float(orig_dim) / dim
+
+    map_rows, map_cols, map_dims = np.mgrid[:rows, :cols, :dim]
+    map_rows = row_scale * (map_rows + 0.5) - 0.5
+    map_cols = col_scale * (map_cols + 0.5) - 0.5
+    map_dims = dim_scale * (map_dims + 0.5) - 0.5
+
+    coord_map = np.array([map_rows, map_cols, map_dims])
+    if not is_seg or order_z == 0:
+        return map_coordinates(reshaped_data, coord_map, order=order_z, mode='nearest')[None]
+    else:
+        unique_labels = np.sort(pd.unique(reshaped_data.ravel()))  # np.unique(reshaped_data)
+        reshaped = np.zeros(new_shape, dtype=dtype_data)
+
+        if order_z == 1:
+            # only look at the bounding box of each label, see _interpolate_mask_in_bbox
+            coords_per_axis = [map_rows[:, 0, 0], map_cols[0, :, 0], map_dims[0, 0, :]]
+            for i, cl in enumerate(unique_labels):
+                if i == 0 and cl == 0:
+                    continue
+                ret = _interpolate_mask_in_bbox(reshaped_data == cl, coords_per_axis, order_z)
+                if ret is None:
+                    continue
+                out_slicer, reshaped_multihot = ret
+                reshaped[out_slicer][np.round(reshaped_multihot) > 0.5] = cl
+            return reshaped[None]
+
+        for i, cl in enumerate(unique_labels):
+            reshaped_multihot = np.round(
+                map_coordinates((reshaped_data == cl).astype(float), coord_map, order=order_z,
+                                mode='nearest'))
+            reshaped[reshaped_multihot > 0.5] = cl
+        return reshaped[None]
+
+
 def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], List[float], np.ndarray],
                          is_seg: bool = False, axis: Union[None, int] = None, order: int = 3,
-                         do_separate_z: bool = False, order_z: int = 0):
+                         do_separate_z: bool = False, order_z: int = 0, num_threads: int = 1):
     """
     separate_z=True will resample with order 0 along z
     :param data:
@@ -134,13 +254,16 @@ def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], L
     :param order:
     :param do_separate_z:
     :param order_z: only applies if do_separate_z is True
+    :param num_threads: if > 1, channels (with separate z: the slices of each channel) are resampled in a thread pool
+    with this many threads. scipy.ndimage releases the GIL, so this actually runs in parallel. The result is
+    identical to num_threads=1 because every channel/slice is still resampled on its own and reassembled in order
     :return:
     """
     assert len(data.shape) == 4, "data must be (c, x, y, z)"
     assert len(new_shape) == len(data.shape) - 1
 
     if is_seg:
-        resize_fn = resize_segmentation
+        resize_fn = resize_segmentation_bbox
         kwargs = OrderedDict()
     else:
         resize_fn = resize
@@ -150,66 +273,50 @@ def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], L
     new_shape = np.array(new_shape)
     if np.any(shape != new_shape):
         data = data.astype(float)
-        if do_separate_z:
-            # print("separate z, order in z is", order_z, "order inplane is", order)
-            assert len(axis) == 1, "only one anisotropic axis supported"
-            axis = axis[0]
-            if axis == 0:
-                new_shape_2d = new_shape[1:]
-            elif axis == 1:
-                new_shape_2d = new_shape[[0, 2]]
-            else:
-                new_shape_2d = new_shape[:-1]
+        executor = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+        map_fn = executor.map if executor is not None else map
+        try:
+            if do_separate_z:
+                # print("separate z, order in z is", order_z, "order inplane is", order)
+                assert len(axis) == 1, "only one anisotropic axis supported"
+                axis = axis[0]
+                if axis == 0:
+                    new_shape_2d = new_shape[1:]
+                elif axis == 1:
+                    new_shape_2d = new_shape[[0, 2]]
+                else:
+                    new_shape_2d = new_shape[:-1]
 
-            reshaped_final_data = []
-            for c in range(data.shape[0]):
-                reshaped_data = []
-                for slice_id in range(shape[axis]):
+                def resize_slice(c_and_slice_id):
+                    c, slice_id = c_and_slice_id
                     if axis == 0:
-                        reshaped_data.append(resize_fn(data[c, slice_id], new_shape_2d, order, **kwargs))
+                        return resize_fn(data[c, slice_id], new_shape_2d, order, **kwargs)
                     elif axis == 1:
-                        reshaped_data.append(resize_fn(data[c, :, slice_id], new_shape_2d, order, **kwargs))
+                        return resize_fn(data[c, :, slice_id], new_shape_2d, order, **kwargs)
                     else:
-                        reshaped_data.append(resize_fn(data[c, :, :, slice_id], new_shape_2d, order, **kwargs))
-                reshaped_data = np.stack(reshaped_data, axis)
-                if shape[axis] != new_shape[axis]:
-
-                    # The following few lines are blatantly copied and modified from sklearn's resize()
-                    rows, cols, dim = new_shape[0], new_shape[1], new_shape[2]
-                    orig_rows, orig_cols, orig_dim = reshaped_data.shape
-
-                    row_scale = float(orig_rows) / rows
-                    col_scale = float(orig_cols) / cols
-                    dim_scale = float(orig_dim) / dim
-
-                    map_rows, map_cols, map_dims = np.mgrid[:rows, :cols, :dim]
-                    map_rows = row_scale * (map_rows + 0.5) - 0.5
-                    map_cols = col_scale * (map_cols + 0.5) - 0.5
-                    map_dims = dim_scale * (map_dims + 0.5) - 0.5
-
-                    coord_map = np.array([map_rows, map_cols, map_dims])
-                    if not is_seg or order_z == 0:
-                        reshaped_final_data.append(map_coordinates(reshaped_data, coord_map, order=order_z,
-                                                                   mode='nearest')[None])
+                        return resize_fn(data[c, :, :, slice_id], new_shape_2d, order, **kwargs)
+
+                # one channel at a time (its slices in parallel) so that only one channel's intermediate volume is in
+                # memory at any point
+                reshaped_final_data = []
+                for c in range(data.shape[0]):
+                    reshaped_data = np.stack(list(map_fn(resize_slice, [(c, slice_id)
+                                                                        for slice_id in range(shape[axis])])), axis)
+                    if shape[axis] != new_shape[axis]:
+                        reshaped_final_data.append(_resample_along_lowres_axis(reshaped_data, new_shape, is_seg,
+                                                                               order_z, dtype_data))
                     else:
-                        unique_labels = np.sort(pd.unique(reshaped_data.ravel()))  # np.unique(reshaped_data)
-                        reshaped = np.zeros(new_shape, dtype=dtype_data)
-
-                        for i, cl in enumerate(unique_labels):
-                            reshaped_multihot = np.round(
-                                map_coordinates((reshaped_data == cl).astype(float), coord_map, order=order_z,
-                                                mode='nearest'))
-                            reshaped[reshaped_multihot > 0.5] = cl
-                        reshaped_final_data.append(reshaped[None])
-                else:
-                    reshaped_final_data.append(reshaped_data[None])
-            reshaped_final_data = np.vstack(reshaped_final_data)
-        else:
-            # print("no separate z, order", order)
-            reshaped = []
-            for c in range(data.shape[0]):
-                reshaped.append(resize_fn(data[c], new_shape, order, **kwargs)[None])
-            reshaped_final_data = np.vstack(reshaped)
+                        reshaped_final_data.append(reshaped_data[None])
+                    del reshaped_data
+                reshaped_final_data = np.vstack(reshaped_final_data)
+            else:
+                # print("no separate z, order", order)
+                reshaped = list(map_fn(lambda c: resize_fn(data[c], new_shape, order, **kwargs)[None],
+                                       range(data.shape[0])))
+                reshaped_final_data = np.vstack(reshaped)
+        finally:
+            if executor is not None:
+                executor.shutdown()
         return reshaped_final_data.astype(dtype_data)
     else:
         # print("no resampling necessary")
@@ -0,0 +1,216 @@
+from typing import Union, Tuple, List
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from nnunetv2.configuration import ANISO_THRESHOLD
+from nnunetv2.preprocessing.resampling.default_resampling import determine_do_separate_z_and_axis
+
+
+def _resize_along_axis(x: torch.Tensor, axis: int, new_size: int, order: int) -> torch.Tensor:
+    """
+    x is (c, x, y(, z)). axis refers to the spatial axes (0 = x). Everything else is resized in one batched call.
+    Output voxel k samples the input at (k + 0.5) * old_size / new_size - 0.5 (computed in float64 exactly like
+    skimage resize / _resample_along_lowres_axis do) and coordinates outside the image are clamped (mode='edge').
+    order 0: nearest neighbor, rounding half up like map_coordinates. order 1: linear. >= 2: cubic convolution
+    (a=-0.75), which is NOT the cubic B-spline of skimage/scipy
+    """
+    dim = axis + 1
+    old_size = x.shape[dim]
+    if old_size == new_size:
+        return x
+    coords = (np.arange(new_size) + 0.5) * (float(old_size) / new_size) - 0.5
+    if order == 0:
+        idx = np.clip(np.floor(coords + 0.5), 0, old_size - 1).astype(np.int64)
+        return x.index_select(dim, torch.from_numpy(idx).to(x.device))
+    if order == 1:
+        coords = np.clip(coords, 0, old_size - 1)
+        lo = np.minimum(np.floor(coords), max(old_size - 2, 0)).astype(np.int64)
+        hi = np.minimum(lo + 1, old_size - 1)
+        weight_shape = [1] * x.ndim
+        weight_shape[dim] = new_size
+        w = torch.from_numpy(coords - lo).to(x.device, x.dtype).view(weight_shape)
+        return x.index_select(dim, torch.from_numpy(lo).to(x.device)) * (1 - w) + \
+            x.index_select(dim, torch.from_numpy(hi).to(x.device)) * w
+    moved = x.movedim(dim, -1)
+    leading_shape = moved.shape[:-1]
+    flat = moved.reshape(1, -1, old_size)
+    # there is no 1d cubic mode. Bicubic with a dummy axis of size 1 is the same thing
+    out = F.interpolate(flat[..., None], size=(new_size, 1), mode='bicubic', align_corners=False)[..., 0]
+    return out.reshape(*leading_shape, new_size).movedim(-1, dim)
+
+
+def _resample_data(data: torch.Tensor, new_shape: List[int], stages: List[Tuple[List[int], int]]) -> torch.Tensor:
+    if any([order >= 2 for _, order in stages]):
+        # skimage resize clips the output to the input range (clip=True), cubic interpolation overshoots
+        mn = data.reshape(data.shape[0], -1).amin(1).view(-1, *[1] * (data.ndim - 1))
+        mx = data.reshape(data.shape[0], -1).amax(1).view(-1, *[1] * (data.ndim - 1))
+    else:
+        mn, mx = None, None
+    for axes, order in stages:
+        for a in axes:
+            data = _resize_along_axis(data, a, new_shape[a], order)
+    if mn is not None:
+        data = torch.maximum(torch.minimum(data, mx), mn)
+    return data
+
+
+def _resize_label_masks(seg_c: torch.Tensor, labels: torch.Tensor, target_shape: List[int], axes: List[int],
+                        order: int) -> torch.Tensor:
+    """
+    float64 masks (one per label) of seg_c (x, y(, z)), resized along axes to target_shape
+    """
+    masks = (seg_c[None] == labels.view(-1, *[1] * seg_c.ndim)).double()
+    for a in axes:
+        masks = _resize_along_axis(masks, a, target_shape[a], order)
+    if order >= 2:
+        # skimage resize clips to the input range
+        masks.clamp_(0, 1)
+    return masks
+
+
+def _resample_seg_argmax(seg: torch.Tensor, target_shape: List[int], axes: List[int], order: int,
+                         labels_per_chunk: int = 8) -> torch.Tensor:
+    """
+    Same rule as resize_segmentation (and resize_segmentation_bbox): every label is resized as a float mask and each
+    voxel gets the label with the highest score. Exact ties go to the nearest neighbor label if it is one of the tied
+    labels, otherwise to the smallest one. labels_per_chunk masks are resized at the same time
+    """
+    out = torch.empty((seg.shape[0], *target_shape), dtype=seg.dtype, device=seg.device)
+    for c in range(seg.shape[0]):
+        labels = torch.unique(seg[c])
+        # index (into labels) of the nearest neighbor label. Nearest neighbor only copies values, so every voxel has one
+        nn = seg[c][None]
+        for a in axes:
+            nn = _resize_along_axis(nn, a, target_shape[a], 0)
+        nn_idx = torch.searchsorted(labels, nn[0].contiguous())
+        del nn
+
+        # running argmax over the labels
+        win = torch.zeros(target_shape, dtype=torch.long, device=seg.device)
+        best, nn_top = None, None
+        for l0 in range(0, len(labels), labels_per_chunk):
+            masks = _resize_label_masks(seg[c], labels[l0:l0 + labels_per_chunk], target_shape, axes, order)
+            for j in range(masks.shape[0]):
+                i = l0 + j
+                score, is_nn = masks[j], nn_idx == i
+                if best is None:
+                    best = score.clone()
+                    # does the nearest neighbor label currently share the top score?
+                    nn_top = is_nn & (score > 0)
+                    continue
+                nn_top |= (score == best) & (score > 0) & is_nn
+                better = score > best
+                nn_top = torch.where(better, is_nn, nn_top)
+                win[better] = i
+                best = torch.maximum(best, score)
+            del masks
+        win = torch.where(nn_top, nn_idx, win)
+        out[c] = labels[win]
+    return out
+
+
+def _resample_seg_overwrite(seg: torch.Tensor, target_shape: List[int], axes: List[int], order: int,
+                            labels_per_chunk: int = 8) -> torch.Tensor:
+    """
+    Rule of _resample_along_lowres_axis (separate z, order_z > 0): in ascending label order, every label is written
+    where its resized mask rounds to 1
+    """
+    out = torch.zeros((seg.shape[0], *target_shape), dtype=seg.dtype, device=seg.device)
+    for c in range(seg.shape[0]):
+        labels = torch.unique(seg[c])
+        for l0 in range(0, len(labels), labels_per_chunk):
+            masks = _resize_label_masks(seg[c], labels[l0:l0 + labels_per_chunk], target_shape, axes, order)
+            for j in range(masks.shape[0]):
+                out[c][torch.round(masks[j]) > 0.5] = labels[l0 + j]
+            del masks
+    return out
+
+
+def _resample_seg(seg: torch.Tensor, new_shape: List[int], stages: List[Tuple[List[int], int]]) -> torch.Tensor:
+    """
+    The first stage follows resize_segmentation, the second one (separate z: along the low resolution axis) follows
+    _resample_along_lowres_axis
+    """
+    for s, (axes, order) in enumerate(stages):
+        target_shape = list(seg.shape[1:])
+        for a in axes:
+            target_shape[a] = new_shape[a]
+        if target_shape == list(seg.shape[1:]):
+            continue
+        if order == 0:
+            for a in axes:
+                seg = _resize_along_axis(seg, a, target_shape[a], 0)
+        elif s == 0:
+            seg = _resample_seg_argmax(seg, target_shape, axes, order)
+        else:
+            seg = _resample_seg_overwrite(seg, target_shape, axes, order)
+    return seg
+
+
+def resample_torch_to_shape(data: Union[torch.Tensor, np.ndarray],
+                            new_shape: Union[Tuple[int, ...], List[int], np.ndarray],
+                            current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                            new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                            is_seg: bool = False,
+                            order: int = 3, order_z: int = 0,
+                            force_separate_z: Union[bool, None] = False,
+                            separate_z_anisotropy_threshold: float = ANISO_THRESHOLD,
+                            device: str = 'cpu',
+                            num_threads: int = None):
+    """
+    Drop-in alternative for resample_data_or_seg_to_shape (same arguments, same separate z handling). Use it by
+    setting resampling_fn_data / resampling_fn_probabilities / resampling_fn_seg to 'resample_torch_to_shape' in the
+    plans (kwargs stay the same, device and num_threads are optional extras).
+
+    All channels (and, with separate z, all slices) are resampled in batched torch calls, which use torch's intra-op
+    threads (num_threads, None = leave torch.get_num_threads() alone). device='cuda' runs this on the GPU.
+
+    Interpolation is separable and done axis by axis, with the sampling coordinates of the default implementation
+    (see _resize_along_axis). Segmentations follow the same rules as well: argmax with nearest neighbor tie break
+    (resize_segmentation) and, with separate z and order_z > 0, the round > 0.5 overwrite of
+    _resample_along_lowres_axis along the low resolution axis.
+    - order 0 (and order_z 0) picks the same voxels, so it gives identical results.
+    - order 1 (and order_z 1) differs only by floating point rounding: data is interpolated in float32 (unless it
+    is float64), the default uses float64. For segmentations this can in rare cases flip a voxel whose label scores
+    are tied up to rounding.
+    - order >= 2 is an approximation: cubic convolution instead of the cubic B-spline of skimage/scipy, and data is
+    clipped to the range of each channel instead of each resized image/slice. If that bothers you, only use this for
+    resampling_fn_probabilities (order 1).
+
+    Returns the same type (np.ndarray or torch.Tensor, always on CPU) and dtype as data.
+    """
+    return_numpy = isinstance(data, np.ndarray)
+    assert len(data.shape) == 4, "data must be (c, x, y, z)"
+    new_shape = [int(i) for i in new_shape]
+    assert len(new_shape) == len(data.shape) - 1
+    if list(data.shape[1:]) == new_shape:
+        return data
+
+    do_separate_z, axis = determine_do_separate_z_and_axis(current_spacing, new_spacing, force_separate_z,
+                                                           separate_z_anisotropy_threshold)
+    if do_separate_z:
+        assert len(axis) == 1, "only one anisotropic axis supported"
+        axis = int(axis[0])
+        # in-plane first, then along the anisotropic axis with order_z. Same as resample_data_or_seg
+        stages = [([a for a in range(len(new_shape)) if a != axis], order), ([axis], order_z)]
+    else:
+        stages = [(list(range(len(new_shape))), order)]
+
+    old_threads = torch.get_num_threads()
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    try:
+        with torch.no_grad():
+            x = torch.from_numpy(data) if return_numpy else data
+            dtype = x.dtype
+            x = x.to(device)
+            if is_seg:
+                out = _resample_seg(x, new_shape, stages)
+            else:
+                out = _resample_data(x.double() if dtype == torch.float64 else x.float(), new_shape, stages).to(dtype)
+            out = out.cpu()
+    finally:
+        torch.set_num_threads(old_threads)
+    return out.numpy() if return_numpy else out
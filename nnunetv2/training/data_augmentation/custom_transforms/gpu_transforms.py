@@ -0,0 +1,416 @@
+"""
+Batched torch implementations of the transforms in nnUNetTrainer.get_training_transforms. They operate on torch
+tensors (b, c, x, y(, z)) that already live on the training device and are meant to be chained with batchgenerators'
+Compose (see nnUNetTrainerGPUDA).
+
+Random parameters are drawn with np.random on the host with the same probabilities and ranges as their batchgenerators
+counterparts. Only the heavy lifting happens on the device. Interpolation is always (bi/tri)linear because
+grid_sample/interpolate have no B-spline interpolation.
+"""
+from typing import Union, Tuple, List
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from batchgenerators.augmentations.utils import create_matrix_rotation_x_3d, create_matrix_rotation_y_3d, \
+    create_matrix_rotation_z_3d, create_matrix_rotation_2d
+from batchgenerators.transforms.abstract_transforms import AbstractTransform
+
+
+def _sample_around_one(value_range: Tuple[float, float]) -> float:
+    # half of the values < 1, half > 1 (if the range allows). Used by contrast, gamma and scaling in batchgenerators
+    if np.random.random() < 0.5 and value_range[0] < 1:
+        return np.random.uniform(value_range[0], 1)
+    return np.random.uniform(max(value_range[0], 1), value_range[1])
+
+
+def _expand_to(x: torch.Tensor, ndim: int) -> torch.Tensor:
+    return x.reshape(*x.shape, *[1] * (ndim - x.ndim))
+
+
+class GPUSpatialTransform(AbstractTransform):
+    def __init__(self, patch_size: Union[Tuple[int, ...], List[int]], rotation_for_DA: dict,
+                 do_dummy_2d_data_aug: bool = False, scale: Tuple[float, float] = (0.7, 1.4),
+                 p_rot_per_sample: float = 0.2, p_scale_per_sample: float = 0.2, p_rot_per_axis: float = 1,
+                 border_cval_seg: int = -1, data_key: str = 'data', label_key: str = 'seg'):
+        """
+        Rotation + scaling like SpatialTransform (random_crop=False, no elastic deformation) as used by nnUNetTrainer.
+        Takes batches of the enlarged initial patch size and returns patch_size. Samples that are neither rotated nor
+        scaled are center cropped (no interpolation).
+
+        do_dummy_2d_data_aug: rotate and scale only axes 1 and 2 (like Convert3DTo2DTransform + SpatialTransform +
+        Convert2DTo3DTransform)
+        """
+        self.patch_size = tuple(patch_size)
+        self.rotation_for_DA = rotation_for_DA
+        self.do_dummy_2d_data_aug = do_dummy_2d_data_aug
+        self.scale = scale
+        self.p_rot_per_sample = p_rot_per_sample
+        self.p_scale_per_sample = p_scale_per_sample
+        self.p_rot_per_axis = p_rot_per_axis
+        self.border_cval_seg = border_cval_seg
+        self.data_key = data_key
+        self.label_key = label_key
+
+    def _sample_affine(self) -> Union[np.ndarray, None]:
+        """
+        returns A such that the sample coordinates are A @ zero_centered_mesh (or None if not augmented)
+        """
+        dim = len(self.patch_size)
+        aug_dim = 2 if (self.do_dummy_2d_data_aug or dim == 2) else 3
+        matrix = np.identity(aug_dim)
+        modified = False
+        if np.random.uniform() < self.p_rot_per_sample:
+            angles = [np.random.uniform(*self.rotation_for_DA[ax]) if np.random.uniform() <= self.p_rot_per_axis else 0
+                      for ax in ('x', 'y', 'z')[:1 if aug_dim == 2 else 3]]
+            if aug_dim == 2:
+                rot = create_matrix_rotation_2d(angles[0])
+            else:
+                rot = create_matrix_rotation_z_3d(angles[2], create_matrix_rotation_y_3d(
+                    angles[1], create_matrix_rotation_x_3d(angles[0], np.identity(3))))
+            # batchgenerators computes coords.T @ rot
+            matrix = rot.T @ matrix
+            modified = True
+        if np.random.uniform() < self.p_scale_per_sample:
+            matrix = matrix * _sample_around_one(self.scale)
+            modified = True
+        if not modified:
+            return None
+        if aug_dim != dim:
+            # dummy 2d: axis 0 is left alone
+            full = np.identity(dim)
+            full[1:, 1:] = matrix
+            matrix = full
+        return matrix
+
+    def __call__(self, **data_dict):
+        data = data_dict[self.data_key]
+        seg = data_dict.get(self.label_key)
+        shape = data.shape[2:]
+        dim = len(shape)
+        b = data.shape[0]
+
+        data_out = data.new_empty((b, data.shape[1], *self.patch_size))
+        seg_out = seg.new_empty((b, seg.shape[1], *self.patch_size)) if seg is not None else None
+
+        matrices = [self._sample_affine() for _ in range(b)]
+        # center crop for all samples that are not augmented
+        lbs = [(shape[d] - self.patch_size[d]) // 2 for d in range(dim)]
+        crop = tuple([slice(lbs[d], lbs[d] + self.patch_size[d]) for d in range(dim)])
+        for i in range(b):
+            if matrices[i] is None:
+                data_out[i] = data[(i, slice(None)) + crop]
+                if seg is not None:
+                    seg_out[i] = seg[(i, slice(None)) + crop]
+
+        augmented = [i for i in range(b) if matrices[i] is not None]
+        if len(augmented) > 0:
+            grid = self._get_grid(np.stack([matrices[i] for i in augmented]), shape, data.device)
+            data_out[augmented] = F.grid_sample(data[augmented].float(), grid, mode='bilinear', padding_mode='zeros',
+                                                align_corners=True).to(data.dtype)
+            if seg is not None:
+                seg_out[augmented] = self._interpolate_seg(seg[augmented], grid)
+
+        data_dict[self.data_key] = data_out
+        if seg is not None:
+            data_dict[self.label_key] = seg_out
+        return data_dict
+
+    def _get_grid(self, matrices: np.ndarray, shape: Tuple[int, ...], device: torch.device) -> torch.Tensor:
+        dim = len(shape)
+        # same as create_zero_centered_coordinate_mesh
+        mesh = torch.stack(torch.meshgrid(*[torch.arange(p, dtype=torch.float32, device=device) - (p - 1) / 2.
+                                            for p in self.patch_size], indexing='ij'))
+        matrices = torch.from_numpy(matrices).float().to(device)
+        coords = torch.einsum('kij,j...->ki...', matrices, mesh)
+        # center of the input patch (SpatialTransform: data.shape / 2 - 0.5), normalized for align_corners=True
+        center = torch.tensor([shape[d] / 2. - 0.5 for d in range(dim)], device=device)
+        size = torch.tensor([max(shape[d] - 1, 1) for d in range(dim)], dtype=torch.float32, device=device)
+        coords = (coords + _expand_to(center, coords.ndim - 1)) / _expand_to(size, coords.ndim - 1) * 2 - 1
+        # grid_sample wants (k, *patch_size, dim) with the last spatial axis first
+        return torch.flip(coords, (1,)).movedim(1, -1)
+
+    def _interpolate_seg(self, seg: torch.Tensor, grid: torch.Tensor) -> torch.Tensor:
+        # like interpolate_img(..., is_seg=True): every label is interpolated separately (out of bounds value =
+        # border_cval_seg) and wherever it reaches 0.5 it overwrites previous labels
+        result = torch.zeros((*seg.shape[:2], *grid.shape[1:-1]), dtype=seg.dtype, device=seg.device)
+        for c in range(seg.shape[1]):
+            for label in torch.unique(seg[:, c]):
+                onehot = (seg[:, c:c + 1] == label).float() - self.border_cval_seg
+                interpolated = F.grid_sample(onehot, grid, mode='bilinear', padding_mode='zeros',
+                                             align_corners=True)[:, 0] + self.border_cval_seg
+                result[:, c][interpolated >= 0.5] = label
+        return result
+
+
+class GPUGaussianNoiseTransform(AbstractTransform):
+    def __init__(self, noise_variance: Tuple[float, float] = (0, 0.1), p_per_sample: float = 1,
+                 data_key: str = 'data'):
+        """
+        like GaussianNoiseTransform (per_channel=False, p_per_channel=1). Just like there, noise_variance is actually
+        used as standard deviation
+        """
+        self.noise_variance = noise_variance
+        self.p_per_sample = p_per_sample
+        self.data_key = data_key
+
+    def __call__(self, **data_dict):
+        data = data_dict[self.data_key]
+        selected = [b for b in range(data.shape[0]) if np.random.uniform() < self.p_per_sample]
+        if len(selected) > 0:
+            std = torch.tensor([np.random.uniform(*self.noise_variance) for _ in selected], dtype=data.dtype,
+                               device=data.device)
+            data[selected] += torch.randn_like(data[selected]) * _expand_to(std, data.ndim)
+        return data_dict
+
+
+def _symmetric_pad_indices(length: int, radius: int, device: torch.device) -> torch.Tensor:
+    # scipy.ndimage mode 'reflect' (d c b a | a b c d | d c b a), works for any radius
+    idx = torch.arange(-radius, length + radius, device=device) % (2 * length)
+    return torch.where(idx >= length, 2 * length - 1 - idx, idx)
+
+
+def gaussian_blur_batched(x: torch.Tensor, sigmas: torch.Tensor) -> torch.Tensor:
+    """
+    x: (k, x, y(, z)), sigmas: (k, ). Like scipy.ndimage.gaussian_filter (truncate=4, mode='reflect') with an
+    individual sigma for each of the k images
+    """
+    k = x.shape[0]
+    radii = [int(4 * float(s) + 0.5) for s in sigmas]
+    radius = max(radii)
+    offsets = torch.arange(-radius, radius + 1, dtype=torch.float32, device=x.device)
+    kernels = torch.exp(-0.5 * (offsets[None] / sigmas[:, None].float().to(x.device)) ** 2)
+    # scipy truncates each kernel at its own radius
+    for i, r in enumerate(radii):
+        kernels[i, :radius - r] = 0
+        kernels[i, radius + r + 1:] = 0
+    kernels = (kernels / kernels.sum(1, keepdim=True))[:, None]
+
+    x = x.float()
+    for axis in range(1, x.ndim):
+        moved = x.movedim(0, -1).movedim(axis - 1, -1)
+        shp = moved.shape
+        moved = moved.reshape(-1, k, shp[-1])
+        moved = moved[..., _symmetric_pad_indices(shp[-1], radius, x.device)]
+        moved = F.conv1d(moved, kernels, groups=k).reshape(shp)
+        x = moved.movedim(-1, axis - 1).movedim(-1, 0)
+    return x
+
+
+class GPUGaussianBlurTransform(AbstractTransform):
+    def __init__(self, blur_sigma: Tuple[float, float] = (1, 5), different_sigma_per_channel: bool = True,
+                 p_per_channel: float = 1, p_per_sample: float = 1, data_key: str = 'data'):
+        """
+        like GaussianBlurTransform (isotropic sigma)
+        """
+        self.blur_sigma = blur_sigma
+        self.different_sigma_per_channel = different_sigma_per_channel
+        self.p_per_channel = p_per_channel
+        self.p_per_sample = p_per_sample
+        self.data_key = data_key
+
+    def __call__(self, **data_dict):
+        data = data_dict[self.data_key]
+        selected, sigmas = [], []
+        for b in range(data.shape[0]):
+            if np.random.uniform() < self.p_per_sample:
+                sigma = None if self.different_sigma_per_channel else np.random.uniform(*self.blur_sigma)
+                for c in range(data.shape[1]):
+                    if np.random.uniform() <= self.p_per_channel:
+                        selected.append((b, c))
+                        sigmas.append(np.random.uniform(*self.blur_sigma) if sigma is None else sigma)
+        if len(selected) > 0:
+            bs, cs = [i[0] for i in selected], [i[1] for i in selected]
+            data[bs, cs] = gaussian_blur_batched(data[bs, cs], torch.tensor(sigmas)).to(data.dtype)
+        return data_dict
+
+
+class GPUBrightnessMultiplicativeTransform(AbstractTransform):
+    def __init__(self, multiplier_range: Tuple[float, float] = (0.5, 2), p_per_sample: float = 1,
+                 data_key: str = 'data'):
+        """
+        like BrightnessMultiplicativeTransform (per_channel=True)
+        """
+        self.multiplier_range = multiplier_range
+        self.p_per_sample = p_per_sample
+        self.data_key = data_key
+
+    def __call__(self, **data_dict):
+        data = data_dict[self.data_key]
+        multipliers = torch.ones(data.shape[:2])
+        for b in range(data.shape[0]):
+            if np.random.uniform() < self.p_per_sample:
+                multipliers[b] = torch.from_numpy(np.random.uniform(*self.multiplier_range, size=data.shape[1]))
+        data *= _expand_to(multipliers.to(data.device, data.dtype), data.ndim)
+        return data_dict
+
+
+def _per_channel_stats(x: torch.Tensor):
+    flat = x.reshape(*x.shape[:2], -1)
+    return flat.mean(-1), flat.std(-1, unbiased=False), flat.amin(-1), flat.amax(-1)
+
+
+class GPUContrastAugmentationTransform(AbstractTransform):
+    def __init__(self, contrast_range: Tuple[float, float] = (0.75, 1.25), preserve_range: bool = True,
+                 p_per_sample: float = 1, data_key: str = 'data'):
+        """
+        like ContrastAugmentationTransform (per_channel=True, p_per_channel=1)
+        """
+        self.contrast_range = contrast_range
+        self.preserve_range = preserve_range
+        self.p_per_sample = p_per_sample
+        self.data_key = data_key
+
+    def __call__(self, **data_dict):
+        data = data_dict[self.data_key]
+        selected = [b for b in range(data.shape[0]) if np.random.uniform() < self.p_per_sample]
+        if len(selected) > 0:
+            factors = torch.tensor([[_sample_around_one(self.contrast_range) for _ in range(data.shape[1])]
+                                    for _ in selected], dtype=data.dtype, device=data.device)
+            x = data[selected]
+            mn, _, minm, maxm = [_expand_to(i, data.ndim) for i in _per_channel_stats(x)]
+            x = (x - mn) * _expand_to(factors, data.ndim) + mn
+            if self.preserve_range:
+                x = torch.maximum(torch.minimum(x, maxm), minm)
+            data[selected] = x
+        return data_dict
+
+
+class GPUSimulateLowResolutionTransform(AbstractTransform):
+    def __init__(self, zoom_range: Tuple[float, float] = (0.5, 1), per_channel: bool = False,
+                 p_per_channel: float = 1, p_per_sample: float = 1, ignore_axes: Tuple[int, ...] = None,
+                 data_key: str = 'data'):
+        """
+        like SimulateLowResolutionTransform: downsampling with nearest neighbor, upsampling (bi/tri)linear
+        """
+        self.zoom_range = zoom_range
+        self.per_channel = per_channel
+        self.p_per_channel = p_per_channel
+        self.p_per_sample = p_per_sample
+        self.ignore_axes = ignore_axes
+        self.data_key = data_key
+
+    def __call__(self, **data_dict):
+        data = data_dict[self.data_key]
+        shape = np.array(data.shape[2:])
+        mode = 'bilinear' if len(shape) == 2 else 'trilinear'
+        for b in range(data.shape[0]):
+            if np.random.uniform() < self.p_per_sample:
+                zoom = None if self.per_channel else np.random.uniform(*self.zoom_range)
+                for c in range(data.shape[1]):
+                    if np.random.uniform() < self.p_per_channel:
+                        z = np.random.uniform(*self.zoom_range) if zoom is None else zoom
+                        target_shape = np.round(shape * z).astype(int)
+                        if self.ignore_axes is not None:
+                            for i in self.ignore_axes:
+                                target_shape[i] = shape[i]
+                        x = data[b:b + 1, c:c + 1].float()
+                        x = F.interpolate(x, size=[int(i) for i in target_shape], mode='nearest-exact')
+                        x = F.interpolate(x, size=[int(i) for i in shape], mode=mode, align_corners=False)
+                        data[b, c] = x[0, 0].to(data.dtype)
+        return data_dict
+
+
+class GPUGammaTransform(AbstractTransform):
+    def __init__(self, gamma_range: Tuple[float, float] = (0.5, 2), invert_image: bool = False,
+                 retain_stats: bool = False, p_per_sample: float = 1, data_key: str = 'data', epsilon: float = 1e-7):
+        """
+        like GammaTransform (per_channel=True)
+        """
+        self.gamma_range = gamma_range
+        self.invert_image = invert_image
+        self.retain_stats = retain_stats
+        self.p_per_sample = p_per_sample
+        self.data_key = data_key
+        self.epsilon = epsilon
+
+    def __call__(self, **data_dict):
+        data = data_dict[self.data_key]
+        selected = [b for b in range(data.shape[0]) if np.random.uniform() < self.p_per_sample]
+        if len(selected) > 0:
+            gammas = torch.tensor([[_sample_around_one(self.gamma_range) for _ in range(data.shape[1])]
+                                   for _ in selected], dtype=torch.float32, device=data.device)
+            x = data[selected].float()
+            if self.invert_image:
+                x = -x
+            mn, sd, minm, maxm = [_expand_to(i, data.ndim) for i in _per_channel_stats(x)]
+            rnge = maxm - minm + self.epsilon
+            x = torch.pow((x - minm) / rnge, _expand_to(gammas, data.ndim)) * rnge + minm
+            if self.retain_stats:
+                new_mn, new_sd, _, _ = [_expand_to(i, data.ndim) for i in _per_channel_stats(x)]
+                x = (x - new_mn) / (new_sd + 1e-8) * sd + mn
+            if self.invert_image:
+                x = -x
+            data[selected] = x.to(data.dtype)
+        return data_dict
+
+
+class GPUMirrorTransform(AbstractTransform):
+    def __init__(self, axes: Tuple[int, ...] = (0, 1, 2), data_key: str = 'data', label_key: str = 'seg'):
+        """
+        like MirrorTransform: every axis in axes is mirrored with probability 0.5 (axes are spatial axes)
+        """
+        self.axes = axes
+        self.data_key = data_key
+        self.label_key = label_key
+
+    def __call__(self, **data_dict):
+        data = data_dict[self.data_key]
+        seg = data_dict.get(self.label_key)
+        dim = data.ndim - 2
+        for b in range(data.shape[0]):
+            flip = [a + 1 for a in range(dim) if a in self.axes and np.random.uniform() < 0.5]
+            if len(flip) > 0:
+                data[b] = torch.flip(data[b], flip)
+                if seg is not None:
+                    seg[b] = torch.flip(seg[b], flip)
+        return data_dict
+
+
+class GPUConvertSegmentationToRegionsTransform(AbstractTransform):
+    def __init__(self, regions: Union[List, Tuple], seg_key: str = "seg", output_key: str = "seg",
+                 seg_channel: int = 0):
+        """
+        like ConvertSegmentationToRegionsTransform
+        """
+        self.regions = regions
+        self.seg_key = seg_key
+        self.output_key = output_key
+        self.seg_channel = seg_channel
+
+    def __call__(self, **data_dict):
+        seg = data_dict.get(self.seg_key)
+        if seg is not None:
+            region_output = []
+            for region_source_labels in self.regions:
+                if not isinstance(region_source_labels, (list, tuple)):
+                    region_source_labels = (region_source_labels, )
+                region_output.append(torch.isin(seg[:, self.seg_channel],
+                                                torch.tensor(region_source_labels, dtype=seg.dtype, device=seg.device)))
+            data_dict[self.output_key] = torch.stack(region_output, 1).to(seg.dtype)
+        return data_dict
+
+
+class GPUDownsampleSegForDSTransform(AbstractTransform):
+    def __init__(self, ds_scales: Union[List, Tuple], input_key: str = "seg", output_key: str = "seg"):
+        """
+        like DownsampleSegForDSTransform2 with order=0 (nearest neighbor)
+        """
+        self.ds_scales = ds_scales
+        self.input_key = input_key
+        self.output_key = output_key
+
+    def __call__(self, **data_dict):
+        seg = data_dict[self.input_key]
+        dim = seg.ndim - 2
+        output = []
+        for s in self.ds_scales:
+            if not isinstance(s, (tuple, list)):
+                s = [s] * dim
+            if all([i == 1 for i in s]):
+                output.append(seg)
+            else:
+                new_shape = [int(round(seg.shape[d + 2] * s[d])) for d in range(dim)]
+                output.append(F.interpolate(seg.float(), size=new_shape, mode='nearest-exact').to(seg.dtype))
+        data_dict[self.output_key] = output
+        return data_dict
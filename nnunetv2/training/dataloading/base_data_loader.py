@@ -3,10 +3,46 @@ from typing import Union, Tuple
 from batchgenerators.dataloading.data_loader import DataLoader
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import *
+from nnunetv2.training.dataloading.foreground_location_index import CaseForegroundLocations
 from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
 
 
+def crop_and_pad_into(arr, lbs: List[int], ubs: List[int], out: Union[np.ndarray, None], pad_value,
+                      dtype=None) -> np.ndarray:
+    """
+    Crops arr (c, x, y(, z)) to [lbs, ubs) (spatial axes; bounds may lie outside of arr) and pads with pad_value
+    where they do. Only the part of the bbox that lies within arr is read, so this works well with memory mapped/lazily
+    loaded arrays. The result is written into out (c, *(ubs - lbs)), which can be a slot of a preallocated batch: the
+    valid crop is copied straight into it and only the border regions are filled with pad_value, every voxel of out is
+    written exactly once (no np.pad, no temporary arrays). If out is None a new array is allocated (dtype defaults to
+    arr.dtype)
+    """
+    shape = arr.shape[1:]
+    dim = len(shape)
+    if out is None:
+        out = np.empty((arr.shape[0], *[ubs[i] - lbs[i] for i in range(dim)]),
+                       dtype=arr.dtype if dtype is None else dtype)
+    valid_lbs = [min(max(0, lbs[i]), shape[i]) for i in range(dim)]
+    valid_ubs = [max(min(shape[i], ubs[i]), valid_lbs[i]) for i in range(dim)]
+    # border slabs. Along axis i we only cover the range that is valid in the axes before i so that the slabs don't
+    # overlap
+    inner = [slice(None)]
+    for i in range(dim):
+        # start < 0 can happen if the bbox lies entirely outside of arr
+        start = max(0, valid_lbs[i] - lbs[i])
+        end = max(start, valid_ubs[i] - lbs[i])
+        trailing = [slice(None)] * (dim - i - 1)
+        if start > 0:
+            out[tuple(inner + [slice(0, start)] + trailing)] = pad_value
+        if end < out.shape[i + 1]:
+            out[tuple(inner + [slice(end, None)] + trailing)] = pad_value
+        inner.append(slice(start, end))
+    if all([valid_ubs[i] > valid_lbs[i] for i in range(dim)]):
+        out[tuple(inner)] = arr[tuple([slice(None)] + [slice(valid_lbs[i], valid_ubs[i]) for i in range(dim)])]
+    return out
+
+
 class nnUNetDataLoaderBase(DataLoader):
     def __init__(self,
                  data: nnUNetDataset,
@@ -17,7 +53,14 @@ class nnUNetDataLoaderBase(DataLoader):
                  oversample_foreground_percent: float = 0.0,
                  sampling_probabilities: Union[List[int], Tuple[int, ...], np.ndarray] = None,
                  pad_sides: Union[List[int], Tuple[int, ...], np.ndarray] = None,
-                 probabilistic_oversampling: bool = False):
+                 probabilistic_oversampling: bool = False,
+                 reuse_batch_buffers: bool = False):
+        """
+        reuse_batch_buffers: assemble every batch in the same data/seg arrays instead of allocating new ones. The
+        returned arrays are overwritten by the next call to generate_train_batch, so only enable this if they are
+        guaranteed to be copied before that (for example by SpatialTransform, which always creates new arrays). Batches
+        that are handed to a multiprocessing queue unmodified are pickled asynchronously and would be corrupted!
+        """
         super().__init__(data, batch_size, 1, None, True, False, True, sampling_probabilities)
         assert isinstance(data, nnUNetDataset), 'nnUNetDataLoaderBase only supports dictionaries as data'
         self.indices = list(data.keys())
@@ -41,6 +84,8 @@ class nnUNetDataLoaderBase(DataLoader):
         self.has_ignore = label_manager.has_ignore_label
         self.get_do_oversample = self._oversample_last_XX_percent if not probabilistic_oversampling \
             else self._probabilistic_oversampling
+        self.reuse_batch_buffers = reuse_batch_buffers
+        self._batch_buffers = None
 
     def _oversample_last_XX_percent(self, sample_idx: int) -> bool:
         """
@@ -52,6 +97,19 @@ class nnUNetDataLoaderBase(DataLoader):
         # print('YEAH BOIIIIII')
         return np.random.uniform() < self.oversample_foreground_percent
 
+    def get_batch_buffers(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        data and seg arrays for the next batch. They are NOT initialized, generate_train_batch must write every voxel
+        (crop_and_pad_into does)
+        """
+        if not self.reuse_batch_buffers:
+            return np.empty(self.data_shape, dtype=np.float32), np.empty(self.seg_shape, dtype=np.int16)
+        if self._batch_buffers is None or self._batch_buffers[0].shape != tuple(self.data_shape) or \
+                self._batch_buffers[1].shape != tuple(self.seg_shape):
+            self._batch_buffers = (np.empty(self.data_shape, dtype=np.float32),
+                                   np.empty(self.seg_shape, dtype=np.int16))
+        return self._batch_buffers
+
     def determine_shapes(self):
         # load one case
         data, seg, properties = self._data.load_case(self.indices[0])
@@ -61,6 +119,13 @@ class nnUNetDataLoaderBase(DataLoader):
         seg_shape = (self.batch_size, seg.shape[0], *self.patch_size)
         return data_shape, seg_shape
 
+    @staticmethod
+    def get_eligible_classes_or_regions(class_locations: Union[dict, CaseForegroundLocations]) -> list:
+        if isinstance(class_locations, CaseForegroundLocations):
+            # precomputed, no need to look at the locations
+            return class_locations.eligible_keys()
+        return [i for i in class_locations.keys() if len(class_locations[i]) > 0]
+
     def get_bbox(self, data_shape: np.ndarray, force_fg: bool, class_locations: Union[dict, None],
                  overwrite_class: Union[int, Tuple[int, ...]] = None, verbose: bool = False):
         # in dataloader 2d we need to select the slice prior to this and also modify the class_locations to only have
@@ -99,7 +164,7 @@ class nnUNetDataLoaderBase(DataLoader):
                                                                       'have class_locations (missing key)'
                 # this saves us a np.unique. Preprocessing already did that for all cases. Neat.
                 # class_locations keys can also be tuple
-                eligible_classes_or_regions = [i for i in class_locations.keys() if len(class_locations[i]) > 0]
+                eligible_classes_or_regions = self.get_eligible_classes_or_regions(class_locations)
 
                 # if we have annotated_classes_key locations and other classes are present, remove the annotated_classes_key from the list
                 # strange formulation needed to circumvent
@@ -1,14 +1,14 @@
 import numpy as np
-from nnunetv2.training.dataloading.base_data_loader import nnUNetDataLoaderBase
+from nnunetv2.training.dataloading.base_data_loader import nnUNetDataLoaderBase, crop_and_pad_into
 from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
 
 
 class nnUNetDataLoader2D(nnUNetDataLoaderBase):
     def generate_train_batch(self):
         selected_keys = self.get_indices()
-        # preallocate memory for data and seg
-        data_all = np.zeros(self.data_shape, dtype=np.float32)
-        seg_all = np.zeros(self.seg_shape, dtype=np.int16)
+        # preallocated (and possibly reused, see reuse_batch_buffers) memory for data and seg. Not initialized, every
+        # voxel is written below
+        data_all, seg_all = self.get_batch_buffers()
         case_properties = []
 
         for j, current_key in enumerate(selected_keys):
@@ -26,7 +26,7 @@ class nnUNetDataLoader2D(nnUNetDataLoaderBase):
                     selected_class_or_region = None
             else:
                 # filter out all classes that are not present here
-                eligible_classes_or_regions = [i for i in properties['class_locations'].keys() if len(properties['class_locations'][i]) > 0]
+                eligible_classes_or_regions = self.get_eligible_classes_or_regions(properties['class_locations'])
 
                 # if we have annotated_classes_key locations and other classes are present, remove the annotated_classes_key from the list
                 # strange formulation needed to circumvent
@@ -41,7 +41,7 @@ class nnUNetDataLoader2D(nnUNetDataLoaderBase):
             if selected_class_or_region is not None:
                 selected_slice = np.random.choice(properties['class_locations'][selected_class_or_region][:, 1])
             else:
-                selected_slice = np.random.choice(len(data[0]))
+                selected_slice = np.random.choice(data.shape[1])
 
             data = data[:, selected_slice]
             seg = seg[:, selected_slice]
@@ -59,30 +59,13 @@ class nnUNetDataLoader2D(nnUNetDataLoaderBase):
 
             # print(properties)
             shape = data.shape[1:]
-            dim = len(shape)
             bbox_lbs, bbox_ubs = self.get_bbox(shape, force_fg if selected_class_or_region is not None else None,
                                                class_locations, overwrite_class=selected_class_or_region)
 
-            # whoever wrote this knew what he was doing (hint: it was me). We first crop the data to the region of the
-            # bbox that actually lies within the data. This will result in a smaller array which is then faster to pad.
-            # valid_bbox is just the coord that lied within the data cube. It will be padded to match the patch size
-            # later
-            valid_bbox_lbs = [max(0, bbox_lbs[i]) for i in range(dim)]
-            valid_bbox_ubs = [min(shape[i], bbox_ubs[i]) for i in range(dim)]
-
-            # At this point you might ask yourself why we would treat seg differently from seg_from_previous_stage.
-            # Why not just concatenate them here and forget about the if statements? Well that's because segneeds to
-            # be padded with -1 constant whereas seg_from_previous_stage needs to be padded with 0s (we could also
-            # remove label -1 in the data augmentation but this way it is less error prone)
-            this_slice = tuple([slice(0, data.shape[0])] + [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
-            data = data[this_slice]
-
-            this_slice = tuple([slice(0, seg.shape[0])] + [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
-            seg = seg[this_slice]
-
-            padding = [(-min(0, bbox_lbs[i]), max(bbox_ubs[i] - shape[i], 0)) for i in range(dim)]
-            data_all[j] = np.pad(data, ((0, 0), *padding), 'constant', constant_values=0)
-            seg_all[j] = np.pad(seg, ((0, 0), *padding), 'constant', constant_values=-1)
+            # only the part of the bbox that lies within the data is read and copied straight into the batch, the rest
+            # (border) is filled with the padding value. seg is padded with -1, data with 0
+            crop_and_pad_into(data, bbox_lbs, bbox_ubs, data_all[j], 0)
+            crop_and_pad_into(seg, bbox_lbs, bbox_ubs, seg_all[j], -1)
 
         return {'data': data_all, 'seg': seg_all, 'properties': case_properties, 'keys': selected_keys}
 
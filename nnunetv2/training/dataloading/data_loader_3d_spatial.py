@@ -0,0 +1,157 @@
+from typing import Union, Tuple, List
+
+import numpy as np
+from batchgenerators.augmentations.utils import create_zero_centered_coordinate_mesh, rotate_coords_3d, \
+    rotate_coords_2d, scale_coords, interpolate_img
+
+from nnunetv2.training.dataloading.base_data_loader import crop_and_pad_into
+from nnunetv2.training.dataloading.data_loader_3d import nnUNetDataLoader3D
+from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
+from nnunetv2.utilities.label_handling.label_handling import LabelManager
+
+
+class nnUNetDataLoader3DSpatialAug(nnUNetDataLoader3D):
+    def __init__(self,
+                 data: nnUNetDataset,
+                 batch_size: int,
+                 patch_size: Union[List[int], Tuple[int, ...], np.ndarray],
+                 final_patch_size: Union[List[int], Tuple[int, ...], np.ndarray],
+                 label_manager: LabelManager,
+                 oversample_foreground_percent: float = 0.0,
+                 sampling_probabilities: Union[List[int], Tuple[int, ...], np.ndarray] = None,
+                 pad_sides: Union[List[int], Tuple[int, ...], np.ndarray] = None,
+                 probabilistic_oversampling: bool = False,
+                 reuse_batch_buffers: bool = False,
+                 rotation_for_DA: dict = None,
+                 do_dummy_2d_data_aug: bool = False,
+                 scale: Tuple[float, float] = (0.7, 1.4),
+                 p_rot_per_sample: float = 0.2,
+                 p_scale_per_sample: float = 0.2,
+                 p_rot_per_axis: float = 1,
+                 order_data: int = 3,
+                 order_seg: int = 1,
+                 border_cval_seg: int = -1):
+        """
+        Crop-then-augment: does the job of nnUNetDataLoader3D followed by the SpatialTransform of
+        nnUNetTrainer.get_training_transforms (rotation + scaling, same probabilities and parameter ranges). Returns
+        batches of final_patch_size, so the training transforms must NOT contain SpatialTransform anymore.
+
+        The regular pipeline pads and copies a patch of patch_size (= initial_patch_size, which is enlarged so that
+        rotated/scaled patches still cover final_patch_size) for every sample, only for SpatialTransform to
+        interpolate final_patch_size out of it. Here we compute the coordinate grid of the spatial transform first and
+        only read the region of the (memory mapped) case that these coordinates need. Samples that are not
+        rotated/scaled (the majority) are cropped to final_patch_size right away.
+
+        The bbox is still sampled with patch_size and the transform is centered on it, so foreground oversampling
+        behaves the same. Results are identical to the regular pipeline up to border effects: where the rotated
+        coordinates leave the enlarged patch we see actual image content instead of padding.
+
+        do_dummy_2d_data_aug: rotation and scaling are applied to axes 1 and 2 only (slice by slice), like
+        Convert3DTo2DTransform + SpatialTransform + Convert2DTo3DTransform
+        """
+        super().__init__(data, batch_size, patch_size, final_patch_size, label_manager, oversample_foreground_percent,
+                         sampling_probabilities, pad_sides, probabilistic_oversampling, reuse_batch_buffers)
+        # the batches we return have final_patch_size
+        self.data_shape = (self.data_shape[0], self.data_shape[1], *final_patch_size)
+        self.seg_shape = (self.seg_shape[0], self.seg_shape[1], *final_patch_size)
+        self.rotation_for_DA = rotation_for_DA if rotation_for_DA is not None else \
+            {'x': (0, 0), 'y': (0, 0), 'z': (0, 0)}
+        self.do_dummy_2d_data_aug = do_dummy_2d_data_aug
+        self.scale = scale
+        self.p_rot_per_sample = p_rot_per_sample
+        self.p_scale_per_sample = p_scale_per_sample
+        self.p_rot_per_axis = p_rot_per_axis
+        self.order_data = order_data
+        self.order_seg = order_seg
+        self.border_cval_seg = border_cval_seg
+        # spline prefiltering (order > 1) looks beyond the neighboring voxels. Its influence decays exponentially, 8
+        # voxels of context are plenty
+        self.margin = 8 if max(order_data, order_seg) > 1 else 1
+
+    def sample_coordinates(self) -> Union[np.ndarray, None]:
+        """
+        zero centered coordinates of the final patch after rotation/scaling (same random draws as augment_spatial).
+        None if this sample is neither rotated nor scaled
+        """
+        patch_size = self.final_patch_size[1:] if self.do_dummy_2d_data_aug else self.final_patch_size
+        dim = len(patch_size)
+        coords = create_zero_centered_coordinate_mesh(patch_size)
+        modified_coords = False
+        if np.random.uniform() < self.p_rot_per_sample:
+            angles = []
+            for ax in ('x', 'y', 'z')[:1 if dim == 2 else 3]:
+                if np.random.uniform() <= self.p_rot_per_axis:
+                    angles.append(np.random.uniform(*self.rotation_for_DA[ax]))
+                else:
+                    angles.append(0)
+            coords = rotate_coords_3d(coords, *angles) if dim == 3 else rotate_coords_2d(coords, angles[0])
+            modified_coords = True
+        if np.random.uniform() < self.p_scale_per_sample:
+            if np.random.random() < 0.5 and self.scale[0] < 1:
+                sc = np.random.uniform(self.scale[0], 1)
+            else:
+                sc = np.random.uniform(max(self.scale[0], 1), self.scale[1])
+            coords = scale_coords(coords, sc)
+            modified_coords = True
+        return coords if modified_coords else None
+
+    def generate_train_batch(self):
+        selected_keys = self.get_indices()
+        # every voxel is written below (crop_and_pad_into or interpolate_img)
+        data_all, seg_all = self.get_batch_buffers()
+        case_properties = []
+        # axes rotation/scaling is applied to
+        aug_axes = [1, 2] if self.do_dummy_2d_data_aug else [0, 1, 2]
+
+        for j, i in enumerate(selected_keys):
+            force_fg = self.get_do_oversample(j)
+            data, seg, properties = self._data.load_case(i)
+            case_properties.append(properties)
+
+            shape = data.shape[1:]
+            bbox_lbs, bbox_ubs = self.get_bbox(shape, force_fg, properties['class_locations'])
+            # center of the enlarged patch, in the coordinates of the case. SpatialTransform uses
+            # data.shape / 2 - 0.5 of the enlarged patch
+            center = [bbox_lbs[d] + self.patch_size[d] / 2. - 0.5 for d in range(3)]
+
+            coords = self.sample_coordinates()
+            if coords is None:
+                # center crop of the enlarged patch. Read only that
+                lbs = [bbox_lbs[d] + (self.patch_size[d] - self.final_patch_size[d]) // 2 for d in range(3)]
+                ubs = [lbs[d] + self.final_patch_size[d] for d in range(3)]
+                crop_and_pad_into(data, lbs, ubs, data_all[j], 0)
+                crop_and_pad_into(seg, lbs, ubs, seg_all[j], self.border_cval_seg)
+                continue
+
+            for k, d in enumerate(aug_axes):
+                coords[k] += center[d]
+            # region of the case that is needed for interpolation
+            lbs, ubs = [None] * 3, [None] * 3
+            for k, d in enumerate(aug_axes):
+                lbs[d] = int(np.floor(coords[k].min())) - self.margin
+                ubs[d] = int(np.ceil(coords[k].max())) + 1 + self.margin
+                coords[k] -= lbs[d]
+            if self.do_dummy_2d_data_aug:
+                # axis 0 is not augmented, center crop
+                lbs[0] = bbox_lbs[0] + (self.patch_size[0] - self.final_patch_size[0]) // 2
+                ubs[0] = lbs[0] + self.final_patch_size[0]
+            region_data = crop_and_pad_into(data, lbs, ubs, None, 0)
+            region_seg = crop_and_pad_into(seg, lbs, ubs, None, self.border_cval_seg, dtype=np.int16)
+
+            for c in range(region_data.shape[0]):
+                if self.do_dummy_2d_data_aug:
+                    for s in range(region_data.shape[1]):
+                        data_all[j, c, s] = interpolate_img(region_data[c, s], coords, self.order_data, 'constant',
+                                                            cval=0)
+                else:
+                    data_all[j, c] = interpolate_img(region_data[c], coords, self.order_data, 'constant', cval=0)
+            for c in range(region_seg.shape[0]):
+                if self.do_dummy_2d_data_aug:
+                    for s in range(region_seg.shape[1]):
+                        seg_all[j, c, s] = interpolate_img(region_seg[c, s], coords, self.order_seg, 'constant',
+                                                           cval=self.border_cval_seg, is_seg=True)
+                else:
+                    seg_all[j, c] = interpolate_img(region_seg[c], coords, self.order_seg, 'constant',
+                                                    cval=self.border_cval_seg, is_seg=True)
+
+        return {'data': data_all, 'seg': seg_all, 'properties': case_properties, 'keys': selected_keys}
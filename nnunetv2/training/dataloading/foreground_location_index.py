@@ -0,0 +1,156 @@
+import os
+import uuid
+from collections.abc import Mapping
+from typing import List, Union, Tuple, Callable
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import join, isfile, load_json, save_json, load_pickle
+
+from nnunetv2.training.dataloading.utils import get_case_identifiers
+
+INDEX_LOCATIONS_FILE = 'foreground_locations.npy'
+INDEX_OFFSETS_FILE = 'foreground_locations_offsets.npy'
+INDEX_META_FILE = 'foreground_locations.json'
+
+
+def _encode_key(k: Union[int, Tuple[int, ...]]):
+    return list(k) if isinstance(k, tuple) else k
+
+
+def _decode_key(k: Union[int, List[int]]):
+    return tuple(k) if isinstance(k, list) else k
+
+
+def _save_atomically(filename: str, save_fn: Callable[[str], None]):
+    # the temporary file must be in the same folder (same file system), otherwise os.replace is not atomic. Keep the
+    # extension, np.save would append .npy otherwise
+    base, ext = os.path.splitext(filename)
+    tmp = f'{base}.{os.getpid()}_{uuid.uuid4().hex[:8]}.tmp{ext}'
+    try:
+        save_fn(tmp)
+        os.replace(tmp, filename)
+    finally:
+        if isfile(tmp):
+            os.remove(tmp)
+
+
+def build_foreground_location_index(folder: str, case_identifiers: List[str] = None):
+    """
+    Collects properties['class_locations'] of all cases in folder (preprocessed data) into one contiguous array:
+    - foreground_locations.npy: (num_locations, 1 + dim) int32, all locations of all cases and classes
+    - foreground_locations_offsets.npy: (num_cases, num_classes + 1) int64. Locations of class j in case i are
+    locations[offsets[i, j]:offsets[i, j + 1]]
+    - foreground_locations.json: case identifiers and class keys (the order of the rows/columns in offsets)
+    """
+    if case_identifiers is None:
+        case_identifiers = get_case_identifiers(folder)
+    case_identifiers = sorted(case_identifiers)
+
+    class_keys = None
+    all_locations = []
+    offsets = None
+    current = 0
+    for i, c in enumerate(case_identifiers):
+        class_locations = load_pickle(join(folder, c + '.pkl'))['class_locations']
+        if class_keys is None:
+            class_keys = list(class_locations.keys())
+            offsets = np.zeros((len(case_identifiers), len(class_keys) + 1), dtype=np.int64)
+        assert set(class_locations.keys()) == set(class_keys), \
+            f'case {c} has different class_locations keys than the other cases'
+        offsets[i, 0] = current
+        for j, k in enumerate(class_keys):
+            locs = class_locations[k]
+            if len(locs) > 0:
+                all_locations.append(np.asarray(locs, dtype=np.int32))
+                current += len(locs)
+            offsets[i, j + 1] = current
+
+    if class_keys is None:
+        # no cases
+        class_keys = []
+        offsets = np.zeros((0, 1), dtype=np.int64)
+    locations = np.concatenate(all_locations) if len(all_locations) > 0 else np.zeros((0, 4), dtype=np.int32)
+    # Several trainings (folds) may share this folder and memory map the index while we rebuild it. Never modify the
+    # files in place: write to a temporary file and atomically replace. Processes that still have the old file open
+    # keep seeing the old (complete) version
+    _save_atomically(join(folder, INDEX_LOCATIONS_FILE), lambda f: np.save(f, locations))
+    _save_atomically(join(folder, INDEX_OFFSETS_FILE), lambda f: np.save(f, offsets))
+    # written last. Its presence marks a complete index
+    _save_atomically(join(folder, INDEX_META_FILE),
+                     lambda f: save_json({'case_identifiers': case_identifiers,
+                                          'class_keys': [_encode_key(k) for k in class_keys]}, f, sort_keys=False))
+
+
+def foreground_location_index_is_up_to_date(folder: str, case_identifiers: List[str] = None) -> bool:
+    """
+    the index must exist, contain all cases and be newer than all properties files
+    """
+    if not isfile(join(folder, INDEX_META_FILE)):
+        return False
+    if case_identifiers is None:
+        case_identifiers = get_case_identifiers(folder)
+    indexed = set(load_json(join(folder, INDEX_META_FILE))['case_identifiers'])
+    if any([i not in indexed for i in case_identifiers]):
+        return False
+    index_time = os.path.getmtime(join(folder, INDEX_META_FILE))
+    return all([os.path.getmtime(join(folder, i + '.pkl')) <= index_time for i in case_identifiers])
+
+
+def maybe_build_foreground_location_index(folder: str, case_identifiers: List[str] = None) -> bool:
+    """
+    returns True if the index had to be (re)built
+    """
+    if foreground_location_index_is_up_to_date(folder, case_identifiers):
+        return False
+    build_foreground_location_index(folder, case_identifiers)
+    return True
+
+
+class ForegroundLocationIndex(object):
+    def __init__(self, folder: str):
+        """
+        Read-only access to the index created by build_foreground_location_index. The locations are memory mapped,
+        so all data augmentation workers share the same pages. Per case and class counts are precomputed, which makes
+        finding the classes present in a case and picking a location O(1) array lookups
+        """
+        meta = load_json(join(folder, INDEX_META_FILE))
+        self.case_identifiers = meta['case_identifiers']
+        self.case_to_idx = {c: i for i, c in enumerate(self.case_identifiers)}
+        self.class_keys = [_decode_key(k) for k in meta['class_keys']]
+        self.class_to_idx = {k: j for j, k in enumerate(self.class_keys)}
+        self.locations = np.load(join(folder, INDEX_LOCATIONS_FILE), mmap_mode='r')
+        self.offsets = np.load(join(folder, INDEX_OFFSETS_FILE))
+        self.counts = np.diff(self.offsets, axis=1)
+
+    def __contains__(self, case_identifier: str):
+        return case_identifier in self.case_to_idx.keys()
+
+    def get_case(self, case_identifier: str) -> 'CaseForegroundLocations':
+        return CaseForegroundLocations(self, self.case_to_idx[case_identifier])
+
+
+class CaseForegroundLocations(Mapping):
+    def __init__(self, index: ForegroundLocationIndex, case_idx: int):
+        """
+        drop-in replacement for properties['class_locations'] of one case. Values are views into the memory mapped
+        index (empty classes have shape (0, 1 + dim) instead of being an empty list)
+        """
+        self.index = index
+        self.case_idx = case_idx
+
+    def __getitem__(self, key):
+        j = self.index.class_to_idx[key]
+        start, end = self.index.offsets[self.case_idx, j], self.index.offsets[self.case_idx, j + 1]
+        return self.index.locations[start:end]
+
+    def __iter__(self):
+        return iter(self.index.class_keys)
+
+    def __len__(self):
+        return len(self.index.class_keys)
+
+    def eligible_keys(self) -> list:
+        """
+        keys of all classes/regions that have locations in this case
+        """
+        return [self.index.class_keys[j] for j in np.flatnonzero(self.index.counts[self.case_idx])]
@@ -1,4 +1,5 @@
 import os
+from collections import OrderedDict
 from typing import List
 
 import numpy as np
@@ -6,18 +7,22 @@ import shutil
 
 from batchgenerators.utilities.file_and_folder_operations import join, load_pickle, isfile
 from nnunetv2.training.dataloading.utils import get_case_identifiers
+from nnunetv2.utilities.preprocessed_storage import open_preprocessed_array
 
 
 class nnUNetDataset(object):
     def __init__(self, folder: str, case_identifiers: List[str] = None,
                  num_images_properties_loading_threshold: int = 0,
-                 folder_with_segs_from_previous_stage: str = None):
+                 folder_with_segs_from_previous_stage: str = None,
+                 properties_cache_size_MB: float = 64):
         """
         This does not actually load the dataset. It merely creates a dictionary where the keys are training case names and
         the values are dictionaries containing the relevant information for that case.
         dataset[training_case] -> info
         Info has the following key:value pairs:
         - dataset[case_identifier]['properties']['data_file'] -> the full path to the npz file associated with the training case
+        (the npz file may not exist if the data was stored in another format, see
+        nnunetv2.utilities.preprocessed_storage. load_case takes care of that)
         - dataset[case_identifier]['properties']['properties_file'] -> the pkl file containing the case properties
 
         In addition, if the total number of cases is < num_images_properties_loading_threshold we load all the pickle files
@@ -29,6 +34,11 @@ class nnUNetDataset(object):
         If properties are loaded into the RAM, the info dicts each will have an additional entry:
         - dataset[case_identifier]['properties'] -> pkl file content
 
+        Properties that are loaded on the fly are kept in an LRU cache of at most properties_cache_size_MB (the size
+        is dominated by the class_locations arrays). This cache exists separately in every process that uses the
+        dataset (so once per data augmentation worker). Set properties_cache_size_MB to 0 to disable it.
+        The returned properties may come from the cache, so don't modify them!
+
         IMPORTANT! THIS CLASS ITSELF IS READ-ONLY. YOU CANNOT ADD KEY:VALUE PAIRS WITH nnUNetDataset[key] = value
         USE THIS INSTEAD:
         nnUNetDataset.dataset[key] = value
@@ -56,12 +66,43 @@ class nnUNetDataset(object):
                                (os.environ['nnUNet_keep_files_open'].lower() in ('true', '1', 't'))
         # print(f'nnUNetDataset.keep_files_open: {self.keep_files_open}')
 
+        self.properties_cache_size_bytes = int(properties_cache_size_MB * 1e6)
+        self._properties_cache = OrderedDict()
+        self._properties_cache_bytes = 0
+
+        # optional SharedCaseCache (see nnunetv2.training.dataloading.shared_case_cache). Set by the trainer
+        self.case_cache = None
+        # optional ForegroundLocationIndex (see nnunetv2.training.dataloading.foreground_location_index). Set by the
+        # trainer. If present, load_case returns properties that ONLY contain class_locations (that's all the data
+        # loaders need) and the pkl files are not read at all
+        self.foreground_index = None
+
     def __getitem__(self, key):
         ret = {**self.dataset[key]}
         if 'properties' not in ret.keys():
-            ret['properties'] = load_pickle(ret['properties_file'])
+            ret['properties'] = self._load_properties(key)
         return ret
 
+    @staticmethod
+    def _estimate_properties_nbytes(properties: dict) -> int:
+        # class_locations arrays make up almost all of it. 1 kB for everything else
+        class_locations = properties.get('class_locations', {})
+        return 1000 + sum([i.nbytes for i in class_locations.values() if isinstance(i, np.ndarray)])
+
+    def _load_properties(self, key) -> dict:
+        if key in self._properties_cache.keys():
+            self._properties_cache.move_to_end(key)
+            return self._properties_cache[key][0]
+        properties = load_pickle(self.dataset[key]['properties_file'])
+        nbytes = self._estimate_properties_nbytes(properties)
+        if nbytes <= self.properties_cache_size_bytes:
+            while self._properties_cache_bytes + nbytes > self.properties_cache_size_bytes:
+                _, (_, evicted_nbytes) = self._properties_cache.popitem(last=False)
+                self._properties_cache_bytes -= evicted_nbytes
+            self._properties_cache[key] = (properties, nbytes)
+            self._properties_cache_bytes += nbytes
+        return properties
+
     def __setitem__(self, key, value):
         return self.dataset.__setitem__(key, value)
 
@@ -78,37 +119,50 @@ class nnUNetDataset(object):
         return self.dataset.values()
 
     def load_case(self, key):
-        entry = self[key]
+        if self.foreground_index is not None and key in self.foreground_index:
+            properties = {'class_locations': self.foreground_index.get_case(key)}
+        else:
+            properties = self[key]['properties']
+        if self.case_cache is not None:
+            cached = self.case_cache.get(key)
+            if cached is not None:
+                return cached[0], cached[1], properties
+        data, seg = self.load_case_arrays(key)
+        return data, seg, properties
+
+    def load_case_arrays(self, key):
+        """
+        data and seg of case key straight from disk (without properties and ignoring case_cache)
+        """
+        entry = self.dataset[key]
+        # data and seg are memory mapped (npy), lazily decompressed (blosc2) or loaded from the npz file. Slice them,
+        # don't assume they are np.ndarrays (use data[:] if you need everything)
         if 'open_data_file' in entry.keys():
             data = entry['open_data_file']
             # print('using open data file')
-        elif isfile(entry['data_file'][:-4] + ".npy"):
-            data = np.load(entry['data_file'][:-4] + ".npy", 'r')
-            if self.keep_files_open:
+        else:
+            data, memory_mapped = open_preprocessed_array(entry['data_file'][:-4], 'data')
+            if memory_mapped and self.keep_files_open:
                 self.dataset[key]['open_data_file'] = data
                 # print('saving open data file')
-        else:
-            data = np.load(entry['data_file'])['data']
 
         if 'open_seg_file' in entry.keys():
             seg = entry['open_seg_file']
             # print('using open data file')
-        elif isfile(entry['data_file'][:-4] + "_seg.npy"):
-            seg = np.load(entry['data_file'][:-4] + "_seg.npy", 'r')
-            if self.keep_files_open:
+        else:
+            seg, memory_mapped = open_preprocessed_array(entry['data_file'][:-4], 'seg')
+            if memory_mapped and self.keep_files_open:
                 self.dataset[key]['open_seg_file'] = seg
                 # print('saving open seg file')
-        else:
-            seg = np.load(entry['data_file'])['seg']
 
         if 'seg_from_prev_stage_file' in entry.keys():
             if isfile(entry['seg_from_prev_stage_file'][:-4] + ".npy"):
                 seg_prev = np.load(entry['seg_from_prev_stage_file'][:-4] + ".npy", 'r')
             else:
                 seg_prev = np.load(entry['seg_from_prev_stage_file'])['seg']
-            seg = np.vstack((seg, seg_prev[None]))
+            seg = np.vstack((seg[:], seg_prev[None]))
 
-        return data, seg, entry['properties']
+        return data, seg
 
 
 if __name__ == '__main__':
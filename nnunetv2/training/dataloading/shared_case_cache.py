@@ -0,0 +1,239 @@
+import atexit
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from multiprocessing import Queue, RawArray, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty, Full
+from typing import List, Callable, Tuple, Union
+
+import numpy as np
+
+_HEADER_BYTES = 1024
+_ALIGNMENT = 64
+
+
+def _aligned(nbytes: int) -> int:
+    return (nbytes + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _attach_shared_memory(name: str) -> SharedMemory:
+    # python < 3.13 registers attached segments with the resource tracker, which then unlinks them when the attaching
+    # process exits (and complains about leaks). Only the process that created the segment must do that
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedCaseCache(object):
+    def __init__(self, keys: List[str], load_fn: Callable[[str], Tuple[np.ndarray, np.ndarray]],
+                 budget_bytes: int, cleanup_every: int = 32):
+        """
+        In-RAM cache of preprocessed cases (data and seg) that is shared by all data augmentation workers.
+
+        The cache is owned by the process that creates it (the main process). A background thread fills it by
+        loading cases with load_fn (key -> (data, seg)) until budget_bytes are used up. Every case lives in its own
+        shared memory segment. Workers map these segments and get np.ndarrays that point right into them, no copies
+        and no disk access.
+
+        If the dataset does not fit, the cache is managed as LRU: workers report which case they used (hit or
+        miss) and the background thread moves cached cases to the end of the LRU and loads missed cases, evicting
+        the least recently used ones to make room. Workers never wait for that, on a miss they load from disk as
+        usual (get returns None).
+
+        Hand this object to the data augmentation workers together with the dataset (it can be pickled when
+        starting processes). Call close() in the owner when done (also happens at exit).
+        """
+        self.keys = list(keys)
+        self.key_to_idx = {k: i for i, k in enumerate(self.keys)}
+        self.budget_bytes = int(budget_bytes)
+        self.cleanup_every = cleanup_every
+
+        # generation of the segment that currently holds each case. 0 = not cached. Segment names are derived from it
+        self._directory = RawArray('q', len(self.keys))
+        self._access_queue = Queue(maxsize=100000)
+        self._prefix = f'nnunet_{uuid.uuid4().hex[:10]}'
+        self._owner_pid = os.getpid()
+
+        # owner only
+        self._load_fn = load_fn
+        self._lru = OrderedDict()
+        self._used_bytes = 0
+        self._generation = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._maintenance_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+        # every process
+        self._init_process_state()
+
+    def _init_process_state(self):
+        self._attached = {}
+        self._zombies = []
+        self._num_accesses = 0
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def __getstate__(self):
+        state = {k: v for k, v in self.__dict__.items() if k not in
+                 ('_load_fn', '_lru', '_stop_event', '_thread', '_attached', '_zombies')}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_fn = None
+        self._lru = OrderedDict()
+        self._stop_event = None
+        self._thread = None
+        self._init_process_state()
+
+    def _is_owner(self) -> bool:
+        return os.getpid() == self._owner_pid
+
+    def _segment_name(self, idx: int, generation: int) -> str:
+        return f'{self._prefix}_{idx}_{generation}'
+
+    def get(self, key: str) -> Union[Tuple[np.ndarray, np.ndarray], None]:
+        """
+        returns (data, seg) if key is cached, else None. The arrays point into shared memory. Don't modify them!
+        """
+        idx = self.key_to_idx.get(key)
+        if idx is None:
+            return None
+        try:
+            self._access_queue.put_nowait(idx)
+        except Full:
+            pass
+
+        self._num_accesses += 1
+        if self._num_accesses % self.cleanup_every == 0:
+            self._release_stale()
+
+        generation = self._directory[idx]
+        if generation == 0:
+            self.num_misses += 1
+            return None
+        entry = self._attached.get(idx)
+        if entry is None or entry[0] != generation:
+            if entry is not None:
+                self._release(idx)
+            try:
+                shm = _attach_shared_memory(self._segment_name(idx, generation))
+            except FileNotFoundError:
+                # was evicted in the meantime
+                self.num_misses += 1
+                return None
+            header = json.loads(bytes(shm.buf[:_HEADER_BYTES]).rstrip(b'\x00').decode('utf-8'))
+            arrays = [np.ndarray(header[k][0], dtype=np.dtype(header[k][1]), buffer=shm.buf, offset=header[k][2])
+                      for k in ('data', 'seg')]
+            for a in arrays:
+                a.flags.writeable = False
+            entry = (generation, shm, arrays[0], arrays[1])
+            self._attached[idx] = entry
+        self.num_hits += 1
+        return entry[2], entry[3]
+
+    def _release(self, idx: int):
+        _, shm, _, _ = self._attached.pop(idx)
+        self._zombies.append(shm)
+        self._close_zombies()
+
+    def _close_zombies(self):
+        remaining = []
+        for shm in self._zombies:
+            try:
+                shm.close()
+            except BufferError:
+                # somebody still holds a view of this segment. Try again later
+                remaining.append(shm)
+        self._zombies = remaining
+
+    def _release_stale(self):
+        # unmap segments of cases that were evicted so that their memory can actually be freed
+        for idx in [i for i, e in self._attached.items() if self._directory[i] != e[0]]:
+            self._release(idx)
+        self._close_zombies()
+
+    def _insert(self, idx: int, data: np.ndarray, seg: np.ndarray, allow_eviction: bool = True) -> bool:
+        nbytes = _HEADER_BYTES + _aligned(data.nbytes) + _aligned(seg.nbytes)
+        if nbytes > self.budget_bytes or (not allow_eviction and self._used_bytes + nbytes > self.budget_bytes):
+            return False
+        while self._used_bytes + nbytes > self.budget_bytes:
+            self._evict(next(iter(self._lru)))
+        self._generation += 1
+        shm = SharedMemory(name=self._segment_name(idx, self._generation), create=True, size=nbytes)
+        offsets = (_HEADER_BYTES, _HEADER_BYTES + _aligned(data.nbytes))
+        header = {'data': (data.shape, data.dtype.str, offsets[0]), 'seg': (seg.shape, seg.dtype.str, offsets[1])}
+        header = json.dumps(header).encode('utf-8')
+        assert len(header) <= _HEADER_BYTES
+        shm.buf[:len(header)] = header
+        for a, offset in zip((data, seg), offsets):
+            np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf, offset=offset)[:] = a
+        self._lru[idx] = (shm, nbytes)
+        self._used_bytes += nbytes
+        # only publish the segment once it is complete
+        self._directory[idx] = self._generation
+        return True
+
+    def _evict(self, idx: int):
+        shm, nbytes = self._lru.pop(idx)
+        self._directory[idx] = 0
+        self._used_bytes -= nbytes
+        # processes that have it mapped keep their mapping until they release it
+        shm.unlink()
+        shm.close()
+
+    def _load(self, idx: int):
+        data, seg = self._load_fn(self.keys[idx])
+        return np.ascontiguousarray(data[:]), np.ascontiguousarray(seg[:])
+
+    def _maintenance_loop(self):
+        try:
+            # initial fill in the order of the keys
+            for idx in range(len(self.keys)):
+                if self._stop_event.is_set():
+                    return
+                if not self._insert(idx, *self._load(idx), allow_eviction=False):
+                    break
+
+            while not self._stop_event.is_set():
+                try:
+                    accessed = [self._access_queue.get(timeout=0.1)]
+                except Empty:
+                    continue
+                while True:
+                    try:
+                        accessed.append(self._access_queue.get_nowait())
+                    except Empty:
+                        break
+                for idx in accessed:
+                    if idx in self._lru.keys():
+                        self._lru.move_to_end(idx)
+                # only load the most recent miss. Loading is slow and everything else is stale by then
+                missed = [i for i in accessed if i not in self._lru.keys()]
+                if len(missed) > 0 and not self._stop_event.is_set():
+                    self._insert(missed[-1], *self._load(missed[-1]))
+        except Exception as e:
+            # the cache is optional. Workers simply load from disk if it stops working
+            print(f'SharedCaseCache: maintenance thread died with exception {e}')
+            raise e
+
+    def get_summary(self) -> str:
+        return f'case cache: {len(self._lru)} of {len(self.keys)} cases cached, ' \
+               f'{self._used_bytes / 1e9:.2f} of {self.budget_bytes / 1e9:.2f} GB used'
+
+    def close(self):
+        if not self._is_owner() or self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        for idx in list(self._lru.keys()):
+            self._evict(idx)
+        self._release_stale()
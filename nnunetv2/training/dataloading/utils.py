@@ -6,6 +6,7 @@ from typing import List
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import isfile, subfiles
 from nnunetv2.configuration import default_num_processes
+from nnunetv2.utilities.preprocessed_storage import PREPROCESSED_DATA_SUFFIXES
 
 
 def _convert_to_npy(npz_file: str, unpack_segmentation: bool = True, overwrite_existing: bool = False) -> None:
@@ -38,9 +39,17 @@ def unpack_dataset(folder: str, unpack_segmentation: bool = True, overwrite_exis
 
 def get_case_identifiers(folder: str) -> List[str]:
     """
-    finds all npz files in the given folder and reconstructs the training case names from them
+    finds all preprocessed cases (in any storage format, see nnunetv2.utilities.preprocessed_storage) in the given
+    folder and reconstructs the training case names from them
     """
-    case_identifiers = [i[:-4] for i in os.listdir(folder) if i.endswith("npz") and (i.find("segFromPrevStage") == -1)]
+    files = os.listdir(folder)
+    case_identifiers = [i[:-4] for i in files if i.endswith("npz") and (i.find("segFromPrevStage") == -1)]
+    # uncompressed/blosc2 storage formats have no npz files. Every case has a pkl file though. Sets, this runs on
+    # folders with many thousands of files
+    files_set = set(files)
+    found = set(case_identifiers)
+    case_identifiers += [i[:-4] for i in files if i.endswith(".pkl") and i[:-4] not in found and
+                         any([i[:-4] + j in files_set for j in PREPROCESSED_DATA_SUFFIXES])]
     return case_identifiers
 
 
@@ -42,7 +42,10 @@ from nnunetv2.training.data_augmentation.custom_transforms.transforms_for_dummy_
     Convert3DTo2DTransform
 from nnunetv2.training.dataloading.data_loader_2d import nnUNetDataLoader2D
 from nnunetv2.training.dataloading.data_loader_3d import nnUNetDataLoader3D
+from nnunetv2.training.dataloading.foreground_location_index import ForegroundLocationIndex, \
+    maybe_build_foreground_location_index, foreground_location_index_is_up_to_date
 from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
+from nnunetv2.training.dataloading.shared_case_cache import SharedCaseCache
 from nnunetv2.training.dataloading.utils import get_case_identifiers, unpack_dataset
 from nnunetv2.training.logging.nnunet_logger import nnUNetLogger
 from nnunetv2.training.loss.compound_losses import DC_and_CE_loss, DC_and_BCE_loss
@@ -51,7 +54,7 @@ from nnunetv2.training.loss.dice import get_tp_fp_fn_tn, MemoryEfficientSoftDice
 from nnunetv2.training.lr_scheduler.polylr import PolyLRScheduler
 from nnunetv2.utilities.collate_outputs import collate_outputs
 from nnunetv2.utilities.default_n_proc_DA import get_allowed_n_proc_DA
-from nnunetv2.utilities.file_path_utilities import check_workers_alive_and_busy
+from nnunetv2.utilities.export_backpressure import ExportBackpressure
 from nnunetv2.utilities.get_network_from_plans import get_network_from_plans
 from nnunetv2.utilities.helpers import empty_cache, dummy_context
 from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot, determine_num_input_channels
@@ -144,6 +147,13 @@ class nnUNetTrainer(object):
         self.num_val_iterations_per_epoch = 50
         self.num_epochs = 1000
         self.current_epoch = 0
+        # RAM (in GB, per GPU) for caching preprocessed cases in shared memory so that the data augmentation workers
+        # don't have to read them from disk over and over again. 0 disables the cache. See SharedCaseCache
+        self.case_cache_size_GB = float(os.environ['nnUNet_case_cache_GB']) \
+            if 'nnUNet_case_cache_GB' in os.environ.keys() else 0.
+        # sample foreground locations from one memory mapped index instead of the pkl files (see
+        # ForegroundLocationIndex). It is built in on_train_start
+        self.use_foreground_location_index = True
 
         ### Dealing with labels/regions
         self.label_manager = self.plans_manager.get_label_manager(dataset_json)
@@ -168,6 +178,7 @@ class nnUNetTrainer(object):
 
         ### placeholders
         self.dataloader_train = self.dataloader_val = None  # see on_train_start
+        self.case_cache = None  # see get_plain_dataloaders
 
         ### initializing stuff for remembering things and such
         self._best_ema = None
@@ -610,6 +621,11 @@ class nnUNetTrainer(object):
                                                         ignore_label=self.label_manager.ignore_label)
 
         dl_tr, dl_val = self.get_plain_dataloaders(initial_patch_size, dim)
+        # SpatialTransform always writes its result into new arrays, so the training data loader can assemble all
+        # batches in the same buffers. Without it batches may still wait to be pickled into the worker queue while the
+        # next one is assembled (validation, variants without spatial augmentation)
+        dl_tr.reuse_batch_buffers = any([isinstance(t, SpatialTransform) for t in
+                                         getattr(tr_transforms, 'transforms', [])])
 
         allowed_num_processes = get_allowed_n_proc_DA()
         if allowed_num_processes == 0:
@@ -625,8 +641,38 @@ class nnUNetTrainer(object):
                                            wait_time=0.02)
         return mt_gen_train, mt_gen_val
 
+    def configure_case_cache(self, dataset_tr: nnUNetDataset, dataset_val: nnUNetDataset):
+        """
+        one cache for training and validation cases. Training cases are cached first
+        """
+        if self.case_cache_size_GB <= 0:
+            return
+        keys = list(dataset_tr.keys()) + [i for i in dataset_val.keys() if i not in dataset_tr.keys()]
+
+        def load_fn(key):
+            return (dataset_tr if key in dataset_tr.keys() else dataset_val).load_case_arrays(key)
+
+        self.case_cache = SharedCaseCache(keys, load_fn, int(self.case_cache_size_GB * 1e9))
+        dataset_tr.case_cache = self.case_cache
+        dataset_val.case_cache = self.case_cache
+        self.print_to_log_file(f'Caching up to {self.case_cache_size_GB} GB of preprocessed cases in shared memory')
+
+    def configure_foreground_location_index(self, dataset_tr: nnUNetDataset, dataset_val: nnUNetDataset):
+        if not self.use_foreground_location_index:
+            return
+        if not foreground_location_index_is_up_to_date(self.preprocessed_dataset_folder,
+                                                       list(dataset_tr.keys()) + list(dataset_val.keys())):
+            self.print_to_log_file('Foreground location index is missing or outdated. Falling back to the '
+                                   'class_locations in the pkl files')
+            return
+        index = ForegroundLocationIndex(self.preprocessed_dataset_folder)
+        dataset_tr.foreground_index = index
+        dataset_val.foreground_index = index
+
     def get_plain_dataloaders(self, initial_patch_size: Tuple[int, ...], dim: int):
         dataset_tr, dataset_val = self.get_tr_and_val_datasets()
+        self.configure_case_cache(dataset_tr, dataset_val)
+        self.configure_foreground_location_index(dataset_tr, dataset_val)
 
         if dim == 2:
             dl_tr = nnUNetDataLoader2D(dataset_tr, self.batch_size,
@@ -805,6 +851,10 @@ class nnUNetTrainer(object):
                            num_processes=max(1, round(get_allowed_n_proc_DA() // 2)))
             self.print_to_log_file('unpacking done...')
 
+        if self.use_foreground_location_index and self.local_rank == 0:
+            if maybe_build_foreground_location_index(self.preprocessed_dataset_folder):
+                self.print_to_log_file('built foreground location index')
+
         if self.is_ddp:
             dist.barrier()
 
@@ -849,6 +899,10 @@ class nnUNetTrainer(object):
                 self.dataloader_val._finish()
             sys.stdout = old_stdout
 
+        if self.case_cache is not None:
+            self.print_to_log_file(self.case_cache.get_summary())
+            self.case_cache.close()
+
         empty_cache(self.device)
         self.print_to_log_file("Training done.")
 
@@ -1111,7 +1165,7 @@ class nnUNetTrainer(object):
                                         self.inference_allowed_mirroring_axes)
 
         with multiprocessing.get_context("spawn").Pool(default_num_processes) as segmentation_export_pool:
-            worker_list = [i for i in segmentation_export_pool._pool]
+            backpressure = ExportBackpressure(segmentation_export_pool)
             validation_output_folder = join(self.output_folder, 'validation')
             maybe_mkdir_p(validation_output_folder)
 
@@ -1130,18 +1184,13 @@ class nnUNetTrainer(object):
             if next_stages is not None:
                 _ = [maybe_mkdir_p(join(self.output_folder_base, 'predicted_next_stage', n)) for n in next_stages]
 
-            results = []
-
             for k in dataset_val.keys():
-                proceed = not check_workers_alive_and_busy(segmentation_export_pool, worker_list, results,
-                                                 allowed_num_queued=2)
-                while not proceed:
-                    sleep(0.1)
-                    proceed = not check_workers_alive_and_busy(segmentation_export_pool, worker_list, results,
-                                                     allowed_num_queued=2)
+                backpressure.wait()
 
                 self.print_to_log_file(f"predicting {k}")
                 data, seg, properties = dataset_val.load_case(k)
+                # depending on the storage format data can be a lazy array (blosc2). We need all of it
+                data = data[:]
 
                 if self.is_cascaded:
                     data = np.vstack((data, convert_labelmap_to_one_hot(seg[-1], self.label_manager.foreground_labels,
@@ -1163,13 +1212,11 @@ class nnUNetTrainer(object):
                 prediction = prediction.cpu()
 
                 # this needs to go into background processes
-                results.append(
-                    segmentation_export_pool.starmap_async(
-                        export_prediction_from_logits, (
-                            (prediction, properties, self.configuration_manager, self.plans_manager,
-                             self.dataset_json, output_filename_truncated, save_probabilities),
-                        )
-                    )
+                backpressure.submit(
+                    export_prediction_from_logits,
+                    (prediction, properties, self.configuration_manager, self.plans_manager,
+                     self.dataset_json, output_filename_truncated, save_probabilities),
+                    prediction.element_size() * prediction.nelement()
                 )
                 # for debug purposes
                 # export_prediction(prediction_for_export, properties, self.configuration, self.plans, self.dataset_json,
@@ -1199,16 +1246,16 @@ class nnUNetTrainer(object):
 
                         # resample_and_save(prediction, target_shape, output_file, self.plans_manager, self.configuration_manager, properties,
                         #                   self.dataset_json)
-                        results.append(segmentation_export_pool.starmap_async(
-                            resample_and_save, (
-                                (prediction, target_shape, output_file, self.plans_manager,
-                                 self.configuration_manager,
-                                 properties,
-                                 self.dataset_json),
-                            )
-                        ))
-
-            _ = [r.get() for r in results]
+                        backpressure.submit(
+                            resample_and_save,
+                            (prediction, target_shape, output_file, self.plans_manager,
+                             self.configuration_manager,
+                             properties,
+                             self.dataset_json)
+                        )
+
+            _ = backpressure.get_results()
+            self.print_to_log_file(backpressure.get_summary())
 
         if self.is_ddp:
             dist.barrier()
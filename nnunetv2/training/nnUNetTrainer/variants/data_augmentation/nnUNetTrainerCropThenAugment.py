@@ -0,0 +1,70 @@
+from typing import Union, Tuple, List
+
+import numpy as np
+from batchgenerators.transforms.abstract_transforms import AbstractTransform, Compose
+from batchgenerators.transforms.spatial_transforms import SpatialTransform
+
+from nnunetv2.training.data_augmentation.custom_transforms.transforms_for_dummy_2d import Convert2DTo3DTransform, \
+    Convert3DTo2DTransform
+from nnunetv2.training.dataloading.data_loader_3d import nnUNetDataLoader3D
+from nnunetv2.training.dataloading.data_loader_3d_spatial import nnUNetDataLoader3DSpatialAug
+from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
+
+
+class nnUNetTrainerCropThenAugment(nnUNetTrainer):
+    """
+    3D configurations only (2D trains like nnUNetTrainer). Rotation and scaling are done by the data loader
+    (nnUNetDataLoader3DSpatialAug), which only reads the region of each case that the transformed patch actually
+    covers instead of cropping and padding the enlarged initial patch for SpatialTransform
+    """
+    @staticmethod
+    def get_training_transforms(patch_size: Union[np.ndarray, Tuple[int]],
+                                rotation_for_DA: dict,
+                                deep_supervision_scales: Union[List, Tuple],
+                                mirror_axes: Tuple[int, ...],
+                                do_dummy_2d_data_aug: bool,
+                                order_resampling_data: int = 3,
+                                order_resampling_seg: int = 1,
+                                border_val_seg: int = -1,
+                                use_mask_for_norm: List[bool] = None,
+                                is_cascaded: bool = False,
+                                foreground_labels: Union[Tuple[int, ...], List[int]] = None,
+                                regions: List[Union[List[int], Tuple[int, ...], int]] = None,
+                                ignore_label: int = None) -> AbstractTransform:
+        tr_transforms = nnUNetTrainer.get_training_transforms(
+            patch_size, rotation_for_DA, deep_supervision_scales, mirror_axes, do_dummy_2d_data_aug,
+            order_resampling_data, order_resampling_seg, border_val_seg, use_mask_for_norm, is_cascaded,
+            foreground_labels, regions, ignore_label)
+        if len(patch_size) == 2:
+            return tr_transforms
+        # the data loader takes care of these
+        return Compose([t for t in tr_transforms.transforms if not
+                        isinstance(t, (SpatialTransform, Convert3DTo2DTransform, Convert2DTo3DTransform))])
+
+    def get_plain_dataloaders(self, initial_patch_size: Tuple[int, ...], dim: int):
+        if dim == 2:
+            return super().get_plain_dataloaders(initial_patch_size, dim)
+
+        dataset_tr, dataset_val = self.get_tr_and_val_datasets()
+        self.configure_case_cache(dataset_tr, dataset_val)
+        self.configure_foreground_location_index(dataset_tr, dataset_val)
+
+        rotation_for_DA, do_dummy_2d_data_aug, _, _ = self.configure_rotation_dummyDA_mirroring_and_inital_patch_size()
+        # same parameters as the SpatialTransform in nnUNetTrainer.get_training_transforms
+        dl_tr = nnUNetDataLoader3DSpatialAug(dataset_tr, self.batch_size,
+                                             initial_patch_size,
+                                             self.configuration_manager.patch_size,
+                                             self.label_manager,
+                                             oversample_foreground_percent=self.oversample_foreground_percent,
+                                             sampling_probabilities=None, pad_sides=None,
+                                             rotation_for_DA=rotation_for_DA,
+                                             do_dummy_2d_data_aug=do_dummy_2d_data_aug,
+                                             scale=(0.7, 1.4), p_rot_per_sample=0.2, p_scale_per_sample=0.2,
+                                             p_rot_per_axis=1, order_data=3, order_seg=1, border_cval_seg=-1)
+        dl_val = nnUNetDataLoader3D(dataset_val, self.batch_size,
+                                    self.configuration_manager.patch_size,
+                                    self.configuration_manager.patch_size,
+                                    self.label_manager,
+                                    oversample_foreground_percent=self.oversample_foreground_percent,
+                                    sampling_probabilities=None, pad_sides=None)
+        return dl_tr, dl_val
@@ -0,0 +1,106 @@
+from typing import Union, Tuple, List
+
+import numpy as np
+import torch
+from batchgenerators.transforms.abstract_transforms import AbstractTransform, Compose
+from batchgenerators.transforms.utility_transforms import RemoveLabelTransform, RenameTransform, NumpyToTensor
+
+from nnunetv2.training.data_augmentation.custom_transforms.gpu_transforms import GPUSpatialTransform, \
+    GPUGaussianNoiseTransform, GPUGaussianBlurTransform, GPUBrightnessMultiplicativeTransform, \
+    GPUContrastAugmentationTransform, GPUSimulateLowResolutionTransform, GPUGammaTransform, GPUMirrorTransform, \
+    GPUConvertSegmentationToRegionsTransform, GPUDownsampleSegForDSTransform
+from nnunetv2.training.data_augmentation.custom_transforms.masking import MaskTransform
+from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
+
+
+class nnUNetTrainerGPUDA(nnUNetTrainer):
+    """
+    The data augmentation workers only crop (patches of the enlarged initial patch size, padded seg = -1). Everything
+    else of nnUNetTrainer.get_training_transforms runs batched on the training device at the beginning of train_step
+    (see get_gpu_training_transforms), with the same probabilities and parameter ranges. Validation is unchanged.
+    Not available for the cascade (its augmentations are morphological operations that stay on the CPU)
+    """
+    def initialize(self):
+        assert not self.is_cascaded, 'nnUNetTrainerGPUDA does not support cascaded training'
+        super().initialize()
+
+    @staticmethod
+    def get_training_transforms(patch_size: Union[np.ndarray, Tuple[int]],
+                                rotation_for_DA: dict,
+                                deep_supervision_scales: Union[List, Tuple],
+                                mirror_axes: Tuple[int, ...],
+                                do_dummy_2d_data_aug: bool,
+                                order_resampling_data: int = 3,
+                                order_resampling_seg: int = 1,
+                                border_val_seg: int = -1,
+                                use_mask_for_norm: List[bool] = None,
+                                is_cascaded: bool = False,
+                                foreground_labels: Union[Tuple[int, ...], List[int]] = None,
+                                regions: List[Union[List[int], Tuple[int, ...], int]] = None,
+                                ignore_label: int = None) -> AbstractTransform:
+        # workers only crop, see get_gpu_training_transforms
+        return Compose([NumpyToTensor(['data', 'seg'], 'float')])
+
+    @staticmethod
+    def get_gpu_training_transforms(patch_size: Union[np.ndarray, Tuple[int]],
+                                    rotation_for_DA: dict,
+                                    deep_supervision_scales: Union[List, Tuple],
+                                    mirror_axes: Tuple[int, ...],
+                                    do_dummy_2d_data_aug: bool,
+                                    border_val_seg: int = -1,
+                                    use_mask_for_norm: List[bool] = None,
+                                    regions: List[Union[List[int], Tuple[int, ...], int]] = None,
+                                    ignore_label: int = None) -> AbstractTransform:
+        tr_transforms = []
+        tr_transforms.append(GPUSpatialTransform(
+            patch_size, rotation_for_DA, do_dummy_2d_data_aug, scale=(0.7, 1.4), p_rot_per_sample=0.2,
+            p_scale_per_sample=0.2, p_rot_per_axis=1, border_cval_seg=border_val_seg))
+
+        tr_transforms.append(GPUGaussianNoiseTransform(p_per_sample=0.1))
+        tr_transforms.append(GPUGaussianBlurTransform((0.5, 1.), different_sigma_per_channel=True, p_per_sample=0.2,
+                                                      p_per_channel=0.5))
+        tr_transforms.append(GPUBrightnessMultiplicativeTransform(multiplier_range=(0.75, 1.25), p_per_sample=0.15))
+        tr_transforms.append(GPUContrastAugmentationTransform(p_per_sample=0.15))
+        tr_transforms.append(GPUSimulateLowResolutionTransform(zoom_range=(0.5, 1), per_channel=True,
+                                                               p_per_channel=0.5, p_per_sample=0.25,
+                                                               ignore_axes=(0,) if do_dummy_2d_data_aug else None))
+        tr_transforms.append(GPUGammaTransform((0.7, 1.5), True, retain_stats=True, p_per_sample=0.1))
+        tr_transforms.append(GPUGammaTransform((0.7, 1.5), False, retain_stats=True, p_per_sample=0.3))
+
+        if mirror_axes is not None and len(mirror_axes) > 0:
+            tr_transforms.append(GPUMirrorTransform(mirror_axes))
+
+        # MaskTransform, RemoveLabelTransform and RenameTransform work on tensors as well
+        if use_mask_for_norm is not None and any(use_mask_for_norm):
+            tr_transforms.append(MaskTransform([i for i in range(len(use_mask_for_norm)) if use_mask_for_norm[i]],
+                                               mask_idx_in_seg=0, set_outside_to=0))
+
+        tr_transforms.append(RemoveLabelTransform(-1, 0))
+        tr_transforms.append(RenameTransform('seg', 'target', True))
+
+        if regions is not None:
+            # the ignore label must also be converted
+            tr_transforms.append(GPUConvertSegmentationToRegionsTransform(list(regions) + [ignore_label]
+                                                                          if ignore_label is not None else regions,
+                                                                          'target', 'target'))
+
+        if deep_supervision_scales is not None:
+            tr_transforms.append(GPUDownsampleSegForDSTransform(deep_supervision_scales, input_key='target',
+                                                                output_key='target'))
+        return Compose(tr_transforms)
+
+    def get_dataloaders(self):
+        rotation_for_DA, do_dummy_2d_data_aug, _, mirror_axes = \
+            self.configure_rotation_dummyDA_mirroring_and_inital_patch_size()
+        self.gpu_transforms = self.get_gpu_training_transforms(
+            self.configuration_manager.patch_size, rotation_for_DA, self._get_deep_supervision_scales(), mirror_axes,
+            do_dummy_2d_data_aug, use_mask_for_norm=self.configuration_manager.use_mask_for_norm,
+            regions=self.label_manager.foreground_regions if self.label_manager.has_regions else None,
+            ignore_label=self.label_manager.ignore_label)
+        return super().get_dataloaders()
+
+    def train_step(self, batch: dict) -> dict:
+        with torch.no_grad():
+            batch = self.gpu_transforms(data=batch['data'].to(self.device, non_blocking=True),
+                                        seg=batch['seg'].to(self.device, non_blocking=True))
+        return super().train_step(batch)
@@ -0,0 +1,146 @@
+import threading
+from multiprocessing.pool import Pool
+from time import time, sleep
+from typing import Callable, Union
+
+import numpy as np
+import torch
+
+from nnunetv2.utilities.file_path_utilities import check_workers_alive_and_busy
+from nnunetv2.utilities.helpers import get_available_memory
+
+
+def _timed_call(fn: Callable, args: tuple):
+    start = time()
+    ret = fn(*args)
+    return ret, start, time()
+
+
+class ExportBackpressure(object):
+    def __init__(self, export_pool: Pool,
+                 min_num_queued: int = 1,
+                 max_num_queued: int = 16,
+                 max_ram_fraction: float = 0.5,
+                 poll_interval: float = 0.01,
+                 smoothing: float = 0.3):
+        """
+        Decides when the main process may hand the next prediction to export_pool. Replaces the
+        check_workers_alive_and_busy(..., allowed_num_queued=2) + sleep(0.1) loop.
+
+        Usage: wait() -> predict -> submit(fn, args, nbytes) for each case, then get_results().
+
+        The number of items that may wait in the queue (on top of the ones being processed by the workers) is
+        adapted to what we observe:
+        - time: enough items to bridge one export (export_time / predict_time). If exporting is fast we never queue
+        much, if it is slow we keep the GPU busy a little longer
+        - RAM: every item in the pool holds its logits in memory, so no more than max_ram_fraction of the available
+        RAM may be spent on them (based on nbytes passed to submit)
+        The result is clipped to [min_num_queued, max_num_queued]. Times are exponential moving averages (smoothing).
+
+        get_metrics() tells you where the time went. A lot of stall_time means we are export bound (more export
+        workers will help), no stall_time means we are prediction bound
+        """
+        self.export_pool = export_pool
+        self.worker_list = [i for i in export_pool._pool]
+        self.min_num_queued = min_num_queued
+        self.max_num_queued = max_num_queued
+        self.max_ram_fraction = max_ram_fraction
+        self.poll_interval = poll_interval
+        self.smoothing = smoothing
+
+        self.results = []
+        self._lock = threading.Lock()
+        self._wait_end = None
+        self.predict_time = None
+        self.export_time = None
+        self.item_bytes = None
+        self.stall_time = 0.
+        self.num_stalls = 0
+        self.total_predict_time = 0.
+        self.total_export_time = 0.
+        self.queue_depths = []
+
+    def _ema(self, old: Union[float, None], new: float) -> float:
+        return new if old is None else (1 - self.smoothing) * old + self.smoothing * new
+
+    def get_num_pending(self) -> int:
+        return sum([not i.ready() for i in self.results])
+
+    def get_allowed_num_queued(self) -> int:
+        if self.export_time is None or self.predict_time is None:
+            # nothing observed yet, same as before
+            allowed = 2
+        else:
+            allowed = int(np.ceil(self.export_time / max(self.predict_time, 1e-3)))
+        if self.item_bytes is not None and self.item_bytes > 0:
+            ram_budget = get_available_memory(torch.device('cpu')) * self.max_ram_fraction
+            # the items being exported right now hold memory as well
+            allowed = min(allowed, int(ram_budget // self.item_bytes) - len(self.worker_list))
+        return int(np.clip(allowed, self.min_num_queued, self.max_num_queued))
+
+    def wait(self) -> float:
+        """
+        blocks until another item may be submitted. Returns how long we stalled
+        """
+        start = time()
+        stalled = False
+        while check_workers_alive_and_busy(self.export_pool, self.worker_list, self.results,
+                                           self.get_allowed_num_queued()):
+            stalled = True
+            sleep(self.poll_interval)
+        stall = time() - start
+        if stalled:
+            self.stall_time += stall
+            self.num_stalls += 1
+        self._wait_end = time()
+        return stall if stalled else 0.
+
+    def submit(self, fn: Callable, args: tuple, nbytes: int = None):
+        """
+        runs fn(*args) in export_pool. nbytes is how much memory the item occupies while it is in the pool (None if
+        negligible, for example if the logits are passed as a file)
+        """
+        if self._wait_end is not None:
+            # everything between wait() and submit() is prediction
+            predict_time = time() - self._wait_end
+            self.predict_time = self._ema(self.predict_time, predict_time)
+            self.total_predict_time += predict_time
+            self._wait_end = None
+        if nbytes is not None:
+            self.item_bytes = self._ema(self.item_bytes, nbytes)
+        self.queue_depths.append(self.get_num_pending())
+        self.results.append(self.export_pool.apply_async(_timed_call, (fn, args), callback=self._on_done))
+
+    def _on_done(self, ret):
+        # runs in the result handler thread of the pool
+        _, start, end = ret
+        with self._lock:
+            self.export_time = self._ema(self.export_time, end - start)
+            self.total_export_time += end - start
+
+    def get_results(self) -> list:
+        """
+        blocks until all items are done. Returns the return values of fn in the order in which they were submitted
+        """
+        return [i.get()[0] for i in self.results]
+
+    def get_metrics(self) -> dict:
+        return {
+            'num_items': len(self.results),
+            'mean_queue_depth': float(np.mean(self.queue_depths)) if len(self.queue_depths) > 0 else 0.,
+            'max_queue_depth': int(np.max(self.queue_depths)) if len(self.queue_depths) > 0 else 0,
+            'stall_time': self.stall_time,
+            'num_stalls': self.num_stalls,
+            'total_predict_time': self.total_predict_time,
+            'total_export_time': self.total_export_time,
+            'mean_export_time': self.export_time,
+            'mean_predict_time': self.predict_time,
+            'bound': 'export' if self.stall_time > 0.1 * self.total_predict_time else 'prediction'
+        }
+
+    def get_summary(self) -> str:
+        m = self.get_metrics()
+        return f"export backpressure: {m['num_items']} items, queue depth mean {m['mean_queue_depth']:.2f} max " \
+               f"{m['max_queue_depth']}, stalled {m['num_stalls']} times for {m['stall_time']:.1f} s in total " \
+               f"(prediction took {m['total_predict_time']:.1f} s, export {m['total_export_time']:.1f} s " \
+               f"summed over workers) -> {m['bound']} bound"
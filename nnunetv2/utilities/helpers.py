@@ -1,3 +1,5 @@
+import os
+
 import torch
 
 
@@ -19,6 +21,20 @@ def empty_cache(device: torch.device):
         pass
 
 
+def get_available_memory(device: torch.device) -> int:
+    """
+    returns the number of bytes that are currently available on device. For anything other than cuda this is the
+    available system RAM (mps uses unified memory). This is a rough estimate, don't expect miracles
+    """
+    if device.type == 'cuda':
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        # sysconf is not available on all platforms (Windows, yo). Assume we have a modest 4GB to spare
+        return 4 * 1024 ** 3
+
+
 class dummy_context(object):
     def __enter__(self):
         pass
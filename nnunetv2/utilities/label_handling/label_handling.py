@@ -208,6 +208,21 @@ class LabelManager(object):
         probs_reverted_cropping[tuple([slice(None)] + list(slicer))] = predicted_probabilities
         return probs_reverted_cropping
 
+    def get_background_logits(self, dtype: torch.dtype = torch.float16, device: torch.device = torch.device('cpu'),
+                              confidence: float = 10.) -> torch.Tensor:
+        """
+        Returns logits of shape (num_segmentation_heads, ) that will be converted to background by
+        convert_logits_to_segmentation. Used to fill regions we did not bother to predict (see
+        nnUNetPredictor.skip_empty_tiles). confidence is the magnitude of the logits. Don't make it too large because
+        these logits are averaged with actual predictions of overlapping tiles.
+
+        Only LabelManager knows how this needs to be done (same as revert_cropping_on_probabilities)
+        """
+        logits = torch.full((self.num_segmentation_heads, ), -confidence, dtype=dtype, device=device)
+        if not self.has_regions:
+            logits[0] = confidence
+        return logits
+
     @staticmethod
     def filter_background(classes_or_regions: Union[List[int], List[Union[int, Tuple[int, ...]]]]):
         # heck yeah
@@ -22,7 +22,9 @@ from nnunetv2.configuration import default_num_processes
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 from nnunetv2.imageio.reader_writer_registry import determine_reader_writer_from_dataset_json
 from nnunetv2.paths import nnUNet_raw, nnUNet_preprocessed
+from nnunetv2.training.dataloading.utils import get_case_identifiers
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
+from nnunetv2.utilities.preprocessed_storage import open_preprocessed_array
 from nnunetv2.utilities.utils import get_identifiers_from_splitted_dataset_folder, \
     get_filenames_of_train_images_and_targets
 
@@ -151,8 +153,10 @@ def plot_overlay(image_file: str, segmentation_file: str, image_reader_writer: B
 
 def plot_overlay_preprocessed(case_file: str, output_file: str, overlay_intensity: float = 0.6, channel_idx=0):
     import matplotlib.pyplot as plt
-    data = np.load(case_file)['data']
-    seg = np.load(case_file)['seg'][0]
+    # case_file is the truncated file name of a preprocessed case (no file ending), see
+    # nnunetv2.utilities.preprocessed_storage
+    data = open_preprocessed_array(case_file, 'data')[0][:]
+    seg = np.array(open_preprocessed_array(case_file, 'seg')[0][:][0])
 
     assert channel_idx < (data.shape[0]), 'This dataset only supports channel index up to %d' % (data.shape[0] - 1)
 
@@ -230,10 +234,10 @@ def generate_overlays_from_preprocessed(dataset_name_or_id: Union[int, str], out
                            f"{plans_identifier} ({dataset_name}) does not exist. Run preprocessing for this "
                            f"configuration first!")
 
-    identifiers = [i[:-4] for i in subfiles(preprocessed_folder, suffix='.npz', join=False)]
+    identifiers = get_case_identifiers(preprocessed_folder)
 
     output_files = [join(output_folder, i + '.png') for i in identifiers]
-    image_files = [join(preprocessed_folder, i + ".npz") for i in identifiers]
+    image_files = [join(preprocessed_folder, i) for i in identifiers]
 
     maybe_mkdir_p(output_folder)
     multiprocessing_plot_overlay_preprocessed(image_files, output_files, overlay_intensity=overlay_intensity,
@@ -52,6 +52,11 @@ class ConfigurationManager(object):
                                                          current_module="nnunetv2.preprocessing")
         return preprocessor_class
 
+    @property
+    def preprocessed_storage_format(self) -> str:
+        # see nnunetv2.utilities.preprocessed_storage
+        return self.configuration.get('preprocessed_storage_format', 'npz')
+
     @property
     def batch_size(self) -> int:
         return self.configuration['batch_size']
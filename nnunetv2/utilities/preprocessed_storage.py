@@ -0,0 +1,214 @@
+import os
+from typing import Union, Tuple, List
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import isfile, load_json, save_json
+
+try:
+    import blosc2
+except ImportError:
+    blosc2 = None
+
+# How preprocessed cases are stored on disk. Every case consists of a properties file (CASE.pkl) plus its data and seg
+# arrays in one of these formats (selected per configuration with 'preprocessed_storage_format' in the plans):
+# - 'npz' (default): CASE.npz (np.savez_compressed, keys data and seg). Small on disk but zlib is slow to decompress.
+# The trainer unpacks it to CASE.npy/CASE_seg.npy before training (unpack_dataset)
+# - 'npy': CASE.npy and CASE_seg.npy. Uncompressed, memory mapped directly. No unpacking needed, uses as much disk space
+# as the unpacked npz format
+# - 'blosc2': CASE.b2nd and CASE_seg.b2nd. Chunked blosc2 (LZ4HC + shuffle) arrays, memory mapped. Only the chunks we
+# actually slice are decompressed, which is fast. Smallest footprint for training. Requires the blosc2 package
+# (pip install blosc2)
+# - 'npy_tiled': CASE.tiled.npy and CASE_seg.tiled.npy (+ CASE.tiled.json with the shapes). Uncompressed but stored
+# tile by tile (see TiledArray), memory mapped. A patch only reads the tiles it intersects instead of all the rows
+# that span the entire volume. Good for large volumes on network file systems
+PREPROCESSED_STORAGE_FORMATS = ('npz', 'npy', 'blosc2', 'npy_tiled')
+# the presence of any of these marks a preprocessed case (together with CASE.pkl)
+PREPROCESSED_DATA_SUFFIXES = ('.npz', '.npy', '.b2nd', '.tiled.npy')
+# everything that may belong to a case. npy files are also created when unpacking npz
+PREPROCESSED_CASE_SUFFIXES = ('.npz', '.npy', '_seg.npy', '.b2nd', '_seg.b2nd', '.tiled.npy', '_seg.tiled.npy',
+                              '.tiled.json', '.pkl')
+
+
+def _check_blosc2():
+    if blosc2 is None:
+        raise RuntimeError("preprocessed_storage_format 'blosc2' requires the blosc2 package. Install it with "
+                           "'pip install blosc2' or use 'npz'/'npy' instead")
+
+
+def get_blosc2_chunks_and_blocks(array_shape: Tuple[int, ...], patch_size: Union[List[int], Tuple[int, ...]]) -> \
+        Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    """
+    one chunk per channel covering about one patch. Blocks (the unit blosc2 decompresses) are an eighth of that so that
+    a patch only touches few blocks that are not needed. For 2d configurations the patch size has fewer dimensions than
+    the data, the leading (slice) axis then gets chunk size 1
+    """
+    spatial = array_shape[1:]
+    patch_size = [1] * (len(spatial) - len(patch_size)) + list(patch_size)
+    chunks = [1] + [int(min(s, p)) for s, p in zip(spatial, patch_size)]
+    blocks = [1] + [max(1, c // 2) for c in chunks[1:]]
+    return tuple(chunks), tuple(blocks)
+
+
+def get_tile_shape(spatial_shape: Tuple[int, ...], patch_size: Union[List[int], Tuple[int, ...]]) -> Tuple[int, ...]:
+    """
+    tiles are half a patch along each axis, so a patch intersects 2-3 tiles per axis. For 2d configurations the patch
+    size has fewer dimensions than the data, the leading (slice) axis then gets tile size 1
+    """
+    patch_size = [1] * (len(spatial_shape) - len(patch_size)) + list(patch_size)
+    return tuple([int(min(s, max(1, p // 2))) for s, p in zip(spatial_shape, patch_size)])
+
+
+class TiledArray(object):
+    def __init__(self, tiles: np.ndarray, shape: Tuple[int, ...]):
+        """
+        Lazy view on an array that is stored tile by tile. tiles has shape (c, *num_tiles, *tile_shape), so every tile
+        is a contiguous block in the (memory mapped) file. shape is the shape of the actual array (c, x, y(, z)), the last
+        tile along each axis may be padded.
+
+        Slicing (arr[slices]) returns a np.ndarray and only touches the tiles that intersect the requested region. Steps
+        other than 1 are supported but read the entire covered region. np.asarray(arr) or arr[:] loads everything
+        """
+        self.tiles = tiles
+        self.shape = tuple([int(i) for i in shape])
+        self.ndim = len(self.shape)
+        self.dtype = tiles.dtype
+        self.tile_shape = tuple(tiles.shape[self.ndim:])
+        assert tiles.ndim == 2 * self.ndim - 1, 'tiles must be (c, *num_tiles, *tile_shape)'
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        ret = self[:]
+        return ret if dtype is None else ret.astype(dtype, copy=False)
+
+    def _normalize_index(self, item) -> Tuple[List[slice], List[int]]:
+        if not isinstance(item, tuple):
+            item = (item,)
+        if any([i is Ellipsis for i in item]):
+            idx = [j for j, i in enumerate(item) if i is Ellipsis][0]
+            item = item[:idx] + (slice(None),) * (self.ndim - len(item) + 1) + item[idx + 1:]
+        item = tuple(item) + (slice(None),) * (self.ndim - len(item))
+        assert len(item) == self.ndim, f'too many indices for TiledArray with {self.ndim} dimensions'
+        slices, squeeze = [], []
+        for d, i in enumerate(item):
+            if isinstance(i, slice):
+                slices.append(slice(*i.indices(self.shape[d])))
+            else:
+                i = int(i)
+                if i < 0:
+                    i += self.shape[d]
+                if not 0 <= i < self.shape[d]:
+                    raise IndexError(f'index {i} is out of bounds for axis {d} with size {self.shape[d]}')
+                slices.append(slice(i, i + 1, 1))
+                squeeze.append(d)
+        return slices, squeeze
+
+    def __getitem__(self, item) -> np.ndarray:
+        slices, squeeze = self._normalize_index(item)
+        # slices are normalized (slice.indices), so len(range(...)) is the output size and steps may be negative
+        out_shape = [len(range(s.start, s.stop, s.step)) for s in slices]
+        if any([i == 0 for i in out_shape]):
+            return np.zeros(out_shape, dtype=self.dtype).squeeze(tuple(squeeze))
+        # bounding region of the requested (spatial) elements
+        lbs = [min(s.start, s.start + (n - 1) * s.step) for s, n in zip(slices[1:], out_shape[1:])]
+        ubs = [max(s.start, s.start + (n - 1) * s.step) + 1 for s, n in zip(slices[1:], out_shape[1:])]
+        first_tile = [l // t for l, t in zip(lbs, self.tile_shape)]
+        last_tile = [(u - 1) // t + 1 for u, t in zip(ubs, self.tile_shape)]
+        # only the required tiles are read from the memory map
+        channels = slices[0] if slices[0].step > 0 else slice(slices[0].start, slices[0].stop if slices[0].stop >= 0
+                                                              else None, slices[0].step)
+        region = self.tiles[(channels,) + tuple([slice(f, l) for f, l in zip(first_tile, last_tile)])]
+        # (c, n0, n1, n2, t0, t1, t2) -> (c, n0, t0, n1, t1, n2, t2) -> (c, n0 * t0, n1 * t1, n2 * t2)
+        dim = len(self.tile_shape)
+        region = region.transpose([0] + [j for d in range(dim) for j in (1 + d, 1 + dim + d)])
+        region = region.reshape(region.shape[0], *[(l - f) * t for f, l, t in
+                                                   zip(first_tile, last_tile, self.tile_shape)])
+        offsets = [f * t for f, t in zip(first_tile, self.tile_shape)]
+        region = region[(slice(None),) + tuple([slice(l - o, u - o) for l, u, o in zip(lbs, ubs, offsets)])]
+        if any([s.step != 1 for s in slices[1:]]):
+            # region is ascending. Negative steps start at the upper end, which [::step] does
+            region = region[(slice(None),) + tuple([slice(None, None, s.step) for s in slices[1:]])]
+        if len(squeeze) > 0:
+            region = region.squeeze(tuple(squeeze))
+        # no memmap subclass, and views on a single tile may not be contiguous
+        region = np.asarray(region)
+        return region if region.flags.c_contiguous else np.ascontiguousarray(region)
+
+
+def save_tiled_array(arr: np.ndarray, filename: str, tile_shape: Tuple[int, ...]):
+    """
+    writes arr (c, x, y(, z)) tile by tile as .npy file with shape (c, *num_tiles, *tile_shape). See TiledArray
+    """
+    dim = arr.ndim - 1
+    num_tiles = [int(np.ceil(s / t)) for s, t in zip(arr.shape[1:], tile_shape)]
+    padded = np.zeros((arr.shape[0], *[n * t for n, t in zip(num_tiles, tile_shape)]), dtype=arr.dtype)
+    padded[(slice(None),) + tuple([slice(0, s) for s in arr.shape[1:]])] = arr
+    # (c, n0 * t0, n1 * t1, n2 * t2) -> (c, n0, t0, n1, t1, n2, t2) -> (c, n0, n1, n2, t0, t1, t2)
+    padded = padded.reshape(arr.shape[0], *[j for n, t in zip(num_tiles, tile_shape) for j in (n, t)])
+    padded = padded.transpose([0] + [1 + 2 * d for d in range(dim)] + [2 + 2 * d for d in range(dim)])
+    np.save(filename, np.ascontiguousarray(padded))
+
+
+def save_preprocessed_case(data: np.ndarray, seg: np.ndarray, output_filename_truncated: str,
+                           storage_format: str = 'npz', patch_size: Union[List[int], Tuple[int, ...]] = None):
+    """
+    does not write the properties file, that is done by the preprocessor. patch_size is used to determine the chunk
+    shape of blosc2 arrays and the tile shape of npy_tiled (None = let blosc2 decide / a single tile)
+    """
+    if storage_format == 'npz':
+        np.savez_compressed(output_filename_truncated + '.npz', data=data, seg=seg)
+    elif storage_format == 'npy':
+        np.save(output_filename_truncated + '.npy', data)
+        np.save(output_filename_truncated + '_seg.npy', seg)
+    elif storage_format == 'blosc2':
+        _check_blosc2()
+        cparams = {'codec': blosc2.Codec.LZ4HC, 'clevel': 8, 'nthreads': 1}
+        for arr, suffix in ((data, '.b2nd'), (seg, '_seg.b2nd')):
+            if patch_size is not None:
+                chunks, blocks = get_blosc2_chunks_and_blocks(arr.shape, patch_size)
+            else:
+                chunks, blocks = None, None
+            blosc2.asarray(np.ascontiguousarray(arr), urlpath=output_filename_truncated + suffix, chunks=chunks,
+                           blocks=blocks, cparams=cparams, mode='w')
+    elif storage_format == 'npy_tiled':
+        tile_shape = get_tile_shape(data.shape[1:], patch_size) if patch_size is not None else data.shape[1:]
+        save_tiled_array(data, output_filename_truncated + '.tiled.npy', tile_shape)
+        save_tiled_array(seg, output_filename_truncated + '_seg.tiled.npy', tile_shape)
+        save_json({'data': data.shape, 'seg': seg.shape, 'tile_shape': tile_shape},
+                  output_filename_truncated + '.tiled.json')
+    else:
+        raise RuntimeError(f'Unknown preprocessed_storage_format: {storage_format}. Supported: '
+                           f'{PREPROCESSED_STORAGE_FORMATS}')
+
+
+def open_preprocessed_array(filename_truncated: str, key: str = 'data'):
+    """
+    key is 'data' or 'seg'. Returns (array, memory_mapped). Prefers npy_tiled over blosc2 over npy over npz. If
+    memory_mapped is False the array was decompressed from the npz file and is a plain np.ndarray.
+    blosc2 arrays are returned as blosc2.NDArray: slicing them (arr[slices]) returns a np.ndarray and only decompresses
+    the chunks that are needed. Same for npy_tiled, which is returned as TiledArray. Use arr[:] if you need everything
+    """
+    suffix = '' if key == 'data' else '_seg'
+    if isfile(filename_truncated + suffix + '.tiled.npy'):
+        shapes = load_json(filename_truncated + '.tiled.json')
+        return TiledArray(np.load(filename_truncated + suffix + '.tiled.npy', 'r'), shapes[key]), True
+    elif isfile(filename_truncated + suffix + '.b2nd'):
+        _check_blosc2()
+        return blosc2.open(urlpath=filename_truncated + suffix + '.b2nd', mode='r', dparams={'nthreads': 1},
+                           mmap_mode='r'), True
+    elif isfile(filename_truncated + suffix + '.npy'):
+        return np.load(filename_truncated + suffix + '.npy', 'r'), True
+    else:
+        return np.load(filename_truncated + '.npz')[key], False
+
+
+def preprocessed_case_exists(filename_truncated: str) -> bool:
+    return isfile(filename_truncated + '.pkl') and any([isfile(filename_truncated + i)
+                                                        for i in PREPROCESSED_DATA_SUFFIXES])
+
+
+def remove_preprocessed_case(filename_truncated: str):
+    for suffix in PREPROCESSED_CASE_SUFFIXES:
+        if isfile(filename_truncated + suffix):
+            os.remove(filename_truncated + suffix)